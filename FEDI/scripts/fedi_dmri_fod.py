@@ -16,6 +16,7 @@ import nibabel as nib
 from collections import OrderedDict
 from huggingface_hub import hf_hub_download
 from FEDI.utils.common import FEDI_ArgumentParser
+from FEDI.utils.FEDI_cache import cached_matrix
 from FEDI.models.pytorch.sh import spherical_harmonic
 from FEDI.models.pytorch.models import SphericalCNN_FOD_Neonatal
 
@@ -44,6 +45,10 @@ def parse_arguments():
     return parser.parse_args()
 
 def compute_sh_basis(bvecs, l_max=8):
+    # The basis only depends on the shell directions, share it through the design matrix cache
+    return cached_matrix("compute_sh_basis", (bvecs, l_max), lambda: _compute_sh_basis(bvecs, l_max))
+
+def _compute_sh_basis(bvecs, l_max):
     # Compute real symmetric SH basis with proper coefficient ordering
     thetas = np.arccos(np.clip(bvecs[:, 2], -1.0, 1.0))
     phis = np.mod(np.arctan2(bvecs[:, 1], bvecs[:, 0]) + 2 * np.pi, 2 * np.pi)
@@ -11,13 +11,45 @@
 
 import argparse
 import os
+import re
 import subprocess
+import time
 import numpy as np
 import nibabel as nib
 
 from FEDI.utils.common import FEDI_ArgumentParser, Metavar
 
 
+# Only every PREVIEW_VOLUME_STRIDE-th volume is registered by --preview
+PREVIEW_VOLUME_STRIDE = 4
+
+
+def registration_epochs(epochs):
+    """Epochs after which the data is registered to the SHORE prediction."""
+    # ITER_REG: registration iterations (adjust based on epochs)
+    if epochs >= 4:
+        return [1, 2, 3, 4]  # Default for 6 epochs
+    elif epochs >= 3:
+        return [1, 2]  # For 3 epochs
+    elif epochs >= 2:
+        return [1]  # For 2 epochs
+    return []  # No registration for 1 epoch
+
+
+def run_logged(command):
+    """Run command like subprocess.run(check=True), echo its output and return it."""
+    # Unbuffered, so that the output of Python commands is echoed as it comes
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
+                               env=dict(os.environ, PYTHONUNBUFFERED="1"))
+    lines = []
+    for line in process.stdout:
+        print(line, end="")
+        lines.append(line)
+    if process.wait():
+        raise subprocess.CalledProcessError(process.returncode, command)
+    return "".join(lines)
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Motion correction of diffusion MRI data.",
@@ -41,12 +73,25 @@ def main():
     optional_args = parser.add_argument_group("Optional Arguments")
     optional_args.add_argument("-m", "--mask", required=False, metavar=Metavar.file, help="Path to the mask file (required for GMM weighting).")
     optional_args.add_argument("--epochs", type=int, default=6, metavar=Metavar.int, help="Number of reconstruction iterations (default: 6).")
+    optional_args.add_argument("-n", "--nprocs", "--nthreads", type=int, default=1, metavar=Metavar.int, help="Number of processes used by the SHORE reconstruction (default: 1).")
+    optional_args.add_argument("--cache_dir", required=False, metavar=Metavar.folder, help="Directory where SHORE design matrices are cached across epochs and subjects (default: <output_dir>/cache).")
+    optional_args.add_argument("--voxel_weighting", action="store_true", help="After initialization, use SHORE-based voxel-wise weights instead of GMM slice weights.")
+    optional_args.add_argument("--echoes", nargs="+", default=[], metavar=Metavar.file, help="Other echo series of the same acquisition (e.g. TE2 of the dual-echo scheme), with the shape, gradient table and mask of --dmri. They are reconstructed jointly with --dmri by each fedi_dmri_recon call, with its slice weights, and moved with its registration transforms.")
+    optional_args.add_argument("--robust", action="store_true", help="Reconstruct each epoch with fedi_dmri_recon --robust: the GMM slice weights are iterated in memory until they converge, starting from the weights of fedi_dmri_outliers, so fewer epochs are needed between registrations (slice weighting only, not with --preview).")
+    optional_args.add_argument("--preview", action="store_true", help=f"Fast low-fidelity run for QC: a single epoch with a preview reconstruction (see fedi_dmri_recon --preview), registering every {PREVIEW_VOLUME_STRIDE}th volume. Writes the same files and reports the speedup over the full configuration.")
 
     # Parse the command-line arguments
     args = parser.parse_args()
+    if args.preview and args.echoes:
+        parser.error("--preview reconstructs a single echo, it does not support --echoes")
+    if args.preview and args.robust:
+        parser.error("--preview reconstructs with the slice weights as given, it does not support --robust")
 
     # Create output directory if it doesn't exist
     os.makedirs(args.output_dir, exist_ok=True)
+
+    # Every epoch reconstructs with the same gradient tables, share their design matrices
+    cache_dir = args.cache_dir or os.path.join(args.output_dir, "cache")
     
     # Determine AXSLICES (slice axis) - matching bash lines 124-137
     # Find minimum dimension to determine slice axis
@@ -71,24 +116,31 @@ def main():
     # Define constants (matching bash variable names from STEP 8)
     raw_working_dmri = args.dmri  # RAWWORKING_DMRI - original input, never changes
     working_dmri = args.dmri  # WORKING_DMRI - gets updated after registration
+    working_echoes = list(args.echoes)  # Other echoes, registered with WORKING_DMRI
     working_dmri_gmm = None  # WORKING_DMRI_GMM - will be set in reorientation section
     working_dmri_mask = args.mask  # WORKING_DMRIMASK
     working_dmri_mask_gmm = None  # WORKING_DMRIMASK_GMM - will be set in reorientation section
     
     epochs = args.epochs  # EPOCHS
-    # ITER_REG: registration iterations (adjust based on epochs)
-    if epochs >= 4:
-        iter_registration = [1, 2, 3, 4]  # Default for 6 epochs
-    elif epochs >= 3:
-        iter_registration = [1, 2]  # For 3 epochs
-    elif epochs >= 2:
-        iter_registration = [1]  # For 2 epochs
-    else:
-        iter_registration = []  # No registration for 1 epoch
+    iter_registration = registration_epochs(epochs)
+    n_volumes = dmri_img.shape[3]
+    reg_volumes = None
+    if args.preview:
+        # One epoch, registered at its end on a subset of the volumes
+        epochs = 1
+        iter_registration = [0]
+        reg_volumes = list(range(0, n_volumes, PREVIEW_VOLUME_STRIDE))
+        timings = {"outliers": 0., "recon": 0., "recon_full": 0., "registration": 0.}
+        preview_start = time.time()
     reg_update = 0  # REG_UPDATE
     reg_counter = 0  # REG_COUNTER
     bvec_ste_in = args.bvec  # BVECSTEIN - gets updated after registration/reconstruction
     bvec_ste = args.bvec  # BVECSTE - original bvec, doesn't change
+    # Residual statistics saved by the last reconstruction, and the dMRI they refer to
+    residuals = None
+    residuals_dmri = None
+    # Inputs and outputs of the last reconstruction, whose unchanged slices the next one copies
+    previous_recon = None
 
     # Main iteration loop (matching STEP 8, lines 1699-1825, including reorientation section)
     for iteration in range(epochs):
@@ -233,6 +285,9 @@ def main():
                 # spred_gmm is set in the reorientation section above
                 if spred_gmm and os.path.exists(spred_gmm):
                     outliers_cmd.extend(["--spredgmm", spred_gmm])
+                # Reuse the residuals of the reconstruction, unless the data was registered since
+                if residuals and residuals_dmri == working_dmri and os.path.exists(residuals):
+                    outliers_cmd.extend(["--residuals", residuals])
         
         # Add mask arguments only if mask is provided
         if working_dmri_mask:
@@ -240,8 +295,14 @@ def main():
                 "--mask", working_dmri_mask,
                 "--maskgmm", working_dmri_mask_gmm
             ])
+            # The residuals only keep the z-scores of the masked voxels, weight those
+            if "--residuals" in outliers_cmd:
+                outliers_cmd.append("--shore_mask_only")
         
+        stage_start = time.time()
         subprocess.run(outliers_cmd, check=True)
+        if args.preview:
+            timings["outliers"] += time.time() - stage_start
 
         print("=" * 120)
         # Select weighting method (matching bash lines 1759-1787)
@@ -269,6 +330,9 @@ def main():
         elif iteration == 99:  # Not used - alternative option
             shore_weighting = os.path.join(args.output_dir, f"fvoxelweights_shore_{iteration}.nii.gz")
             print("Shore-based (voxel-wise) weights will be used.")
+        elif args.voxel_weighting:  # Voxel-wise weighting after initial step
+            shore_weighting = os.path.join(args.output_dir, f"fvoxelweights_shore_{iteration}.nii.gz")
+            print("Shore-based (voxel-wise) weights will be used.")
         else:  # Default weighting after initial step
             shore_weighting = os.path.join(args.output_dir, f"fsliceweights_gmmodel_{iteration}.txt")
             print("GMM (slice-wise) weights will be used.")
@@ -276,20 +340,55 @@ def main():
         print("=" * 120)
         
         # SHORE Fitting (matching bash lines 1789-1794)
+        # The other echoes are outputs of the same call, spred<epoch>_echo<k>.nii.gz
+        echo_suffixes = [""] + [f"_echo{echo}" for echo in range(2, len(working_echoes) + 2)]
         recon_cmd = [
             "fedi_dmri_recon",
-            "--dmri", working_dmri,
+            "--dmri", working_dmri, *working_echoes,
             "--bval", args.bval,
             "--bvec_in", bvec_ste_in,
             "--bvec_out", bvec_ste,
             "--weights", shore_weighting,
-            "--fspred", os.path.join(args.output_dir, f"spred{iteration}.nii.gz"),
+            "--fspred", *[os.path.join(args.output_dir, f"spred{iteration}{suffix}.nii.gz") for suffix in echo_suffixes],
+            "--cache_dir", cache_dir,
+            "--nprocs", str(args.nprocs),
             "-do_not_use_mask"
         ]
         if working_dmri_mask:
             recon_cmd.extend(["--mask", working_dmri_mask])
-        
-        subprocess.run(recon_cmd, check=True)
+        if args.robust and shore_weighting.endswith(".txt"):
+            recon_cmd.append("--robust")
+        residuals = os.path.join(args.output_dir, f"residuals{iteration}.npz")
+        residuals_dmri = working_dmri
+        recon_cmd.extend(["--residuals"] + [os.path.join(args.output_dir, f"residuals{iteration}{suffix}.npz") for suffix in echo_suffixes])
+        fcoeff = os.path.join(args.output_dir, f"coef{iteration}.npz")
+        recon_cmd.extend(["--fcoeff"] + [os.path.join(args.output_dir, f"coef{iteration}{suffix}.npz") for suffix in echo_suffixes])
+        # Without registration since the last epoch, only the slices whose weights changed are refitted
+        # (--robust refits every slice as its weights change)
+        if (previous_recon and not working_echoes and "--robust" not in recon_cmd and previous_recon["dmri"] == working_dmri and previous_recon["bvec_in"] == bvec_ste_in
+                and os.path.splitext(previous_recon["weights"])[1] == os.path.splitext(shore_weighting)[1]):
+            recon_cmd.extend([
+                "--previous_fspred", previous_recon["fspred"],
+                "--previous_weights", previous_recon["weights"],
+                "--previous_fcoeff", previous_recon["fcoeff"],
+                "--previous_dmri", previous_recon["dmri"]
+            ])
+        previous_recon = {"dmri": working_dmri, "bvec_in": bvec_ste_in, "weights": shore_weighting,
+                          "fspred": os.path.join(args.output_dir, f"spred{iteration}.nii.gz"), "fcoeff": fcoeff}
+
+        if args.preview:
+            recon_cmd.append("--preview")
+            stage_start = time.time()
+            recon_log = run_logged(recon_cmd)
+            timings["recon"] += time.time() - stage_start
+            # Wall time of the preview plus the extra time the full fit is estimated to take
+            estimate = re.search(r"Estimated time of the full reconstruction: ([0-9.eE+-]+) seconds", recon_log)
+            fit_time = re.search(r"The ShoreRecon block took ([0-9.eE+-]+) seconds", recon_log)
+            timings["recon_full"] += time.time() - stage_start
+            if estimate and fit_time:
+                timings["recon_full"] += float(estimate.group(1)) - float(fit_time.group(1))
+        else:
+            subprocess.run(recon_cmd, check=True)
 
         # Make sure that bvec_in is bvec_out after reconstruction done (matching bash line 1797)
         bvec_ste_in = bvec_ste
@@ -305,13 +404,23 @@ def main():
             reg_working_path = os.path.join(args.output_dir, f"registration_iter{reg_counter}")
 
             # Volume-to-volume registration (matching bash lines 1807-1810)
-            subprocess.run([
+            reg_cmd = [
                 "fedi_dmri_reg",
                 "--input_dmri", raw_working_dmri,
                 "--target_dmri", os.path.join(args.output_dir, f"spred{iteration}.nii.gz"),
                 "--output_dir", reg_working_path,
                 "--output_dmri", os.path.join(args.output_dir, f"working_updated{reg_update}.nii.gz")
-            ], check=True)
+            ]
+            if reg_volumes is not None:
+                reg_cmd.extend(["--volumes", ",".join(str(v) for v in reg_volumes)])
+            # The other echoes move with the first one
+            updated_echoes = [os.path.join(args.output_dir, f"working_updated{reg_update}{suffix}.nii.gz") for suffix in echo_suffixes[1:]]
+            for raw_echo, updated_echo in zip(args.echoes, updated_echoes):
+                reg_cmd.extend(["--apply_to", raw_echo, updated_echo])
+            stage_start = time.time()
+            subprocess.run(reg_cmd, check=True)
+            if args.preview:
+                timings["registration"] += time.time() - stage_start
 
             # Rotate bvecs per volume (matching bash lines 1814-1819)
             bvec_ste_rot = os.path.join(args.output_dir, f"rotated_bvecs{reg_update}")
@@ -326,12 +435,24 @@ def main():
 
             # Update working variables after registration (matching bash lines 1821-1823)
             working_dmri = os.path.join(args.output_dir, f"working_updated{reg_update}.nii.gz")
+            working_echoes = updated_echoes
             bvec_ste_in = bvec_ste_rot
             reg_update += 1
 
     print("\n" + "="*120)
     print("Motion correction completed successfully!")
     print(f"Final output: {working_dmri}")
+    for working_echo in working_echoes:
+        print(f"Final output: {working_echo}")
+    if args.preview:
+        # The full configuration runs every stage per epoch and registers all volumes
+        preview_duration = time.time() - preview_start
+        other = preview_duration - timings["outliers"] - timings["recon"] - timings["registration"]
+        n_registrations = len([i for i in registration_epochs(args.epochs) if i < args.epochs])
+        full_duration = (args.epochs * (other + timings["outliers"] + timings["recon_full"])
+                         + n_registrations * timings["registration"] * n_volumes / len(reg_volumes))
+        print(f"Preview took {preview_duration:.1f} seconds, the full configuration ({args.epochs} epochs) "
+              f"is estimated at {full_duration:.1f} seconds: {full_duration / preview_duration:.1f} times faster.")
     print("="*120)
 
 
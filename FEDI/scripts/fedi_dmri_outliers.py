@@ -11,11 +11,11 @@
 
 
 import argparse
+from contextlib import nullcontext
 import numpy as np
 import os
-import math
 import subprocess
-import numpy.matlib as matlib
+import nibabel as nib
 
 # Matplotlib setup for non-interactive backend
 import matplotlib
@@ -24,11 +24,14 @@ import matplotlib.pyplot as plt
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 
 # Import functions from Dipy and SciPy
-from scipy import stats
 from dipy.io.gradients import read_bvals_bvecs
 from dipy.io.image import load_nifti, save_nifti
 
 from FEDI.utils.common import FEDI_ArgumentParser, Metavar
+from FEDI.utils.FEDI_nifti import nifti_memmap_writer
+from FEDI.utils.FEDI_outlier_scores import OutlierScores
+from FEDI.utils.FEDI_residuals import ResidualSummary
+from FEDI.utils.FEDI_weighting import gmm_slice_weights, residual_voxel_weights
 
 
 parser = argparse.ArgumentParser(
@@ -64,6 +67,7 @@ optional = parser.add_argument_group('\033[1mOPTIONAL OPTIONS\033[0m')
 # Add optional arguments with default values
 optional.add_argument("-s", "--spred", required=False, metavar=Metavar.file, help="Path to spred file")
 optional.add_argument("-f", "--spredgmm", required=False, metavar=Metavar.file, help="Path to spred file for GMM")
+optional.add_argument("-i", "--residuals", required=False, metavar=Metavar.file, help="Residual statistics (.npz) saved by fedi_dmri_recon --residuals for dmri and spred. The SHORE-based voxel weights, and the GMM weights when dmrigmm is dmri, are computed from it without loading dmri and spred")
 
 optional.add_argument("-m", "--mask", required=False, metavar=Metavar.file, help="Path to mask file, required for GMM weighting")
 optional.add_argument("-k", "--maskgmm", required=False, metavar=Metavar.file, help="Path to mask file, required for GMM weighting")
@@ -79,6 +83,9 @@ optional.add_argument("-n", "--fsliceweights_angle_neighbors", required=False, m
 optional.add_argument("-y", "--fsliceweights_corre_neighbors", required=False, metavar=Metavar.file, help="Filename for sliceweights using correlation with neighbors")
 optional.add_argument("-g", "--fsliceweights_gmmodel", required=False, metavar=Metavar.file, help="Filename for sliceweights using Gaussian mixture model (GMM)")
 optional.add_argument("-r", "--fvoxelweights_shorebased", required=False, metavar=Metavar.file, help="Filename.nii.gz (4D)  for voxelweights using shore-based residuals")
+optional.add_argument("--shore_mask_only", action="store_true", help="Compute the shore-based voxelweights only within --mask, voxels outside the mask get a weight of 1 (default: all voxels are weighted)")
+
+optional.add_argument("--slab_size", type=int, default=0, metavar=Metavar.int, help="Read dmri and spred by slabs of this many slices, all the weights being computed in a single pass over the data, to bound memory (default: 0, load the whole volume)")
 
 # Parse the command-line arguments
 args = parser.parse_args()
@@ -86,6 +93,23 @@ args = parser.parse_args()
 
 
 
+def iter_slabs(nz, slab_size):
+    """Slices of the slabs of slab_size slices of a volume of nz slices, a single slab if slab_size <= 0."""
+    slab_size = slab_size if slab_size > 0 else max(nz, 1)
+    for start in range(0, nz, slab_size):
+        yield slice(start, min(start + slab_size, nz))
+
+
+def read_slab(img, slab):
+    """Slices slab of a 4D NIfTI image, read lazily with the dtype of load_nifti."""
+    return np.asanyarray(img.dataobj[:, :, slab, :])
+
+
+def slab_dtype(img):
+    """dtype of the data read by read_slab."""
+    return np.asanyarray(img.dataobj[:1, :1, :1, :1]).dtype
+
+
 def save_figure_onebox(weights, clim_min, clim_max, title, outpath, fignamepng):
     # Plot and save the 2D image
     fig, ax = plt.subplots(nrows=1, ncols=1, figsize=(25, 7.5))  # Adjust figure size
@@ -154,107 +178,8 @@ def save_figure_twobox(first_box, second_box, clim1_min, clim1_max, clim2_min, c
 
 
 
-def calculate_mzscore_weightts(Zscores, lowerThreshold, upperThreshold, weightscalingmethod):
-
-    weights = Zscores
-    weights[weights < lowerThreshold] = lowerThreshold
-    weights[weights > upperThreshold] = upperThreshold
-
-    if weightscalingmethod == "linear":
-        # Linear scaling
-        weights = (weights - lowerThreshold) / (upperThreshold - lowerThreshold)
-    elif weightscalingmethod == "sigmoid":
-        # Sigmoid scaling
-        k = 1  # You may adjust the k value as needed
-        weights = (weights - lowerThreshold) * 2.0 / (upperThreshold - lowerThreshold) - 1.0
-        weights = 1 / (1 + np.exp(-weights / k))
-
-    weights = 1 - weights
-
-    # Replace NaN with 0
-    weights = np.nan_to_num(weights)
-
-    # Ensure that at least some values are > 0
-    for i in range(weights.shape[0]):
-        if np.all(weights[i, :] <= 0):
-            weights[i, 0] = 1
-            weights[i, -1] = 1
-
-    return weights
-
-
-def mzscore_weighting(dmri, fmask, bvals, outpath, metric, lowerThreshold, upperThreshold, weightscalingmethod, fsliceweights_mzscore):
-
-    print("Calculate Modified Z-Score Weights")
-    bvalsunique = np.unique(bvals.round(-2))
-    shape = dmri.shape
-    NorZscore = np.zeros((shape[2], shape[3]))
-    NorZscore.fill(np.nan)
-    ModZscore = np.zeros((shape[2], shape[3]))
-    ModZscore.fill(np.nan)
-
-    for b in bvalsunique:
-        # for each dwi bvalues
-        inds = np.where(bvals.round(-2) == b)[0]
-        # print("Modified Z-Score for bvalue : ",b)
-        # print("Index are :",inds)
-        if inds.size < 2:
-            continue
-
-        shell = dmri[:, :, :, inds].astype(np.float32)
-        if fmask is not None:
-            mask = fmask.astype(int) == 0
-            # shell[mask] = np.nan
-            shell[mask] = 0
-
-        # not useful line : return indices of that shell has of the True values
-        #  tmp = np.argwhere(np.isnan(shell))
-        dims = shell.shape
-
-        # reshape the shell to new size : dims[0] * dims[1] , dims[2], dims[3]
-        shell = shell.reshape((dims[0] * dims[1], dims[2], dims[3]))
-        # print("---bvalue is:", b)
-        # print("---dmri.shape:", dmri.shape)
-        # print("---shell.shape: ",shell.shape)
-
-        # 1. Normal Zscore calculation
-        # zscore = (shell-shell_mean)/std
-        norZ=stats.zscore(np.nanmean(shell, axis=0), axis=1, nan_policy='raise')
-        NorZscore[:, inds] = norZ
-
-
-        # 2. Modified Zscore
-        # get y following the chosen metric
-        if metric == "var":
-            y = np.nanvar(shell, axis=0)
-        if metric == "mean":
-            y = np.nanmean(shell, axis=0)
-        if metric == "iod":
-            y = np.nanvar(shell, axis=0) / np.nanmean(shell, axis=0)
-
-        # print("y.shape: ",y.shape)
-        # calculates the mean along axis 1 of y, then replicates the meadian values dims[3] times along first axis, then transpose
-        ymean = matlib.repmat(np.nanmedian(y, axis=1), dims[3], 1).T
-        # print("ymean.shape: ",ymean.shape)
-        # Median Absolute Deviation (MAD) = k-factor * median(|y - ymean|)
-        # k-factor =  For normally distributed data k is taken to be 1.4826
-        MAD = 1.4826 * np.nanmedian(np.abs(y - ymean), axis=1) + 0.0001
-
-        # Calculate modified Zscore = (y-ymean)/MAD
-        modZ = np.abs(y - ymean) /  (matlib.repmat(MAD, dims[3], 1).T )
-
-        # print("modZ.shape: ",modZ.shape)
-        ModZscore[:, inds] = modZ
-        # print("ModZscore.shape", ModZscore.shape)
-
-    NorZscore_weights = calculate_mzscore_weightts(NorZscore, lowerThreshold, upperThreshold, weightscalingmethod)
-    ModZscore_weights = calculate_mzscore_weightts(ModZscore, lowerThreshold, upperThreshold, weightscalingmethod)
-
-    # # Save ModZscore as a text file
-    # np.savetxt(outpath +"/"+ "Zscoressss.txt", NorZscore, delimiter=", ")
-
-    # Save ModZscore as a text file
-    # np.savetxt(outpath + "/fslicemodified_zscore.txt", ModZscore, delimiter=',', fmt='%.6f')
+def mzscore_weighting(ModZscore, ModZscore_weights, outpath, lowerThreshold, upperThreshold, fsliceweights_mzscore):
+    """Save the modified z-score slice weights computed by OutlierScores, and their figure."""
 
     # Save Weights as a text file
     np.savetxt(os.path.join(outpath, fsliceweights_mzscore), ModZscore_weights, delimiter=',', fmt='%.6f')
@@ -298,80 +223,12 @@ def normalize_bvecs(bvecs):
 
 
 
-def neighbors_weighting(dmri, bvals, bvecs, b0_threshold, std_scale, filename_angle_neighbors, filename_correlation_neighbors, outpath):
-
-    print("Calculate Neighbors Weights")
-
-    AngleMatrix = np.ones((dmri.shape[2], dmri.shape[3]))
-    CorreMatrix = np.ones((dmri.shape[2], dmri.shape[3]))
-
-    bvecs = normalize_bvecs(bvecs)
-    for slice_idx in range(dmri.shape[2]-2):
-        slice_dmri = dmri[:, :, slice_idx:slice_idx+2, :]
-
-        results_dict = {}
-        # print("slice:", slice_idx)
-        for bval in np.unique(bvals[bvals > b0_threshold]):
-            shell_idx = np.where(bvals == bval)[0]
-            shell = bvecs[shell_idx]
-            results_dict[bval] = np.ones((len(shell), 3)) * -1
-            for i, vec in enumerate(shell):
-                if np.linalg.norm(vec) < 0.001:
-                    continue
-
-                dot_product = np.clip(np.tensordot(shell, vec, axes=1), -1, 1)
-                # print(dot_product)
-                angle = np.arccos(dot_product) * 180 / math.pi
-                angle[np.isnan(angle)] = 0
-
-                idx = np.argpartition(angle, 4).tolist()
-                idx.remove(i)
-
-                avg_angle = np.average(angle[idx[:3]])
-                corr = np.corrcoef([slice_dmri[..., shell_idx[i]].ravel(),
-                                    slice_dmri[..., shell_idx[idx[0]]].ravel(),
-                                    slice_dmri[..., shell_idx[idx[1]]].ravel(),
-                                    slice_dmri[..., shell_idx[idx[2]]].ravel()])
-                results_dict[bval][i] = [shell_idx[i], avg_angle,
-                                         np.average(corr[0, 1:])]
-
-        for key in results_dict.keys():
-            # print("key:", key)
-            avg_angle = np.round(np.average(results_dict[key][:, 1]), 4)
-            std_angle = np.round(np.std(results_dict[key][:, 1]), 4)
-
-            avg_corr = np.round(np.average(results_dict[key][:, 2]), 4)
-            std_corr = np.round(np.std(results_dict[key][:, 2]), 4)
-
-            outliers_angle = np.argwhere(
-                results_dict[key][:, 1] < avg_angle-(std_scale*std_angle))
-            outliers_corr = np.argwhere(
-                results_dict[key][:, 2] < avg_corr-(std_scale*std_corr))
-
-            # print('Results for shell {} with {} directions:'.format(key, len(results_dict[key])))
-            # print('AVG and STD of angles: {} +/- {}'.format(avg_angle, std_angle))
-            # print('AVG and STD of correlations: {} +/- {}'.format(avg_corr, std_corr))
-
-            if len(outliers_angle) or len(outliers_corr):
-                # print('Possible outliers ({} STD below or above average):'.format(std_scale))
-                # print('Outliers based on angle [position (4D), value]')
-                for i in outliers_angle:
-                    # print(results_dict[key][i, :][0][0:2])
-                    AngleMatrix[slice_idx, int(results_dict[key][i, :][0][0])] = 0
-                # print('Outliers based on correlation [position (4D), value]')
-                for i in outliers_corr:
-                    # print(results_dict[key][i, :][0][0])
-                    CorreMatrix[slice_idx, int(results_dict[key][i, :][0][0])] = 0
-
-            else:
-                # print('No outliers detected.')
-                DoNotPrint=1
-            # print()
+def neighbors_weighting(AngleMatrix, CorreMatrix, filename_angle_neighbors, filename_correlation_neighbors, outpath):
+    """Save the angle and correlation slice weights computed by OutlierScores, and their figure."""
 
     np.savetxt(os.path.join(outpath, filename_angle_neighbors), AngleMatrix, delimiter=',', fmt='%.6f')
     # Save Weights as a text file
     np.savetxt(os.path.join(outpath, filename_correlation_neighbors), CorreMatrix, delimiter=',', fmt='%.6f')
-    filename_angle_neighbors, filename_correlation_neighbors
 
     filename_correlation_neighbors_png = filename_correlation_neighbors.replace(".txt", ".png")
 
@@ -382,70 +239,28 @@ def neighbors_weighting(dmri, bvals, bvecs, b0_threshold, std_scale, filename_an
     return AngleMatrix, CorreMatrix
 
 
-def shorebased_zscore_residuals_voxelwise(dmri, spred, bvals):
+def shorebased_weighting_voxelwise(zscores, affine, outpath, filename, mask=None):
     """
-    Calculate voxel-wise standardized residuals.
-
-    Args:
-        dmri (numpy.ndarray): Raw diffusion MRI data.
-        spred (numpy.ndarray): Predicted data from a model (e.g., SHORE).
-        bvals (numpy.ndarray): B-values array.
+    Calculate voxel-wise shore-based weights from standardized residuals.
 
-    Returns:
-        numpy.ndarray: Voxel-wise standardized residuals.
-    """
-    # Calculate residuals
-    residualsraw = dmri - spred
-
-    # Initialize array for standardized residuals
-    zscores = np.zeros_like(residualsraw)
-
-    # Iterate over each voxel
-    for i in range(dmri.shape[0]):
-        for j in range(dmri.shape[1]):
-            for k in range(dmri.shape[2]):
-                # print("i,j,k: ",i,j,k)
-                # voxel_residuals = residualsraw[i, j, k, :]
-                for bval in np.unique(bvals):
-                    bval_idx = np.where(bvals == bval)[0]
-                    # print("bval_idx: ",bval_idx)
-                    voxel_residuals_bval=residualsraw[i,j,k,bval_idx]    
-                    sigma_hat = 1.4826 * stats.median_abs_deviation(voxel_residuals_bval)
-                    zscores[i, j, k, bval_idx] = voxel_residuals_bval / sigma_hat
-
-    print("zscores.shape: ",zscores.shape)
-    return zscores
-
-
-def shorebased_weighting_voxelwise(dmri, affine, spred, outpath, filename, bvals):
-    """
-    Calculate voxel-wise shore-based weights.
+    The weights computed from dmri and spred are streamed by OutlierScores,
+    this saves those of residuals already standardized by fedi_dmri_recon.
 
     Args:
-        dmri (numpy.ndarray): Raw diffusion MRI data.
+        zscores (numpy.ndarray): Voxel-wise standardized residuals.
         affine (numpy.ndarray): Affine transformation matrix.
-        spred (numpy.ndarray): Predicted data from a model (e.g., SHORE).
         outpath (str): Output directory path.
         filename (str): Output filename.
-        bvals (numpy.ndarray): B-values array.
+        mask (numpy.ndarray, optional): Voxels to weight, the others get a weight of 1.
 
     Returns:
         numpy.ndarray: Voxel-wise SHORE-based weights.
     """
-    # Calculate voxel-wise standardized residuals
-    zscores = shorebased_zscore_residuals_voxelwise(dmri, spred, bvals)
-
-    # Initialize array for weights
-    weights_4D = np.zeros_like(zscores)
-
-    # Compute weights for each voxel
-    for i in range(dmri.shape[0]):
-        for j in range(dmri.shape[1]):
-            for k in range(dmri.shape[2]):
-                weights_4D[i, j, k, :] = np.sqrt(1 / np.square(np.square(zscores[i, j, k, :]) + 1))
-
-
+    if mask is not None:
+        zscores = np.where(mask[..., None] > 0, zscores, 0)
 
+    # Compute the weights of all voxels at once
+    weights_4D = residual_voxel_weights(zscores)
 
     save_nifti(os.path.join(outpath, filename), weights_4D, affine)
 
@@ -454,7 +269,6 @@ def shorebased_weighting_voxelwise(dmri, affine, spred, outpath, filename, bvals
     return weights_4D
 
 
-
 # def shore_weighting(dmri, spred, fsliceweights_shore):
 #     """
 #     Calculate shore-based weights based on the paper (section 2.1.2) by Alexandra Koch et al. MRM 2019 
@@ -526,286 +340,34 @@ def shorebased_weighting_voxelwise(dmri, affine, spred, outpath, filename, bvals
 
 
 
-class GMModel:
-    """
-    2-component Gaussian Mixture Model for outlier detection
-    Based on the C++ implementation in dwisliceoutliergmm.cpp
-    """
-    
-    def __init__(self, max_iters=50, eps=1e-3, reg_covar=1e-6):
-        self.niter = max_iters
-        self.tol = eps
-        self.reg = reg_covar
-        
-    def fit(self, x):
-        """Fit GMM to vector x using Expectation-Maximization"""
-        x = np.asarray(x).flatten()
-        
-        # Initialize
-        self._init(x)
-        
-        ll0 = -np.inf
-        
-        # EM algorithm
-        for n in range(self.niter):
-            ll = self._e_step(x)
-            self._m_step(x)
-            
-            # Check convergence
-            if np.abs(ll - ll0) < self.tol:
-                break
-            ll0 = ll
-            
-    def posterior(self):
-        """Get posterior probability of inlier class"""
-        return np.exp(self.Rin)
-    
-    def _init(self, x):
-        """Initialize inlier and outlier classes"""
-        med = np.median(x)
-        mad = np.median(np.abs(x - med)) * 1.4826
-        
-        # Initialize means (shift +1 for log-Gaussians)
-        self.Min = med
-        self.Mout = med + 1.0
-        
-        # Initialize standard deviations
-        self.Sin = mad
-        self.Sout = mad + 1.0
-        
-        # Initialize mixing proportions
-        self.Pin = 0.9
-        self.Pout = 0.1
-        
-    def _e_step(self, x):
-        """E-step: update sample log-responsibilities and return log-likelihood"""
-        # Compute log responsibilities
-        self.Rin = self._log_gaussian(x, self.Min, self.Sin) + np.log(self.Pin)
-        self.Rout = self._log_gaussian(x, self.Mout, self.Sout) + np.log(self.Pout)
-        
-        # Normalize
-        log_prob_norm = np.logaddexp(self.Rin, self.Rout)
-        self.Rin -= log_prob_norm
-        self.Rout -= log_prob_norm
-        
-        return np.mean(log_prob_norm)
-    
-    def _m_step(self, x):
-        """M-step: update component mean and variance"""
-        eps = np.finfo(float).eps
-        
-        # Compute weights
-        w1 = np.exp(self.Rin) + eps
-        w2 = np.exp(self.Rout) + eps
-        
-        # Update mixing proportions
-        self.Pin = np.mean(w1)
-        self.Pout = np.mean(w2)
-        
-        # Update means
-        self.Min = self._average(x, w1)
-        self.Mout = self._average(x, w2)
-        
-        # Update standard deviations
-        self.Sin = np.sqrt(self._average((x - self.Min)**2, w1) + self.reg)
-        self.Sout = np.sqrt(self._average((x - self.Mout)**2, w2) + self.reg)
-    
-    def _log_gaussian(self, x, mu, sigma):
-        """Compute log probability under Gaussian"""
-        resp = (x - mu) / sigma
-        resp = -(resp**2 + np.log(2 * np.pi)) / 2 - np.log(sigma)
-        return resp
-    
-    def _average(self, x, w):
-        """Weighted average"""
-        return np.dot(x, w) / np.sum(w)
-
-
-def organize_shells(bvals, threshold=50):
-    """
-    Organize gradient directions into shells
-    
-    Parameters:
-    -----------
-    bvals : ndarray
-        B-values
-    threshold : float
-        Threshold for grouping b-values into shells
-        
-    Returns:
-    --------
-    shells : list of lists
-        Each shell contains volume indices
-    """
-    unique_bvals = []
-    shells = []
-    
-    for i, bval in enumerate(bvals):
-        # Find matching shell
-        matched = False
-        for j, ubval in enumerate(unique_bvals):
-            if np.abs(bval - ubval) < threshold:
-                shells[j].append(i)
-                matched = True
-                break
-        
-        if not matched:
-            unique_bvals.append(bval)
-            shells.append([i])
-    
-    return shells
-
-
-def compute_rmse_slicewise(data, pred, mask, mb=1):
-    """
-    Compute root mean squared error for each slice
-    
-    Parameters:
-    -----------
-    data : ndarray (nx, ny, nz, nv)
-        DWI data
-    pred : ndarray (nx, ny, nz, nv)
-        Signal prediction
-    mask : ndarray (nx, ny, nz)
-        Brain mask
-    mb : int
-        Multiband factor
-        
-    Returns:
-    --------
-    E : ndarray (ne, nv)
-        RMSE matrix (ne = nz/mb excitations, nv = volumes)
+def gmm_weighting(fdmri, fspred, mask, bvals, outpath, filename_gmm, residuals=None, scores=None, slab_size=0):
     """
-    nx, ny, nz, nv = data.shape
-    ne = nz // mb  # Number of excitations
-    
-    # Initialize error and count matrices
-    E_full = np.zeros((nz, nv))
-    N_full = np.zeros((nz, nv), dtype=int)
-    
-    # For each volume and slice
-    for v in range(nv):
-        for z in range(nz):
-            # Compute error for this slice
-            data_slice = data[:, :, z, v]
-            pred_slice = pred[:, :, z, v]
-            mask_slice = mask[:, :, z]
-            
-            # Apply mask
-            valid = mask_slice > 0
-            
-            if np.any(valid):
-                diff = data_slice[valid] - pred_slice[valid]
-                E_full[z, v] = np.sum(diff**2)
-                N_full[z, v] = np.sum(valid)
-    
-    # Combine multiband slices
-    E_mb = np.zeros((ne, nv))
-    N_mb = np.zeros((ne, nv), dtype=int)
-    
-    for b in range(nz // ne):
-        E_mb += E_full[b*ne:(b+1)*ne, :]
-        N_mb += N_full[b*ne:(b+1)*ne, :]
-    
-    # Compute RMSE
-    E = np.zeros((ne, nv))
-    valid_mask = N_mb > 0
-    E[valid_mask] = np.sqrt(E_mb[valid_mask] / N_mb[valid_mask])
-    
-    return E
-
+    Calculate GMM weights using integrated Python implementation.
 
-def fedi_dmri_outliersgmm(data, pred, mask, bvals, mb=1):
-    """
-    Detect and reweigh outlier slices using Bayesian GMM modeling
-    
-    Parameters:
-    -----------
-    data : ndarray (nx, ny, nz, nv)
-        DWI data
-    pred : ndarray (nx, ny, nz, nv)
-        Signal prediction
-    mask : ndarray (nx, ny, nz)
-        Brain mask
-    bvals : ndarray (nv,)
-        B-values
-    mb : int
-        Multiband factor
-        
-    Returns:
-    --------
-    W : ndarray (nz, nv)
-        Slice weights
+    The slice RMSE is taken from residuals (a ResidualSummary of fdmri and
+    fspred) or scores (an OutlierScores that accumulated the residuals of
+    fdmri and fspred) if given, only the header of fdmri is then read.
+    Otherwise fdmri and fspred are read once, by slabs of slab_size slices.
     """
-    nx, ny, nz, nv = data.shape
-    ne = nz // mb
-    
-    # Organize into shells
-    shells = organize_shells(bvals)
-    
-    # Compute RMSE
-    E = compute_rmse_slicewise(data, pred, mask, mb)
-    
-    # Compute weights using GMM
-    W = np.ones_like(E)
-    gmm = GMModel()
-    
-    for s, shell in enumerate(shells):
-        # Collect residuals for this shell
-        res = []
-        for v in shell:
-            res.extend(E[:, v])
-        res = np.array(res)
-        
-        # Clip at non-zero minimum
-        nzmin = np.min(res[res > 0]) if np.any(res > 0) else 1e-10
-        logres = np.log(np.maximum(res, nzmin))
-        
-        # Fit GMM
-        gmm.fit(logres)
-        
-        # Get posterior probabilities
-        p = gmm.posterior()
-        
-        # Assign to weight matrix
-        k = 0
-        for v in shell:
-            W[:, v] = p[k*ne:(k+1)*ne]
-            k += 1
-    
-    # Replicate for multiband and round to 6 decimals
-    W_full = W.repeat(mb, axis=0)
-    W_full = np.round(W_full * 1e6) * 1e-6
-    
-    return W_full
+    print("Calculate GMM Weights")
 
+    img = nib.load(fdmri)
+    shape, affine, dtype = img.shape, img.affine, slab_dtype(img)
 
-def gmm_weighting(fdmri, fspred, mask, bvals, bvecs, outpath, filename_gmm):
-    """
-    Calculate GMM weights using integrated Python implementation.
-    """
-    print("Calculate GMM Weights")
-    
-    # Load data
-    dmri, affine = load_nifti(fdmri)
-    spred, _ = load_nifti(fspred)
-    mask_data, _ = load_nifti(mask)
-    
-    # Load bvals
-    if isinstance(bvals, str):
-        bvals_array = np.loadtxt(bvals)
+    if residuals is not None:
+        weights_raw = gmm_slice_weights(residuals.rmse(mb=1), bvals, mb=1)
     else:
-        bvals_array = bvals
-    
-    # Ensure mask is binary
-    mask_data = (mask_data > 0).astype(float)
-    
-    # Compute weights using integrated GMM function
-    weights_raw = fedi_dmri_outliersgmm(dmri, spred, mask_data, bvals_array, mb=1)
-    
+        if scores is None:
+            spred_img = nib.load(fspred)
+            mask_data, _ = load_nifti(mask)
+            scores = OutlierScores(shape, bvals, gmm=True)
+            for slab in iter_slabs(shape[2], slab_size):
+                scores.add_slab(slab.start, read_slab(img, slab), read_slab(spred_img, slab), gmm_mask=mask_data[:, :, slab])
+        weights_raw = scores.gmm_weights(mb=1)
+
     # Take square root (as in original implementation)
     weights_raw = np.sqrt(weights_raw)
-    
+
     # Save weights
     output_path = os.path.join(outpath, filename_gmm)
     np.savetxt(output_path, weights_raw, delimiter=',', fmt='%.6f')
@@ -814,16 +376,10 @@ def gmm_weighting(fdmri, fspred, mask, bvals, bvecs, outpath, filename_gmm):
     filename_gmm_png = filename_gmm.replace(".txt", ".png")
     save_figure_onebox(weights=weights_raw, clim_min=0, clim_max=1, title="Gaussian Mixture Model", outpath=outpath,fignamepng=filename_gmm_png)
 
-    # save weights as a 4D-volume
-    weights_4D=np.zeros_like(dmri)
-
-    # weights 2D --> 4D
-    for s in range(weights_raw.shape[0]):
-        for v in range(weights_raw.shape[1]):
-            weights_4D[:,:,s,v]=weights_raw[s,v]
-
+    # save weights as a 4D-volume, the weight of each slice and volume broadcast over its voxels
     filename_gmm_nii = filename_gmm.replace(".txt", ".nii.gz")
-    save_nifti(os.path.join(outpath, filename_gmm_nii), weights_4D, affine)
+    with nifti_memmap_writer(os.path.join(outpath, filename_gmm_nii), shape, affine, dtype) as weights_4D:
+        weights_4D[:] = weights_raw
 
     return weights_raw
 
@@ -852,24 +408,28 @@ def main():
     zscoremetric = args.zscoremetric
     weightscalingmethod = args.scalingmethod
 
-    # fsliceweights_mzscore = args.fsliceweights_mzscore
-    # fsliceweights_= args.fsliceweights_angle_neighbors
-    # fsliceweights_corre_neighbors = args.fsliceweights_corre_neighbors
-    # fsliceweights_gmmodel = args.fsliceweights_gmmodel
-    # fsliceweights_shore=args.fsliceweights_shore
+    bvals, bvecs = read_bvals_bvecs(fbval, fbvec)
+
+    # Only the headers are read here, the data is read once, slab by slab, below
+    dmri_img = nib.load(fdmri)
+    shape, affine = dmri_img.shape, dmri_img.affine
+    print("dmri.shape: ", shape)
 
-    dmri, affine = load_nifti(fdmri)
-    print("dmri.shape: ", dmri.shape)
+    residuals = None
+    if args.residuals is not None:
+        residuals = ResidualSummary.load(args.residuals)
+        if residuals.mask.shape != shape[:3] or len(residuals.bvals) != shape[3]:
+            parser.error("--residuals do not match the shape of --dmri")
+        print("residuals.mask.shape: ", residuals.mask.shape)
 
+    spred_img = None
     if fspred is not None and os.path.isfile(fspred):
-        spred, saffine = load_nifti(fspred)
-        print("spred.shape:", spred.shape)
+        spred_img = nib.load(fspred)
+        print("spred.shape:", spred_img.shape)
     else:
         fspred = None
         print("No spred given")
 
-    bvals, bvecs = read_bvals_bvecs(fbval, fbvec)
-
     print("bvals.shape: ", bvals.shape)
     print("bvecs.shape: ", bvecs.shape)
 
@@ -879,38 +439,84 @@ def main():
         fmask, affinemask = load_nifti(mask)
         print("fmask.shape: ", fmask.shape)
 
-    # add if mask provided, it should be multiplied by the dmri and spred file.
-
-    if args.fsliceweights_gmmodel is not None and fspred is not None:
-        gmm_weighting(fdmri=fdmrigmm, fspred=fspredgmm, mask=maskgmm, bvals=fbval, bvecs=fbvec, outpath=outpath, filename_gmm=args.fsliceweights_gmmodel)
-
-    if args.fsliceweights_mzscore is not None:
-        if fspred is not None:
-            dmri_mzscore = spred
+    run_gmm = args.fsliceweights_gmmodel is not None and fspred is not None
+    run_shore = args.fvoxelweights_shorebased is not None and fspred is not None
+    if args.shore_mask_only and fmask is None:
+        parser.error("--shore_mask_only requires --mask")
+    shore_mask = fmask if args.shore_mask_only else None
+    # The standardized residuals of the sidecar are only kept for the voxels of
+    # its mask, they are used if they cover all the weighted voxels
+    shore_residuals = None
+    if run_shore and residuals is not None:
+        weighted = np.ones(shape[:3], dtype=bool) if shore_mask is None else shore_mask > 0
+        if np.all(residuals.mask[weighted]):
+            shore_residuals = residuals
         else:
-            dmri_mzscore = dmri
+            print("The residuals do not cover the weighted voxels, the shore-based weights are computed from dmri and spred")
+
+    # The slice RMSE of the residuals is along the third axis of dmri, it
+    # only applies to dmrigmm if it was not reoriented
+    same_dmrigmm = os.path.abspath(fdmrigmm) == os.path.abspath(fdmri)
+    residuals_gmm = residuals if same_dmrigmm else None
+    if run_gmm and residuals_gmm is None and (fspredgmm is None or maskgmm is None):
+        parser.error("GMM weighting requires --spredgmm and --maskgmm")
+    # The GMM residuals of dmri and spred themselves are accumulated in the same pass
+    fused_gmm = (run_gmm and residuals_gmm is None and same_dmrigmm
+                 and os.path.abspath(fspredgmm) == os.path.abspath(fspred))
+
+    scores = OutlierScores(shape, bvals,
+                           mzscore=zscoremetric if args.fsliceweights_mzscore is not None else None,
+                           bvecs=normalize_bvecs(bvecs) if args.fsliceweights_angle_neighbors is not None else None,
+                           gmm=fused_gmm, shore=run_shore and shore_residuals is None)
+
+    # The slice weights score spred if given, dmri otherwise
+    slice_scores = scores.mzscore is not None or scores.neighbors
+    read_dmri = scores.needs_data or (slice_scores and spred_img is None)
+    read_spred = spred_img is not None and (scores.needs_data or slice_scores)
+
+    if read_dmri or read_spred:
+        print("Calculate the slice statistics by slabs of", args.slab_size if args.slab_size > 0 else shape[2], "slices")
+        maskgmm_data = load_nifti(maskgmm)[0] if fused_gmm else None
+        shore_writer = nullcontext()
+        if scores.shore:
+            # Same dtype as the residuals of dmri and spred
+            shore_writer = nifti_memmap_writer(os.path.join(outpath, args.fvoxelweights_shorebased), shape, affine,
+                                               np.result_type(slab_dtype(dmri_img), slab_dtype(spred_img)))
+        with shore_writer as weights_4D:
+            for slab in iter_slabs(shape[2], args.slab_size):
+                voxel_weights = scores.add_slab(slab.start,
+                                                read_slab(dmri_img, slab) if read_dmri else None,
+                                                read_slab(spred_img, slab) if read_spred else None,
+                                                None if fmask is None else fmask[:, :, slab],
+                                                None if maskgmm_data is None else maskgmm_data[:, :, slab],
+                                                None if shore_mask is None else shore_mask[:, :, slab])
+                if voxel_weights is not None:
+                    weights_4D[:, :, slab] = voxel_weights
+        if scores.shore:
+            print("--> weights_shore_based_4D.shape: ", shape)
+
+    if run_gmm:
+        gmm_weighting(fdmri=fdmrigmm, fspred=fspredgmm, mask=maskgmm, bvals=bvals, outpath=outpath, filename_gmm=args.fsliceweights_gmmodel,
+            residuals=residuals_gmm, scores=scores if fused_gmm else None, slab_size=args.slab_size)
 
-        mzscore_weighting(dmri=dmri_mzscore, fmask=fmask, bvals=bvals,
-            outpath=outpath,
-            metric=zscoremetric,
+    if args.fsliceweights_mzscore is not None:
+        print("Calculate Modified Z-Score Weights")
+        ModZscore, ModZscore_weights = scores.mzscore_weights(lowerThreshold, upperThreshold, weightscalingmethod)
+        mzscore_weighting(ModZscore, ModZscore_weights, outpath=outpath,
             lowerThreshold=lowerThreshold,
             upperThreshold=upperThreshold,
-            weightscalingmethod=weightscalingmethod,
             fsliceweights_mzscore=args.fsliceweights_mzscore)
 
     if args.fsliceweights_angle_neighbors is not None:
-        if fspred is not None:
-            dmri_neighbors = spred
-        else:
-            dmri_neighbors = dmri
-
-        neighbors_weighting(dmri=dmri_neighbors, bvals=bvals, bvecs=bvecs, b0_threshold=0,
-            std_scale=3, filename_angle_neighbors=args.fsliceweights_angle_neighbors, filename_correlation_neighbors=args.fsliceweights_corre_neighbors, outpath=outpath)
+        print("Calculate Neighbors Weights")
+        AngleMatrix, CorreMatrix = scores.neighbors_weights(std_scale=3)
+        neighbors_weighting(AngleMatrix, CorreMatrix, filename_angle_neighbors=args.fsliceweights_angle_neighbors,
+            filename_correlation_neighbors=args.fsliceweights_corre_neighbors, outpath=outpath)
 
-    if args.fvoxelweights_shorebased is not None and fspred is not None:
-        shorebased_weighting_voxelwise(dmri=dmri, affine=affine, spred=spred, outpath=outpath, filename=args.fvoxelweights_shorebased, bvals=bvals)
-        # shore_weighting(dmri=dmri, spred=spred, fsliceweights_shore=args.fsliceweights_shore)
+    if shore_residuals is not None:
+        shorebased_weighting_voxelwise(zscores=shore_residuals.zscores_volume(), affine=affine, outpath=outpath,
+            filename=args.fvoxelweights_shorebased, mask=shore_mask)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
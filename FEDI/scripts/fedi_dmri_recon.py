@@ -14,9 +14,16 @@ import nibabel as nib
 import argparse
 import warnings
 import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 
 from FEDI.utils.FEDI_shore import BrainSuiteShoreModel as ShoreModel
 from FEDI.utils.FEDI_shore import brainsuite_shore_basis as shore_matrix
+from FEDI.utils.FEDI_cache import set_cache_dir
+from FEDI.utils.FEDI_nifti import nifti_memmap_writer
+from FEDI.utils.FEDI_residuals import ResidualSummary
+from FEDI.utils.FEDI_shore_coeff import ShoreCoefficients, n_shore_coef, pack_slices
+from FEDI.utils.FEDI_weighting import gmm_reweighting, mzscore_slice_weights
 
 from dipy.core.gradients import gradient_table
 from dipy.io.gradients import read_bvals_bvecs
@@ -44,32 +51,492 @@ lambdaN = 1e-8
 lambdaL = 1e-8
 S0=1
 
+# In-plane downsampling factor of the --preview reconstruction
+PREVIEW_FACTOR = 2
+
+# Default tolerance of --reuse_tol on the weights and the relative change of the data
+REUSE_TOL = 1e-3
+
+# Default maximum number of fits and tolerance on the slice weights of --robust
+ROBUST_ITER = 10
+ROBUST_TOL = 1e-3
+
+
+def recon_slice(dmri_slice, mask_slice, weights_slice, fitting_method, gtab_in, gtab_out, radial_order, solver="closed_form",
+                lambda_selection="fixed", lambda_slice=None, positive=False, coef_slice=None):
+    """Fit SHORE to one slice and predict it on gtab_out.
+
+    weights_slice is the row of slice weights (slice fitting) or the (x, y, volumes)
+    voxel weights of the slice (voxel fitting). If given, lambda_slice is filled
+    with the lambdaN of each voxel, selected by GCV unless lambda_selection is "fixed",
+    and coef_slice with the SHORE coefficients of each voxel.
+    positive constrains the EAP of every voxel to be positive. Negative values
+    of dmri_slice are fitted as 0.
+    """
+    dmri_slice = np.maximum(dmri_slice, 0)
+    if fitting_method == "slice":
+
+        mask_slice[0,0]=1 # to avoid some issues with the SHORE/CVXPY optimization process
+        weights_slice = np.diag(np.sqrt(weights_slice))
+        # shore_model = ShoreModel(gtab_in,radial_order=radial_order, zeta=zeta, lambdaN=lambdaN, lambdaL=lambdaL, constrain_e0=True, positive_constraint=False, weights=weights_slice)
+        # shore_model = ShoreModel(gtab_in,radial_order=radial_order, zeta=zeta, lambdaN=lambdaN, lambdaL=lambdaL, regularization="L2")
+        shore_model = ShoreModel(gtab_in,radial_order=radial_order, zeta=zeta, lambdaN=lambdaN, lambdaL=lambdaL, regularization="FEDI", weights=weights_slice, fedi_solver=solver,
+                                 lambda_selection=lambda_selection, positive_constraint=positive)
+        shore_fit = shore_model.fit(dmri_slice,mask_slice)
+
+    elif fitting_method == "voxel":
+
+        # All masked voxels of the slice are solved together, each one with its own weight vector
+        if not np.any(mask_slice):
+            return np.zeros(dmri_slice.shape[:-1] + (len(gtab_out.bvals),))
+        shore_model = ShoreModel(gtab_in,radial_order=radial_order, zeta=zeta, lambdaN=lambdaN, lambdaL=lambdaL, regularization="FEDI", fedi_solver="closed_form",
+                                 positive_constraint=positive)
+        shore_fit = shore_model.fit(dmri_slice, mask_slice, weights=weights_slice)
+
+    if lambda_slice is not None:
+        lambda_slice[...] = shore_fit.lambdaN
+
+    # Generate fitted model coefficients and the SHORE basis for prediction
+    shore_coeffs = shore_fit.shore_coeff
+    if coef_slice is not None:
+        coef_slice[...] = shore_coeffs
+    shore_basis = shore_matrix(radial_order=radial_order, zeta=zeta, gtab=gtab_out, tau=tau)
+
+    # Calculate the signal prediction using the SHORE coefficients
+    return S0 * np.dot(shore_coeffs, shore_basis.T)
+
+
+# Arrays and parameters shared with the worker processes, set by _init_worker
+_worker_state = {}
+
+
+def _share_array(array):
+    """Copy array into a new shared memory block, return the block and its array view."""
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+    shared[...] = array
+    return shm, shared
+
+
+def _init_worker(specs, params):
+    for key, (name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=name)
+        _worker_state[key] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        # Keep a reference to the block, the view does not own it
+        _worker_state[key + "_shm"] = shm
+    _worker_state.update(params)
+
+
+def _recon_slice_worker(indxslice):
+    state = _worker_state
+    if state["fitting_method"] == "slice":
+        weights_slice = state["weights"][indxslice,:]
+    else:
+        weights_slice = state["weights"][:,:,indxslice,:]
+    lambda_slice = state["lambda"][:,:,indxslice] if "lambda" in state else None
+    coef_slice = state["coef"][:,:,indxslice] if "coef" in state else None
+    state["spred"][:,:,indxslice,:] = recon_slice(
+        state["dmri"][:,:,indxslice,:], state["mask"][:,:,indxslice], weights_slice,
+        state["fitting_method"], state["gtab_in"], state["gtab_out"], state["radial_order"], state["solver"],
+        state["lambda_selection"], lambda_slice, state["positive"], coef_slice)
+    stats = None
+    if state["residuals"] is not None:
+        stats = state["residuals"].slice_stats(state["dmri"][:,:,indxslice,:], state["spred"][:,:,indxslice,:], indxslice)
+    return indxslice, stats
+
+
+def recon_slices_parallel(dmri, mask, weightsraw, spred4D, nprocs, lambda_map=None, residuals=None, coef_map=None,
+                          slices=None, **params):
+    """Reconstruct all slices, or the given slices, on a pool of nprocs processes.
+
+    The input, mask, weights and output volumes are placed in shared memory, so
+    workers read and write slices in place instead of receiving pickled copies.
+    Slices are dispatched by decreasing number of masked voxels so that the
+    nearly empty edge slices fill the gaps at the end. The residual statistics
+    of each slice are computed by its worker and sent back to fill residuals.
+    """
+    blocks = {}
+    try:
+        arrays = [("dmri", dmri), ("mask", mask), ("weights", weightsraw), ("spred", spred4D)]
+        if lambda_map is not None:
+            arrays.append(("lambda", lambda_map))
+        if coef_map is not None:
+            arrays.append(("coef", coef_map))
+        for key, array in arrays:
+            blocks[key] = _share_array(array)
+        specs = {key: (shm.name, shared.shape, shared.dtype) for key, (shm, shared) in blocks.items()}
+
+        order = np.argsort(-np.count_nonzero(mask, axis=(0, 1)), kind="stable")
+        if slices is not None:
+            order = order[np.isin(order, slices)]
+        params = dict(params, residuals=residuals)
+        with ProcessPoolExecutor(max_workers=nprocs, initializer=_init_worker, initargs=(specs, params)) as executor:
+            for indxslice, stats in executor.map(_recon_slice_worker, order.tolist()):
+                print("-------------------------------------> Slice:", indxslice)
+                if residuals is not None:
+                    residuals.add_slice(indxslice, stats)
+
+        spred4D[...] = blocks["spred"][1]
+        if lambda_map is not None:
+            lambda_map[...] = blocks["lambda"][1]
+        if coef_map is not None:
+            coef_map[...] = blocks["coef"][1]
+    finally:
+        for shm, _ in blocks.values():
+            shm.close()
+            shm.unlink()
+    return spred4D
+
+
+def recon_slices(dmri, mask, weightsraw, spred4D, nprocs, lambda_map=None, residuals=None, coef_map=None, slices=None,
+                 **params):
+    """Reconstruct the slices of dmri into spred4D, serially or on nprocs processes.
+
+    The lambdaN and the SHORE coefficients of each voxel are written to
+    lambda_map and coef_map (nx, ny, nz, n_coefs) if given. If residuals
+    (a ResidualSummary) is given, the residual statistics of each slice are
+    added to it as soon as the slice is predicted. If slices is given, only
+    these slices are reconstructed, the others are left untouched.
+    """
+    if nprocs > 1:
+        return recon_slices_parallel(dmri, mask, weightsraw, spred4D, nprocs, lambda_map, residuals, coef_map, slices,
+                                     **params)
+    for indxslice in (range(0,dmri.shape[2]) if slices is None else slices):
+
+        print("-------------------------------------> Slice:", indxslice)
+
+        if params["fitting_method"] == "slice":
+            weights_slice = weightsraw[indxslice,:]
+        elif params["fitting_method"] == "voxel":
+            weights_slice = weightsraw[:,:,indxslice,:]
+
+        spred4D[:,:,indxslice,:] = recon_slice(dmri[:,:,indxslice,:], mask[:,:,indxslice], weights_slice,
+                                               params["fitting_method"], params["gtab_in"], params["gtab_out"],
+                                               params["radial_order"], params["solver"], params["lambda_selection"],
+                                               None if lambda_map is None else lambda_map[:,:,indxslice],
+                                               params["positive"], None if coef_map is None else coef_map[:,:,indxslice])
+        if residuals is not None:
+            residuals.add_slice(indxslice, residuals.slice_stats(dmri[:,:,indxslice,:], spred4D[:,:,indxslice,:], indxslice))
+    return spred4D
+
+
+def recon_slabs(fdmri, mask, weights, fitting_method, fspred, slab_size, nprocs, lambda_map=None, residuals=None,
+                coef_slabs=None, **params):
+    """Reconstruct the dMRI slab by slab without loading the whole volume.
+
+    Slabs of slab_size slices are read lazily from the input (and voxel weights)
+    NIfTI, fitted, and written to a memory-mapped output (see
+    nifti_memmap_writer). Peak memory is bounded by a few slabs. If coef_slabs is a list,
+    the SHORE coefficients of the masked voxels of each slab are appended to
+    it, packed by pack_slices.
+    """
+    img = nib.load(fdmri)
+    shape = img.shape
+    if fitting_method == "voxel":
+        weights_obj = nib.load(weights).dataobj
+
+    # Same dtype as load_nifti, the output keeps it
+    dtype = np.asanyarray(img.dataobj[:1, :1, :1, :1]).dtype
+    with nifti_memmap_writer(fspred, shape, img.affine, dtype) as spred4D:
+        for start in range(0, shape[2], slab_size):
+            slab = slice(start, min(start + slab_size, shape[2]))
+            print("----------------------------------> Slab:", slab.start, "-", slab.stop - 1)
+            dmri = np.asanyarray(img.dataobj[:, :, slab, :])
+            if fitting_method == "slice":
+                weights_slab = weights[slab]
+            else:
+                weights_slab = np.minimum(np.asanyarray(weights_obj[:, :, slab, :]) * 1.5, 1)
+            spred_slab = np.zeros_like(dmri)
+            residuals_slab = None
+            if residuals is not None:
+                residuals_slab = ResidualSummary(residuals.mask[:, :, slab], residuals.bvals, residuals.rmse_mask[:, :, slab])
+            coef_slab = None
+            if coef_slabs is not None:
+                coef_slab = np.zeros(dmri.shape[:3] + (n_shore_coef(params["radial_order"]),), dtype=np.float32)
+                mask_slab = mask[:, :, slab] > 0
+            recon_slices(dmri, mask[:, :, slab], weights_slab, spred_slab, nprocs,
+                         None if lambda_map is None else lambda_map[:, :, slab], residuals_slab, coef_slab,
+                         fitting_method=fitting_method, **params)
+            spred4D[:, :, slab, :] = spred_slab
+            if coef_slabs is not None:
+                coef_slabs.append(pack_slices(coef_slab, mask_slab))
+            if residuals is not None:
+                residuals.merge(residuals_slab, slab.start)
+
+
+def downsample_inplane(volume, factor, reduce=np.mean):
+    """Reduce blocks of factor x factor voxels of each slice, padding the edges by replication."""
+    nx, ny = volume.shape[:2]
+    pad = [(0, -nx % factor), (0, -ny % factor)] + [(0, 0)] * (volume.ndim - 2)
+    volume = np.pad(volume, pad, mode="edge")
+    blocks = volume.reshape((volume.shape[0] // factor, factor, volume.shape[1] // factor, factor) + volume.shape[2:])
+    return reduce(blocks, axis=(1, 3))
+
+
+def upsample_inplane(volume, factor, shape):
+    """Repeat each voxel of volume over factor x factor voxels, cropped to shape."""
+    volume = np.repeat(np.repeat(volume, factor, axis=0), factor, axis=1)
+    return volume[:shape[0], :shape[1]]
+
+
+def recon_preview(dmri, mask, weightsraw, spred4D, nprocs, factor, coef_map=None, **params):
+    """Reconstruct a downsampled copy of dmri and upsample the prediction into spred4D.
+
+    Blocks of factor x factor voxels of each slice are averaged (the mask is
+    their union), so the fit solves factor**2 fewer voxels. The prediction and
+    the coefficients (into coef_map) are repeated back over the blocks, every
+    output keeps the full resolution.
+    """
+    mask_small = downsample_inplane(mask > 0, factor, np.any).astype(np.uint8)
+    weights_small = weightsraw
+    if params["fitting_method"] == "voxel":
+        weights_small = downsample_inplane(weightsraw, factor)
+    dmri_small = downsample_inplane(dmri, factor)
+    spred_small = np.zeros_like(dmri_small)
+    coef_small = None
+    if coef_map is not None:
+        coef_small = np.zeros(dmri_small.shape[:3] + coef_map.shape[3:], dtype=coef_map.dtype)
+    recon_slices(dmri_small, mask_small, weights_small, spred_small, nprocs, None, None, coef_small, **params)
+    spred4D[...] = upsample_inplane(spred_small, factor, spred4D.shape)
+    if coef_map is not None:
+        coef_map[...] = upsample_inplane(coef_small, factor, coef_map.shape)
+    return spred4D
+
+
+def estimate_recon_time(dmri, mask, weightsraw, nprocs, **params):
+    """Estimate the time of recon_slices from the fit of the slice with the most masked voxels."""
+    counts = np.count_nonzero(mask, axis=(0, 1))
+    indxslice = int(np.argmax(counts))
+    if counts[indxslice] == 0:
+        return 0.
+    if params["fitting_method"] == "slice":
+        weights_slice = weightsraw[indxslice, :]
+    else:
+        weights_slice = weightsraw[:, :, indxslice, :]
+    start_time = time.time()
+    recon_slice(dmri[:, :, indxslice, :], mask[:, :, indxslice].copy(), weights_slice, params["fitting_method"],
+                params["gtab_in"], params["gtab_out"], params["radial_order"], params["solver"],
+                params["lambda_selection"], None, params["positive"])
+    slice_time = time.time() - start_time
+    # The cost of a slice grows with its masked voxels, the slices are spread over the processes
+    return slice_time * counts.sum() / counts[indxslice] / min(nprocs, np.count_nonzero(counts))
+
+
+def changed_slices(weights, previous_weights, mask, previous_mask, tol=REUSE_TOL, dmri=None, previous_dmri=None):
+    """Boolean (nz,) of the slices whose fit may differ from the previous reconstruction.
+
+    A slice changed if any of its weights (a row of slice weights, or the
+    voxel weights of the slice) moved by more than tol, if its mask changed,
+    or, when previous_dmri is given, if its data moved by more than tol times
+    the largest absolute value of its previous data.
+    """
+    nz = mask.shape[2]
+    if weights.shape != previous_weights.shape or mask.shape != previous_mask.shape:
+        return np.ones(nz, dtype=bool)
+    axes = (1,) if weights.ndim == 2 else (0, 1, 3)
+    changed = np.max(np.abs(weights - previous_weights), axis=axes, initial=0) > tol
+    changed |= np.any((mask > 0) != (previous_mask > 0), axis=(0, 1))
+    if previous_dmri is not None:
+        if dmri.shape != previous_dmri.shape:
+            return np.ones(nz, dtype=bool)
+        for indxslice in np.flatnonzero(~changed):
+            previous = previous_dmri[:, :, indxslice, :]
+            diff = np.max(np.abs(dmri[:, :, indxslice, :] - previous), initial=0)
+            changed[indxslice] = diff > tol * np.max(np.abs(previous), initial=0)
+    return changed
+
+
+def recon_robust(dmri, mask, weightsraw, spred4D, gtab_in, gtab_out, radial_order, rmse_mask=None, positive=False,
+                 max_iter=ROBUST_ITER, tol=ROBUST_TOL, coef_map=None):
+    """Robust slice-weighted reconstruction of dmri into spred4D, see BrainSuiteShoreModel.fit_irls.
+
+    weightsraw are the initial slice weights (scaled as the slice weights of
+    recon_slice). The RMSE of the slices is reweighted as by fedi_dmri_moco:
+    the GMM slice weights of fedi_dmri_outliers, scaled by 1.5 and clipped at
+    1. Returns the slice weights of the last fit, the number of fits and
+    whether the weights converged.
+    """
+    def reweight(E):
+        return np.minimum(gmm_reweighting(E, gtab_in.bvals) * 1.5, 1)
+
+    shore_model = ShoreModel(gtab_in, radial_order=radial_order, zeta=zeta, lambdaN=lambdaN, lambdaL=lambdaL, regularization="FEDI",
+                             fedi_solver="closed_form", positive_constraint=positive)
+    # Same fit mask as recon_slice, the first voxel of each slice is fitted, the RMSE is unchanged
+    rmse_mask = mask if rmse_mask is None else rmse_mask
+    fit_mask = np.array(mask, copy=True)
+    fit_mask[0, 0, :] = 1
+    shore_fit, weights, n_iter, converged = shore_model.fit_irls(np.maximum(dmri, 0), fit_mask, weightsraw, rmse_mask, reweight, max_iter, tol)
+    shore_coeffs = shore_fit.shore_coeff
+    shore_basis = shore_matrix(radial_order=radial_order, zeta=zeta, gtab=gtab_out, tau=tau)
+    for indxslice in range(dmri.shape[2]):
+        spred4D[:,:,indxslice,:] = S0 * np.dot(shore_coeffs[:,:,indxslice], shore_basis.T)
+    if coef_map is not None:
+        coef_map[...] = shore_coeffs
+    return weights, n_iter, converged
+
+
+def stack_echoes(volumes):
+    """Stack the volumes of the echoes along the first axis, so that their slices are fitted together."""
+    return np.concatenate(volumes, axis=0)
+
+
+def split_echoes(volume, n_echoes):
+    """Inverse of stack_echoes, the volume of each echo."""
+    return np.split(volume, n_echoes, axis=0)
+
+
+def residual_mask(mask, brain_mask=None):
+    """Fitted voxels whose standardized residuals are kept, those of brain_mask if given."""
+    if brain_mask is None:
+        return mask
+    return (mask > 0) & (brain_mask > 0)
+
+
+def add_residual_slices(residuals, dmri, spred4D, slices=None):
+    """Add the residual statistics of the slices (all by default) of dmri and spred4D to residuals."""
+    for indxslice in (range(dmri.shape[2]) if slices is None else slices):
+        residuals.add_slice(indxslice, residuals.slice_stats(dmri[:,:,indxslice,:], spred4D[:,:,indxslice,:], indxslice))
+    return residuals
+
+
+def fspred_sidecar_fname(fspred, suffix):
+    """File name of an output saved next to the predicted dMRI."""
+    for ext in (".nii.gz", ".nii"):
+        if fspred.endswith(ext):
+            return fspred[:-len(ext)] + suffix
+    return fspred + suffix
+
+
+def lambda_map_fname(fspred):
+    """File name of the GCV lambda map saved next to the predicted dMRI."""
+    return fspred_sidecar_fname(fspred, "_lambda.nii.gz")
+
+
+def same_fit_options(options, previous_options):
+    """Whether two dicts of fit options (see ShoreCoefficients) have the same names and values."""
+    return (set(options) == set(previous_options)
+            and all(np.array_equal(np.asarray(value), previous_options[name]) for name, value in options.items()))
+
+
+def load_previous_recon(args, mask, weightsraw, dmri, fitting_method, coef_params):
+    """Slices to refit (see changed_slices), predicted dMRI and coefficients of the previous reconstruction.
+
+    Returns (None, None, None), i.e. every slice is refitted, if a file of the
+    previous reconstruction is missing or does not match the shape of dmri,
+    if it used other SHORE parameters or fit options (coef_params, see
+    ShoreCoefficients), or if it did not save the lambda map needed by
+    --lambda_selection.
+    """
+    previous_files = [args.previous_fspred, args.previous_weights, args.previous_fcoeff, args.previous_dmri]
+    if args.lambda_selection != "fixed":
+        previous_files.append(lambda_map_fname(args.previous_fspred))
+    missing = [fname for fname in previous_files if not os.path.exists(fname)]
+    if missing:
+        print("The previous reconstruction is incomplete (missing %s), every slice is refitted" % ", ".join(missing))
+        return None, None, None
+    shapes = [nib.load(args.previous_fspred).shape, nib.load(args.previous_dmri).shape]
+    if args.lambda_selection != "fixed":
+        shapes.append(nib.load(lambda_map_fname(args.previous_fspred)).shape + dmri.shape[3:])
+    previous_coeffs = ShoreCoefficients.load(args.previous_fcoeff)
+    params = dict(coef_params)
+    fit_options = params.pop("fit_options")
+    same_params = (all(getattr(previous_coeffs, name) == value for name, value in params.items())
+                   and same_fit_options(fit_options, previous_coeffs.fit_options))
+    if any(shape != dmri.shape for shape in shapes) or not same_params:
+        print("The previous reconstruction does not match, every slice is refitted")
+        return None, None, None
+    previous_spred = load_nifti(args.previous_fspred)[0]
+    if fitting_method == "slice":
+        previous_weights = np.loadtxt(args.previous_weights, delimiter=',')
+    else:
+        previous_weights = load_nifti(args.previous_weights)[0]
+    previous_dmri = None
+    if not os.path.samefile(args.previous_dmri, args.dmri[0]):
+        previous_dmri = load_nifti(args.previous_dmri)[0]
+    refit = changed_slices(weightsraw, previous_weights, mask, previous_coeffs.mask, args.reuse_tol, dmri, previous_dmri)
+    return refit, previous_spred, previous_coeffs
+
+
 def main():
     # Create an argument parser, Add arguments for directory path and mask prefix, Parse the command-line arguments
     parser = argparse.ArgumentParser(description="Continuous and analytical diffusion signal modelling with 3D-SHORE.") 
-    parser.add_argument("-d", "--dmri", required=True, help="dmri")
+    parser.add_argument("-d", "--dmri", required=True, nargs="+", help="dmri. Several echo series of the same acquisition (same shape, gradient table, mask and weights) are reconstructed jointly, sharing the factorization of each slice")
     parser.add_argument("-a", "--bval", required=True, help="bval")
     parser.add_argument("-e", "--bvec_in", required=True, help="bvec of the input data")
     parser.add_argument("-u", "--bvec_out", required=True, help="bvec for the output data")
     parser.add_argument("-m", "--mask", required=False, help="Path to mask file, required to reduce computation time")
     parser.add_argument("-do_not_use_mask", action="store_true", help="Flag to indicate not to use the mask, even if provided")
     parser.add_argument("-w", "--weights", required=False, help="weights txt file")
-    parser.add_argument("-s", "--fspred", required=True, help="predicted dmri file name")
+    parser.add_argument("-s", "--fspred", required=True, nargs="+", help="predicted dmri file name, one per echo given by --dmri")
+    parser.add_argument("--solver", required=False, default="closed_form", choices=["closed_form", "cvxpy"], help="Solver for the slice-weighted SHORE fit: closed_form (default, one factorization per slice weights) or cvxpy (one problem per voxel). Voxel weights (.nii.gz) always use the batched closed form")
+    parser.add_argument("-n", "--nprocs", "--nthreads", type=int, default=1, help="Number of worker processes reconstructing slices in parallel (default: 1)")
+    parser.add_argument("--cache_dir", required=False, help="Directory where SHORE design matrices are cached and reused across runs (default: $FEDI_CACHE_DIR, in memory only if unset)")
+    parser.add_argument("--lambda_selection", default="fixed", choices=["fixed", "gcv_voxel", "gcv_slice"], help="Select lambdaN (and lambdaL, keeping their ratio) by generalized cross-validation per voxel or per slice instead of the fixed 1e-8, and save the lambda map as <fspred>_lambda.nii.gz (default: fixed). Requires slice weights (.txt)")
+    parser.add_argument("--positive", action="store_true", help="Constrain the EAP of every voxel to be positive, on an 11^3 grid of radius 20 um (closed-form solver only)")
+    parser.add_argument("--preview", action="store_true", help="Fast low-fidelity reconstruction for QC: lower radial order, unconstrained closed-form fit with fixed lambdas, on slices downsampled by %d in-plane. The outputs keep the full resolution and file layout, with --lambda_selection the lambda map holds the fixed lambdaN. Reports the speedup over the full configuration" % PREVIEW_FACTOR)
+    parser.add_argument("--slab_size", type=int, default=0, help="Stream the reconstruction by slabs of this many slices, read lazily and written to a memory-mapped output, to bound memory (default: 0, load the whole volume)")
+    parser.add_argument("--fcoeff", required=False, nargs="+", help="Save the SHORE coefficients of the fitted voxels (float32, packed by the mask), the model parameters and the fit options to this .npz file, for fedi_dmri_shore. One file per echo")
+    parser.add_argument("--residuals", required=False, nargs="+", help="Save the residual statistics of the fit (RMSE per slice and volume within --mask, per-shell MAD and standardized residuals of the fitted voxels within --mask) to this compressed .npz sidecar, for fedi_dmri_outliers --residuals. One file per echo")
+    parser.add_argument("--robust", action="store_true", help="Robust fit: iteratively reweight the slices in memory from the GMM of the slice RMSE, as the outlier/reconstruction epochs of fedi_dmri_moco do, until the slice weights converge. Starts from the slice weights given by -w (.txt), or from the modified z-score weights of the data. The final weights are saved as <fspred>_weights.txt")
+    parser.add_argument("--robust_iter", type=int, default=ROBUST_ITER, help="Maximum number of fits of --robust (default: %d)" % ROBUST_ITER)
+    parser.add_argument("--robust_tol", type=float, default=ROBUST_TOL, help="Largest change of a slice weight at the convergence of --robust (default: %g)" % ROBUST_TOL)
+    parser.add_argument("--previous_fspred", required=False, help="Predicted dMRI of a previous reconstruction with the same gradient tables and options, e.g. the previous moco epoch. Only the slices whose weights, mask or data changed beyond --reuse_tol are refitted, the others are copied from it. Requires --previous_weights, --previous_fcoeff and --previous_dmri")
+    parser.add_argument("--previous_weights", required=False, help="Weights file of the previous reconstruction")
+    parser.add_argument("--previous_fcoeff", required=False, help="SHORE coefficients (--fcoeff) of the previous reconstruction")
+    parser.add_argument("--previous_dmri", required=False, help="Input dMRI of the previous reconstruction, compared slice by slice unless it is the file given by --dmri")
+    parser.add_argument("--reuse_tol", type=float, default=REUSE_TOL, help="Largest change of a weight, and of the data relative to the largest value of the slice, for which a slice is copied from the previous reconstruction (default: %g)" % REUSE_TOL)
     # parser.add_argument("-r", "--order", required=True, help="Shore order, 2: 8 coefs; 4:29 coefs; 6: 72 coefs; 8:145 coefs.")
 
     args = parser.parse_args()
 
     # variable
-    fdmri= args.dmri
+    fdmris = args.dmri
+    n_echoes = len(fdmris)
+    fdmri= fdmris[0]
     fbval=args.bval
     fbvec_in=args.bvec_in
 
     fbvec_out=args.bvec_out
 
-    fspred=args.fspred
+    fspreds = args.fspred
+    fspred=fspreds[0]
     fname_weights=args.weights
 
-    dmri, affine = load_nifti(fdmri)
+    for option in ("fspred", "fcoeff", "residuals"):
+        if getattr(args, option) and len(getattr(args, option)) != n_echoes:
+            parser.error("--%s requires one file per echo given by --dmri" % option)
+    fcoeffs, fresiduals = args.fcoeff, args.residuals
+    args.fcoeff = fcoeffs[0] if fcoeffs else None
+    args.residuals = fresiduals[0] if fresiduals else None
+    if n_echoes > 1 and (args.slab_size > 0 or args.preview or args.previous_fspred):
+        parser.error("several echoes do not support --slab_size, --preview or --previous_fspred")
+
+    if args.cache_dir:
+        set_cache_dir(args.cache_dir)
+    if args.positive and (args.solver != "closed_form" or args.lambda_selection != "fixed"):
+        parser.error("--positive requires --solver closed_form and --lambda_selection fixed")
+    if args.preview and args.slab_size > 0:
+        parser.error("--preview loads the whole volume, it does not support --slab_size")
+    previous = [args.previous_fspred, args.previous_weights, args.previous_fcoeff, args.previous_dmri]
+    if any(previous) and not all(previous):
+        parser.error("--previous_fspred, --previous_weights, --previous_fcoeff and --previous_dmri go together")
+    if args.previous_fspred and (args.preview or args.slab_size > 0):
+        parser.error("--previous_fspred does not support --preview or --slab_size")
+    if args.robust and (args.solver != "closed_form" or args.lambda_selection != "fixed" or args.preview
+                        or args.slab_size > 0 or args.previous_fspred):
+        parser.error("--robust requires --solver closed_form and --lambda_selection fixed, without --preview, --slab_size or --previous_fspred")
+    if args.robust and args.robust_iter < 1:
+        parser.error("--robust_iter must be at least 1")
+    if args.robust and fname_weights and not fname_weights.endswith('.txt'):
+        parser.error("--robust reweights slices, it requires slice weights (.txt)")
+    if not (args.robust or fname_weights):
+        parser.error("-w/--weights is required without --robust")
+
+    if args.slab_size > 0:
+        # Only the header is read here, slabs are loaded by recon_slabs
+        dmri = nib.load(fdmri)
+    else:
+        dmri, affine = load_nifti(fdmri)
 
 
     # Logic for handling the mask based on the -do_not_use_mask flag and presence of a mask path
@@ -81,11 +548,21 @@ def main():
         mask, affinemask = load_nifti(args.mask)
     else:
         print("Check mask status...")
+    brain_mask = load_nifti(args.mask)[0] if args.mask else None
+    if n_echoes > 1:
+        shapes = [nib.load(f).shape for f in fdmris]
+        if len(set(shapes)) > 1:
+            parser.error("the echoes given by --dmri do not have the same shape: %s" % shapes)
+        print("Reconstructing", n_echoes, "echoes jointly")
+        dmri = stack_echoes([dmri] + [load_nifti(f)[0] for f in fdmris[1:]])
+        mask = stack_echoes([mask] * n_echoes)
+        if brain_mask is not None:
+            brain_mask = stack_echoes([brain_mask] * n_echoes)
     # Not sure, add small value for slices that contains only zeros (this make issues/warnings for fitting)
     dmri=dmri
 
-    # Set negative values to 0
-    dmri[dmri < 0] = 0
+    # Negative values are set to 0 slice by slice by recon_slice, the
+    # residuals are computed against the data as given
 
 
     # bvalsraw, bvecsraw = read_bvals_bvecs(fbval, fbvec)
@@ -99,12 +576,21 @@ def main():
     gtab_out = gradient_table(bvals, bvecs=bvecs_out, b0_threshold=0)
 
     # Load weights txt/niftii file
-    if fname_weights.endswith('.txt'):
+    if fname_weights is None:
+        # Initial weights of --robust, as the first epoch of fedi_dmri_moco
+        weightsraw = mzscore_slice_weights(dmri, brain_mask, bvals)[1]
+        fitting_method = "slice"
+    elif fname_weights.endswith('.txt'):
         weightsraw = np.loadtxt(fname_weights, delimiter=',')
         fitting_method = "slice"
     elif fname_weights.endswith('.nii.gz'):
-        weightsraw, affine = load_nifti(fname_weights)
         fitting_method = "voxel"
+        if args.lambda_selection != "fixed":
+            parser.error("--lambda_selection requires slice weights (.txt), voxel weights do not share one decomposition")
+        if args.slab_size <= 0:
+            weightsraw, affine = load_nifti(fname_weights)
+            if n_echoes > 1:
+                weightsraw = stack_echoes([weightsraw] * n_echoes)
 
 
 
@@ -121,6 +607,64 @@ def main():
     elif dmri.shape[3] > 12:
         radial_order = 2
 
+    if args.preview:
+        # Keep the requested configuration to estimate its time
+        full_params = dict(radial_order=radial_order, solver=args.solver, lambda_selection=args.lambda_selection, positive=args.positive)
+        radial_order = max(2, radial_order - 2)
+        args.solver, args.lambda_selection, args.positive = "closed_form", "fixed", False
+        print("Preview: radial_order", radial_order, ", unconstrained closed-form fit, in-plane downsampling by", PREVIEW_FACTOR)
+
+    lambda_map = None
+    if args.lambda_selection != "fixed":
+        lambda_map = np.zeros(dmri.shape[:3])
+
+    residuals = None
+    if args.residuals and n_echoes == 1:
+        # The slice RMSE and the standardized residuals are kept within the brain mask, even if the fit is not masked
+        residuals = ResidualSummary(residual_mask(mask, brain_mask), bvals, brain_mask)
+
+    # The mask is copied, the slice fit marks its first voxel as fitted
+    fit_mask = mask > 0
+    if n_echoes > 1 and fitting_method == "slice":
+        # The first voxel of every slice of each echo, as when the echoes are reconstructed separately
+        mask[::dmri.shape[0] // n_echoes, 0, :] = 1
+    coef_mask = None
+    if args.fcoeff:
+        coef_mask = fit_mask
+    # Saved with the coefficients, a later --previous_fcoeff reconstruction reuses them only if they match
+    fit_options = dict(bvals=bvals, bvec_in=bvecs_in, bvec_out=bvecs_out, solver=args.solver,
+                       positive=args.positive, lambda_selection=args.lambda_selection)
+    coef_params = dict(radial_order=radial_order, zeta=zeta, tau=tau, lambdaN=lambdaN, lambdaL=lambdaL, S0=S0,
+                       fit_options=fit_options)
+
+    if args.slab_size > 0:
+        print("-----------------------------------------------------------")
+        print("dmri.shape:", dmri.shape, " Streaming slabs of", args.slab_size, "slices")
+        print("-----------------------------------------------------------")
+        start_time = time.time()
+        if fitting_method == "slice":
+            weights = np.minimum(weightsraw * 1.5, 1)
+        else:
+            # Voxel weights are read and scaled slab by slab
+            weights = fname_weights
+        coef_slabs = None if coef_mask is None else []
+        recon_slabs(fdmri, mask, weights, fitting_method, fspred, args.slab_size, args.nprocs, lambda_map, residuals, coef_slabs,
+                    gtab_in=gtab_in, gtab_out=gtab_out, radial_order=radial_order, solver=args.solver,
+                    lambda_selection=args.lambda_selection, positive=args.positive)
+        print(f"The ShoreRecon block took {time.time() - start_time} seconds to execute.")
+        if lambda_map is not None:
+            save_nifti(lambda_map_fname(fspred), lambda_map, dmri.affine)
+        if residuals is not None:
+            residuals.save(args.residuals)
+        if coef_slabs is not None:
+            ShoreCoefficients(np.concatenate(coef_slabs), coef_mask, dmri.affine, **coef_params).save(args.fcoeff)
+        return
+
+    # Slices unchanged since the previous reconstruction are copied from it
+    refit = None
+    if args.previous_fspred:
+        refit, previous_spred, previous_coeffs = load_previous_recon(args, mask, weightsraw, dmri, fitting_method, coef_params)
+
     weightsraw = weightsraw * 1.5
 
     weightsraw [weightsraw > 1]=1
@@ -129,7 +673,15 @@ def main():
     # dmri=dmri[50:55,50:53,10:27,:]
     # mask=mask[50:55,50:53,10:27]
     spred4D=np.zeros_like(dmri)
-    dmri_slice=np.zeros_like(dmri)
+    slices = None
+    if refit is not None:
+        slices = np.flatnonzero(refit)
+        spred4D[:,:,~refit,:] = previous_spred[:,:,~refit,:]
+        del previous_spred
+        if lambda_map is not None:
+            lambda_map[:,:,~refit] = load_nifti(lambda_map_fname(args.previous_fspred))[0][:,:,~refit]
+        print("Refitting", len(slices), "of", dmri.shape[2], "slices,", dmri.shape[2] - len(slices),
+              "slices unchanged since the previous reconstruction are copied")
     print("-----------------------------------------------------------")
     print("dmri.shape:", dmri.shape)
     print("-----------------------------------------------------------")
@@ -140,82 +692,68 @@ def main():
     # constrain_e0=True should be always True to do weighted L2 Loss function
 
     print("dmri.shape[2]",dmri.shape[2])
-    for indxslice in range(0,dmri.shape[2]):
-
-
-
-        # print("--------------------------------------------------")
-        print("-------------------------------------> Slice:", indxslice)
-        # print("--------------------------------------------------")
-
-        if fitting_method == "slice":
-            
-            dmri_slice = dmri[:,:,indxslice,:]
-            mask_slice = mask[:,:,indxslice]
-            mask_slice[0,0]=1 # to avoid some issues with the SHORE/CVXPY optimization process
-            weights_slice = np.diag(np.sqrt(weightsraw[indxslice,:]))
-            # print("------------------------------------")
-            # print("dmri_slice.shape:", dmri_slice.shape)
-            # print("mask_slice.shape:", mask_slice.shape)
-            # print("------------------------------------")
-            # print("1. Instantiate the SHORE Model")
-            # shore_model = ShoreModel(gtab_in,radial_order=radial_order, zeta=zeta, lambdaN=lambdaN, lambdaL=lambdaL, constrain_e0=True, positive_constraint=False, weights=weights_slice)
-            # shore_model = ShoreModel(gtab_in,radial_order=radial_order, zeta=zeta, lambdaN=lambdaN, lambdaL=lambdaL, regularization="L2")
-            shore_model = ShoreModel(gtab_in,radial_order=radial_order, zeta=zeta, lambdaN=lambdaN, lambdaL=lambdaL, regularization="FEDI", weights=weights_slice)
-
-            # print("2. Fit the SHORE model to the data")
-            shore_fit = shore_model.fit(dmri_slice,mask_slice)
-
-            # print("3. Generate fitted model coefficients:")
-            shore_coeffs = shore_fit.shore_coeff
-            print("shore_coeffs.shape: ", shore_coeffs.shape)
-         
-            # print("4. Generate SHORE basis for prediction:")
-            shore_basis = shore_matrix(radial_order=radial_order, zeta=zeta, gtab=gtab_out, tau=tau)
-            # print("shore_basis", shore_basis.shape)
-
-            # print("5. Calculate the signal prediction using the SHORE coefficients:")
-            # B03D[:,:,indxslice] = S0 * shore_coeffs[:,:,0]
-            spred4D[:,:,indxslice,:] = S0 * np.dot(shore_coeffs, shore_basis.T)
-            # print("signal_prediction.shape :",spred4D.shape)
-
-        elif fitting_method == "voxel":
-
-            for i in range(dmri.shape[0]):
-                for j in range(dmri.shape[1]):
-                    print("-------------------------------------> Slice:", indxslice)
-                    dmri_slice = dmri[i,j,indxslice,:]
-                    mask_slice = mask[i,j,indxslice]
-                    weights_voxel = np.diag(weightsraw[i,j,indxslice,:])
-                    print("Instantiate the SHORE Model:")
-                    # For cvxpy_solver: one of OSQP (default), ECOS, ECOS_BB,  SCIPY, SCS was expected.
-                    # shore_model = ShoreModel(gtab_in,radial_order=radial_order, zeta=zeta, lambdaN=lambdaN, lambdaL=lambdaL, constrain_e0=True, positive_constraint=False, weights=weights_voxel,cvxpy_solver='OSQP')
-                    shore_model = ShoreModel(gtab_in,radial_order=radial_order, zeta=zeta, lambdaN=lambdaN, lambdaL=lambdaL, regularization="FEDI", weights=weights_voxel)
-                    # shore_model = ShoreModel(gtab_in,radial_order=radial_order, zeta=zeta, lambdaN=lambdaN, lambdaL=lambdaL, regularization="L2")
-
-                    print("Fit the SHORE model to the data")
-                    shore_fit = shore_model.fit(dmri_slice,mask_slice)
-
-                    print("Generate the coffes of the fitted model:")
-                    shore_coeffs = shore_fit.shore_coeff
-                    print("shore_coeffs.shape: ", shore_coeffs.shape)
-                 
-                    print("Generate the SHORE basis for prediction:")
-                    shore_basis = shore_matrix(radial_order=radial_order, zeta=zeta, gtab=gtab_out, tau=tau)
-                    print("shore_basis", shore_basis.shape)
-
-                    print("Calculate the signal prediction using the SHORE coefficients")
-                    # B03D[:,:,indxslice] = S0 * shore_coeffs[:,:,0]
-                    spred4D[i,j,indxslice,:] = S0 * np.dot(shore_coeffs, shore_basis.T)
-                    # print("signal_prediction.shape :",spred4D.shape)
+    coef_map = None
+    if coef_mask is not None:
+        coef_map = np.zeros(dmri.shape[:3] + (n_shore_coef(radial_order),), dtype=np.float32)
+        if refit is not None:
+            coef_map[:,:,~refit] = previous_coeffs.volume()[:,:,~refit]
+    params = dict(fitting_method=fitting_method, gtab_in=gtab_in, gtab_out=gtab_out)
+    if args.preview:
+        recon_preview(dmri, mask, weightsraw, spred4D, args.nprocs, PREVIEW_FACTOR, coef_map,
+                      radial_order=radial_order, solver=args.solver, lambda_selection=args.lambda_selection,
+                      positive=args.positive, **params)
+        if full_params["lambda_selection"] != "fixed":
+            # Same lambda map as a fit with fixed lambdas, the lambdaN of the fitted voxels
+            lambda_map = np.where(fit_mask, lambdaN, 0.)
+        if residuals is not None:
+            # The residuals are those of the full resolution data
+            add_residual_slices(residuals, dmri, spred4D)
+    elif args.robust:
+        robust_weights, n_iter, converged = recon_robust(dmri, mask, weightsraw, spred4D, gtab_in, gtab_out, radial_order,
+                                                         brain_mask, args.positive, args.robust_iter, args.robust_tol, coef_map)
+        print("Robust fit:", n_iter, "fits, the slice weights", "converged" if converged else "reached --robust_iter")
+        np.savetxt(fspred_sidecar_fname(fspred, "_weights.txt"), robust_weights, delimiter=',', fmt='%.6f')
+        if residuals is not None:
+            add_residual_slices(residuals, dmri, spred4D)
+    else:
+        recon_slices(dmri, mask, weightsraw, spred4D, args.nprocs, lambda_map, residuals, coef_map, slices,
+                     radial_order=radial_order, solver=args.solver, lambda_selection=args.lambda_selection,
+                     positive=args.positive, **params)
+        if residuals is not None and refit is not None:
+            add_residual_slices(residuals, dmri, spred4D, np.flatnonzero(~refit))
 
     end_time = time.time()
     duration = end_time - start_time
     print(f"The ShoreRecon block took {duration} seconds to execute.")
+    if args.preview:
+        full_duration = estimate_recon_time(dmri, mask, weightsraw, args.nprocs, **full_params, **params)
+        print(f"Estimated time of the full reconstruction: {full_duration} seconds, the preview ran {full_duration / max(duration, 1e-6):.1f} times faster.")
 
     # Save the predicted diffusion signal
-    save_nifti(fspred, spred4D, affine)
+    if n_echoes > 1:
+        # The outputs of each echo, the residuals are computed per echo
+        lambda_maps = [None] * n_echoes if lambda_map is None else split_echoes(lambda_map, n_echoes)
+        coef_maps = [None] * n_echoes if coef_map is None else split_echoes(coef_map, n_echoes)
+        for echo, (dmri_echo, spred_echo) in enumerate(zip(split_echoes(dmri, n_echoes), split_echoes(spred4D, n_echoes))):
+            save_nifti(fspreds[echo], spred_echo, affine)
+            if lambda_maps[echo] is not None:
+                save_nifti(lambda_map_fname(fspreds[echo]), lambda_maps[echo], affine)
+            echo_mask = split_echoes(fit_mask, n_echoes)[echo]
+            if fresiduals:
+                rmse_mask = None if brain_mask is None else split_echoes(brain_mask, n_echoes)[echo]
+                add_residual_slices(ResidualSummary(residual_mask(echo_mask, rmse_mask), bvals, rmse_mask),
+                                    dmri_echo, spred_echo).save(fresiduals[echo])
+            if coef_maps[echo] is not None:
+                ShoreCoefficients.from_volume(coef_maps[echo], echo_mask, affine, **coef_params).save(fcoeffs[echo])
+        return
 
+    save_nifti(fspred, spred4D, affine)
+    if lambda_map is not None:
+        save_nifti(lambda_map_fname(fspred), lambda_map, affine)
+    if residuals is not None:
+        residuals.save(args.residuals)
+    if coef_map is not None:
+        ShoreCoefficients.from_volume(coef_map, coef_mask, affine, **coef_params).save(args.fcoeff)
 
 if __name__ == "__main__":
     main()
@@ -11,6 +11,8 @@
 import argparse
 import os
 import subprocess
+import numpy as np
+from scipy.io import savemat
 
 # Utility function to execute a shell command
 def run_command(command):
@@ -20,6 +22,11 @@ def run_command(command):
         print(f"Command failed: {e.cmd}")
         raise
 
+# Identity rigid transform in the ANTs (ITK MATLAB v4) format, for the volumes that are not registered
+def write_identity_transform(path):
+    parameters = np.array([1, 0, 0, 0, 1, 0, 0, 0, 1, 0, 0, 0], dtype=np.float64)[:, None]
+    savemat(path, {"AffineTransform_double_3_3": parameters, "fixed": np.zeros((3, 1))}, format="4")
+
 # Main execution
 def main():
     # Argument parser setup
@@ -41,6 +48,8 @@ def main():
     parser.add_argument("--target_dmri", required=True, help="Path to the 4D target diffusion MRI file.")
     parser.add_argument("--output_dir", required=True, help="Directory for intermediate and output files.")
     parser.add_argument("--output_dmri", required=True, help="Filename for the registered diffusion MRI output.")
+    parser.add_argument("--volumes", required=False, help="Comma-separated indices of the volumes to register, the others are kept as they are with an identity transform (default: all volumes).")
+    parser.add_argument("--apply_to", nargs=2, action="append", default=[], metavar=("INPUT", "OUTPUT"), help="Another 4D series of the same acquisition (e.g. the second echo) moved with the transforms of input_dmri, and its output. Can be repeated.")
 
 
     args = parser.parse_args()
@@ -61,6 +70,11 @@ def main():
     n_volumes = int(result.stdout.split()[3])
     print(f"Number of volumes: {n_volumes}")
 
+    registered = set(range(n_volumes))
+    if args.volumes:
+        registered = {int(v) for v in args.volumes.split(",")}
+        print(f"Registering {len(registered)} of {n_volumes} volumes")
+
     # Split 4D volume into 3D volumes
     warped_volumes = []
     for v_idx in range(n_volumes):
@@ -68,10 +82,16 @@ def main():
         spred_volume_path = os.path.join(args.output_dir, f"target_dmri_v{v_idx}.nii.gz")
 
         run_command(["mrconvert", "-coord", "3", str(v_idx), args.input_dmri, raw_volume_path, "-force", "-quiet"])
+
+        transform_prefix = os.path.join(args.output_dir, f"Transform_v{v_idx}_")
+        if v_idx not in registered:
+            write_identity_transform(transform_prefix + "0GenericAffine.mat")
+            warped_volumes.append(raw_volume_path)
+            continue
+
         run_command(["mrconvert", "-coord", "3", str(v_idx), args.target_dmri, spred_volume_path, "-force", "-quiet"])
 
         # Perform antsRegistration
-        transform_prefix = os.path.join(args.output_dir, f"Transform_v{v_idx}_")
         warped_volume_path = os.path.join(args.output_dir, f"input_dmri_v{v_idx}_warped.nii.gz")
 
         ants_command = [
@@ -109,5 +129,23 @@ def main():
     run_command(["mrcat", "-axis", "3"] + warped_volumes + [args.output_dmri, "-quiet"])
     print(f"Registration completed successfully. Registered dMRI saved to {args.output_dmri}.")
 
+    # The other series move with input_dmri, each volume with the transform of its volume
+    for series_idx, (apply_input, apply_output) in enumerate(args.apply_to):
+        moved_volumes = []
+        for v_idx in range(n_volumes):
+            volume_path = os.path.join(args.output_dir, f"apply{series_idx}_v{v_idx}.nii.gz")
+            run_command(["mrconvert", "-coord", "3", str(v_idx), apply_input, volume_path, "-force", "-quiet"])
+            if v_idx not in registered:
+                moved_volumes.append(volume_path)
+                continue
+            moved_path = os.path.join(args.output_dir, f"apply{series_idx}_v{v_idx}_warped.nii.gz")
+            run_command(["antsApplyTransforms", "--dimensionality", "3", "--input", volume_path,
+                         "--reference-image", os.path.join(args.output_dir, f"input_dmri_v{v_idx}.nii.gz"),
+                         "--output", moved_path, "--interpolation", "BSpline",
+                         "--transform", os.path.join(args.output_dir, f"Transform_v{v_idx}_0GenericAffine.mat")])
+            moved_volumes.append(moved_path)
+        run_command(["mrcat", "-axis", "3"] + moved_volumes + [apply_output, "-quiet"])
+        print(f"{apply_input} moved with the same transforms, saved to {apply_output}.")
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3.10
+
+##########################################################################
+##                                                                      ##
+##  Part of Fetal and Neonatal Development Imaging Toolbox (FEDI)       ##
+##                                                                      ##
+##  Author:    Haykel Snoussi, PhD (dr.haykel.snoussi@gmail.com)        ##
+##                                                                      ##
+##########################################################################
+
+import argparse
+import time
+import numpy as np
+
+from dipy.core.gradients import gradient_table
+from dipy.io.gradients import read_bvals_bvecs
+from dipy.io.image import save_nifti
+
+from FEDI.utils.common import FEDI_ArgumentParser, Metavar
+from FEDI.utils.FEDI_shore_coeff import ShoreCoefficients, read_dvs
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description=(
+            "\033[1mDESCRIPTION:\033[0m \n\n    "
+            "Predict the diffusion signal on new gradient tables, or derive SHORE maps (RTOP, MSD, ODF), "
+            "from the SHORE coefficients saved by fedi_dmri_recon --fcoeff, without fitting again. "
+            "Predictions are streamed to disk by blocks of slices, so that they are never held in memory as a whole.\n"
+        ),
+        epilog=(
+            "\033[1mREFERENCES:\033[0m\n  "
+            "Snoussi, Haykel, Davood Karimi, Onur Afacan, Mustafa Utkur, and Ali Gholipour. "
+            "HAITCH: A framework for distortion and motion correction in fetal multi-shell "
+            "diffusion-weighted MRI. Imaging Neuroscience 2025."
+        ),
+        formatter_class=FEDI_ArgumentParser
+    )
+
+    mandatory = parser.add_argument_group('\033[1mMANDATORY OPTIONS\033[0m')
+    mandatory.add_argument("-c", "--fcoeff", required=True, metavar=Metavar.file, help="SHORE coefficients (.npz) saved by fedi_dmri_recon --fcoeff")
+
+    optional = parser.add_argument_group('\033[1mOPTIONAL OPTIONS\033[0m')
+    optional.add_argument("-s", "--fspred", metavar=Metavar.file, help="Output predicted dMRI (.nii.gz) on the gradient table given by --bval and --bvec")
+    optional.add_argument("-a", "--bval", metavar=Metavar.file, help="bval file of the predicted dMRI")
+    optional.add_argument("-e", "--bvec", metavar=Metavar.file, help="bvec file of the predicted dMRI")
+    optional.add_argument("--target", nargs=3, action="append", default=[], metavar=(Metavar.file, Metavar.file, Metavar.file),
+                          help="bval file, bvec file and output predicted dMRI of an additional target scheme, can be repeated")
+    optional.add_argument("--dvs", nargs=3, action="append", default=[], metavar=(Metavar.file, Metavar.float, Metavar.file),
+                          help="Siemens .dvs scheme file, its largest b-value and output predicted dMRI of an additional target scheme, can be repeated")
+    optional.add_argument("--max_memory", type=float, default=256, metavar=Metavar.float, help="Memory of a block of predicted signal in MB (default: 256)")
+    optional.add_argument("--S0", type=float, metavar=Metavar.float, help="Scale of the predicted signal (default: the S0 of the reconstruction)")
+    optional.add_argument("--rtop_signal", metavar=Metavar.file, help="Output map of the return to origin probability computed from the signal")
+    optional.add_argument("--rtop_pdf", metavar=Metavar.file, help="Output map of the return to origin probability computed from the propagator")
+    optional.add_argument("--msd", metavar=Metavar.file, help="Output map of the mean squared displacement")
+    optional.add_argument("--odf_sh", metavar=Metavar.file, help="Output 4D map of the spherical harmonics coefficients of the analytical ODF")
+
+    args = parser.parse_args()
+    if args.fspred and not (args.bval and args.bvec):
+        parser.error("--fspred requires --bval and --bvec")
+    return args
+
+
+def main():
+    args = parse_arguments()
+
+    start_time = time.time()
+    coeffs = ShoreCoefficients.load(args.fcoeff)
+    print("Loaded", coeffs.coef.shape[0], "voxels of a", coeffs.shape, "volume, radial_order", coeffs.radial_order)
+
+    targets = [(fbval, fbvec, fname) for fbval, fbvec, fname in args.target]
+    if args.fspred:
+        targets.insert(0, (args.bval, args.bvec, args.fspred))
+    schemes = []
+    for fbval, fbvec, fname in targets:
+        bvals, bvecs = read_bvals_bvecs(fbval, fbvec)
+        schemes.append((gradient_table(bvals, bvecs=bvecs, b0_threshold=0), fname))
+    for fdvs, bmax, fname in args.dvs:
+        schemes.append((read_dvs(fdvs, float(bmax)), fname))
+
+    for gtab, fname in schemes:
+        coeffs.predict_to_nifti(gtab, fname, args.S0, int(args.max_memory * 2**20))
+        print("Predicted dMRI saved to", fname, coeffs.shape + (len(gtab.bvals),))
+
+    # Every map is a single product with the stored coefficients, computed only if asked
+    for metric in ("rtop_signal", "rtop_pdf", "msd", "odf_sh"):
+        fname = getattr(args, metric)
+        if fname:
+            save_nifti(fname, coeffs.metric(metric).astype(np.float32), coeffs.affine)
+            print(metric, "map saved to", fname)
+
+    print(f"Done in {time.time() - start_time} seconds.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""Content-addressed cache of design matrices shared by the FEDI models
+
+Design matrices (SHORE and spherical harmonics bases) and their regularized
+inverses only depend on the gradient scheme and on a few model parameters.
+They are cached here under a hash of those inputs, in memory with LRU
+eviction bounded by their size in bytes and, for the matrices of a gradient
+scheme, on disk if a cache directory is set, so that other processes (e.g.
+the successive fedi_dmri_recon calls of fedi_dmri_moco, or subjects acquired
+with the same .dvs scheme) reuse them. Matrices of arbitrary points (ODF
+spheres, propagator grids) are only kept in memory.
+
+The cache directory is taken from the ``FEDI_CACHE_DIR`` environment
+variable, or set with :func:`set_cache_dir`.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class MatrixCache(object):
+    """LRU cache of arrays, optionally backed by a directory of .npz files.
+
+    Parameters
+    ----------
+    max_bytes : int
+        Maximum total size of the arrays kept in memory. An entry larger than
+        max_bytes is returned but not kept.
+    cache_dir : str, optional
+        Directory where entries are stored on disk. None keeps the cache in
+        memory only.
+    """
+
+    def __init__(self, max_bytes=256 * 2**20, cache_dir=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def nbytes(self):
+        """Total size of the arrays kept in memory."""
+        return self._nbytes
+
+    def get(self, key, persist=True):
+        """Return the cached value of key, or None."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+        if not (persist and self.cache_dir):
+            return None
+        value = self._load(key)
+        if value is not None:
+            self._remember(key, value)
+        return value
+
+    def set(self, key, value, persist=True):
+        """Store value (an array or a tuple of arrays) under key."""
+        value = _freeze(value)
+        self._remember(key, value)
+        if persist and self.cache_dir:
+            self._save(key, value)
+        return value
+
+    def get_or_compute(self, key, compute, persist=True):
+        """Return the cached value of key, computing and storing it if needed."""
+        value = self.get(key, persist)
+        if value is None:
+            value = self.set(key, compute(), persist)
+        return value
+
+    def clear(self):
+        """Empty the in-memory cache. Files on disk are kept."""
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+    def _remember(self, key, value):
+        size = _nbytes(value)
+        with self._lock:
+            if key in self._entries:
+                self._nbytes -= _nbytes(self._entries.pop(key))
+            if size > self.max_bytes:
+                return
+            self._entries[key] = value
+            self._nbytes += size
+            while self._nbytes > self.max_bytes:
+                self._nbytes -= _nbytes(self._entries.popitem(last=False)[1])
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".npz")
+
+    def _load(self, key):
+        try:
+            with np.load(self._path(key)) as npz:
+                arrays = [npz["arr_%d" % i] for i in range(len(npz.files))]
+        except (OSError, ValueError, KeyError):
+            return None
+        return _freeze(arrays[0] if len(arrays) == 1 else tuple(arrays))
+
+    def _save(self, key, value):
+        arrays = value if isinstance(value, tuple) else (value,)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Write to a temporary file first so that concurrent processes
+            # never read a partially written entry
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, *arrays)
+            os.replace(tmp, self._path(key))
+        except OSError:
+            # The disk cache is an optimization only
+            pass
+
+
+def _freeze(value):
+    """Make cached arrays read-only, they are shared between callers."""
+    arrays = value if isinstance(value, tuple) else (value,)
+    for array in arrays:
+        if isinstance(array, np.ndarray):
+            array.flags.writeable = False
+    return value
+
+
+def _nbytes(value):
+    arrays = value if isinstance(value, tuple) else (value,)
+    return sum(array.nbytes for array in arrays if isinstance(array, np.ndarray))
+
+
+def hash_key(tag, *parts):
+    """Build a cache key from a tag and arrays or scalar parameters."""
+    h = hashlib.sha1()
+    for part in parts:
+        if part is None or np.isscalar(part):
+            h.update(repr(part).encode())
+        else:
+            part = np.ascontiguousarray(part)
+            h.update(str(part.dtype).encode())
+            h.update(str(part.shape).encode())
+            h.update(part.tobytes())
+        h.update(b"|")
+    return "%s-%s" % (tag, h.hexdigest())
+
+
+def gtab_key_parts(gtab):
+    """Parts of a gradient table that define a design matrix."""
+    return (gtab.bvals, gtab.bvecs, gtab.b0s_mask, gtab.big_delta, gtab.small_delta)
+
+
+design_matrix_cache = MatrixCache(cache_dir=os.environ.get("FEDI_CACHE_DIR"))
+
+
+def set_cache_dir(cache_dir):
+    """Store the design matrices cache on disk under cache_dir (None to disable)."""
+    design_matrix_cache.cache_dir = cache_dir
+
+
+def cached_matrix(tag, parts, compute, persist=True):
+    """Return compute() from the shared cache, keyed by tag and parts."""
+    return design_matrix_cache.get_or_compute(hash_key(tag, *parts), compute, persist)
@@ -1,4 +1,9 @@
 """Tools to easily make multi voxel models"""
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from multiprocessing import shared_memory
+
 import numpy as np
 from numpy.lib.stride_tricks import as_strided
 from tqdm import tqdm
@@ -39,6 +44,138 @@ def multi_voxel_fit(single_voxel_fit):
     return new_fit
 
 
+def parallel_multi_voxel_fit(single_voxel_fit=None, chunk_fit=None):
+    """Method decorator to turn a single voxel model fit definition into a
+    multi voxel model fit definition that fits chunks of voxels on a pool
+
+    The masked voxels are packed, in C order of the mask, and split into
+    chunks of vox_per_chunk voxels, fitted on n_jobs processes or threads.
+    With the "process" engine the packed voxels are placed in shared memory
+    and the model is sent once to each worker. If chunk_fit is given, it is
+    called first on the (n, N) signal of each chunk and may return the fits
+    of all its voxels at once, as a sequence or a DenseMultiVoxelFit of a 1d
+    mask, or None to fit the chunk voxel by voxel. When every chunk returns
+    a DenseMultiVoxelFit, the chunks are joined into a single one.
+
+    Can be used as ``@parallel_multi_voxel_fit`` or
+    ``@parallel_multi_voxel_fit(chunk_fit=_fit_chunk)``. The decorated
+    method takes the extra arguments n_jobs (default 1, 0 or less for all
+    cores), vox_per_chunk (default: four chunks per job) and engine, one of
+    "process" (default), "thread" and "serial".
+    """
+    if single_voxel_fit is None:
+        return partial(parallel_multi_voxel_fit, chunk_fit=chunk_fit)
+
+    def new_fit(self, data, mask=None, n_jobs=1, vox_per_chunk=None, engine="process"):
+        """Fit method for every voxel in data, by chunks of voxels"""
+        # If only one voxel just return a normal fit
+        if data.ndim == 1:
+            return single_voxel_fit(self, data)
+
+        if mask is None:
+            mask = np.ones(data.shape[:-1], dtype=bool)
+        elif mask.shape != data.shape[:-1]:
+            raise ValueError("mask and data shape do not match")
+        else:
+            mask = np.asarray(mask, dtype=bool)
+        if engine not in ("process", "thread", "serial"):
+            raise ValueError("Unknown engine %s, one of process, thread, serial was expected." % engine)
+
+        voxels = data[mask]
+        n = voxels.shape[0]
+        if n_jobs < 1:
+            n_jobs = os.cpu_count()
+        if vox_per_chunk is None:
+            vox_per_chunk = -(-n // (4 * n_jobs))
+        vox_per_chunk = max(1, int(vox_per_chunk))
+        chunks = [(start, min(start + vox_per_chunk, n)) for start in range(0, n, vox_per_chunk)]
+
+        bar = tqdm(total=n, position=0)
+        results = []
+        if n_jobs == 1 or engine == "serial" or len(chunks) < 2:
+            for start, stop in chunks:
+                results.append(_fit_chunk(self, single_voxel_fit, chunk_fit, voxels[start:stop]))
+                bar.update(stop - start)
+        elif engine == "thread":
+            with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+                for (start, stop), fits in zip(chunks, executor.map(
+                        lambda chunk: _fit_chunk(self, single_voxel_fit, chunk_fit,
+                                                 voxels[chunk[0]:chunk[1]]), chunks)):
+                    results.append(fits)
+                    bar.update(stop - start)
+        else:
+            shm = shared_memory.SharedMemory(create=True, size=max(voxels.nbytes, 1))
+            try:
+                shared = np.ndarray(voxels.shape, dtype=voxels.dtype, buffer=shm.buf)
+                shared[...] = voxels
+                spec = (shm.name, voxels.shape, voxels.dtype)
+                with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_chunk_worker,
+                                         initargs=(spec, self, single_voxel_fit.__name__)) as executor:
+                    for (start, stop), fits in zip(chunks, executor.map(_chunk_worker, chunks)):
+                        results.append(fits)
+                        bar.update(stop - start)
+                del shared
+            finally:
+                shm.close()
+                shm.unlink()
+        bar.close()
+        return _join_chunk_fits(self, results, mask)
+
+    new_fit.__name__ = single_voxel_fit.__name__
+    new_fit.__qualname__ = single_voxel_fit.__qualname__
+    # Looked up by name on the model class in the worker processes
+    new_fit.single_voxel_fit = single_voxel_fit
+    new_fit.chunk_fit = chunk_fit
+    return new_fit
+
+
+def _fit_chunk(model, single_voxel_fit, chunk_fit, voxels):
+    if chunk_fit is not None:
+        fits = chunk_fit(model, voxels)
+        if fits is not None:
+            return fits
+    return [single_voxel_fit(model, signal) for signal in voxels]
+
+
+# Packed voxels and model of a worker process, set by _init_chunk_worker
+_chunk_worker_state = {}
+
+
+def _init_chunk_worker(spec, model, method):
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    # Keep a reference to the block, the view does not own it
+    _chunk_worker_state["shm"] = shm
+    _chunk_worker_state["voxels"] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    _chunk_worker_state["model"] = model
+    _chunk_worker_state["fit"] = getattr(type(model), method)
+
+
+def _chunk_worker(chunk):
+    state = _chunk_worker_state
+    start, stop = chunk
+    return _fit_chunk(state["model"], state["fit"].single_voxel_fit, state["fit"].chunk_fit,
+                      state["voxels"][start:stop])
+
+
+def _join_chunk_fits(model, results, mask):
+    """Fit of the voxels of mask from the fits of consecutive chunks of its voxels."""
+    dense = [fits for fits in results if isinstance(fits, DenseMultiVoxelFit)]
+    if results and len(dense) == len(results) and \
+            len(set((type(fits), tuple(sorted(fits.voxel_params))) for fits in dense)) == 1:
+        coef = np.concatenate([fits.coef for fits in dense], axis=0)
+        params = {key: np.concatenate([fits.voxel_params[key] for fits in dense])
+                  for key in dense[0].voxel_params}
+        return type(dense[0])(model, coef, mask, **params)
+
+    fit_array = np.empty(mask.shape, dtype=object)
+    ijk = zip(*np.nonzero(mask))
+    for fits in results:
+        for i in range(len(fits.coef) if isinstance(fits, DenseMultiVoxelFit) else len(fits)):
+            fit_array[next(ijk)] = fits[i]
+    return MultiVoxelFit(model, fit_array, mask)
+
+
 class MultiVoxelFit(ReconstFit):
     """Holds an array of fits and allows access to their attributes and
     methods"""
@@ -103,6 +240,89 @@ class MultiVoxelFit(ReconstFit):
         return result
 
 
+class DenseMultiVoxelFit(MultiVoxelFit):
+    """Holds the fits of the voxels of a mask as one array of coefficients
+
+    The coefficients of the n voxels of mask are the rows of a single
+    (n, n_coefs) array, in C order of the mask, and the other per-voxel
+    parameters of the fits are (n,) arrays. Subclasses compute their
+    attributes for all voxels at once from these arrays; the single voxel
+    fits of fit_class are only created for indexing a voxel and for the
+    attributes and methods that are not vectorized.
+
+    Parameters
+    ----------
+    model : object
+        Model of the fits.
+    coef : ndarray (n, n_coefs)
+        Coefficients of the voxels of mask.
+    mask : ndarray
+        Fitted voxels.
+    **voxel_params : ndarray (n,) or scalar
+        Other arguments of fit_class, one value per voxel or shared.
+    """
+    fit_class = None
+
+    def __init__(self, model, coef, mask, **voxel_params):
+        self.model = model
+        self.mask = np.asarray(mask, dtype=bool)
+        self.coef = np.asarray(coef)
+        n = np.count_nonzero(self.mask)
+        if self.coef.shape[0] != n:
+            raise ValueError("coef has %d rows for %d voxels in mask" % (self.coef.shape[0], n))
+        self.voxel_params = {key: np.broadcast_to(value, (n,))
+                             for key, value in voxel_params.items()}
+        self._fit_array = None
+
+    @property
+    def shape(self):
+        return self.mask.shape
+
+    def volume(self, values, fill=0):
+        """Unpack values (n, ...) of the voxels of mask into an array of shape mask.shape + (...)."""
+        values = np.asarray(values)
+        result = np.full(self.mask.shape + values.shape[1:], fill, dtype=values.dtype)
+        result[self.mask] = values
+        return result
+
+    def voxel_param(self, key, default=0):
+        """(n,) values of the fit_class argument key, default where it was not given."""
+        if key in self.voxel_params:
+            return self.voxel_params[key]
+        return np.broadcast_to(default, self.coef.shape[:1])
+
+    def _voxel_fit(self, i):
+        params = {key: value[i] for key, value in self.voxel_params.items()}
+        return self.fit_class(self.model, self.coef[i], **params)
+
+    @property
+    def fit_array(self):
+        """Object array of the single voxel fits, created on first use."""
+        if self._fit_array is None:
+            fit_array = np.empty(self.mask.shape, dtype=object)
+            for i, ijk in enumerate(zip(*np.nonzero(self.mask))):
+                fit_array[ijk] = self._voxel_fit(i)
+            self._fit_array = fit_array
+        return self._fit_array
+
+    def __getattr__(self, attr):
+        # Attributes of the container itself, e.g. while it is being copied
+        if attr.startswith("_") or attr in ("model", "mask", "coef", "voxel_params"):
+            raise AttributeError(attr)
+        return MultiVoxelFit.__getattr__(self, attr)
+
+    def __getitem__(self, index):
+        rows = np.full(self.mask.shape, -1)
+        rows[self.mask] = np.arange(self.coef.shape[0])
+        rows = rows[index]
+        if np.ndim(rows) == 0:
+            return None if rows < 0 else self._voxel_fit(rows)
+        mask = rows >= 0
+        rows = rows[mask]
+        params = {key: value[rows] for key, value in self.voxel_params.items()}
+        return type(self)(self.model, self.coef[rows], mask, **params)
+
+
 class CallableArray(np.ndarray):
     """An array which can be called like a function"""
     def __call__(self, *args, **kwargs):
@@ -0,0 +1,50 @@
+"""Writing NIfTI volumes larger than memory
+
+The data of an uncompressed NIfTI-1 file is a Fortran ordered array after a
+fixed size header, so it can be written in place through a memory map, block
+by block. A .nii.gz output is written uncompressed next to it first, then
+compressed in a stream.
+"""
+import gzip
+import os
+import shutil
+from contextlib import contextmanager
+
+import nibabel as nib
+import numpy as np
+
+
+def open_nifti_memmap(fname, shape, affine, dtype=np.float64):
+    """Create an uncompressed NIfTI file of the given shape and return its data as a writable memmap."""
+    header = nib.Nifti1Image(np.zeros((1,) * len(shape), dtype=dtype), affine).header.copy()
+    header.set_data_shape(shape)
+    header.set_data_dtype(dtype)
+    header.set_data_offset(352)
+    with open(fname, "wb") as f:
+        f.write(header.binaryblock)
+        # Empty extension flag, the data starts right after
+        f.write(b"\0" * 4)
+        f.truncate(352 + int(np.prod(shape)) * np.dtype(dtype).itemsize)
+    return np.memmap(fname, dtype=dtype, mode="r+", offset=352, shape=shape, order="F")
+
+
+@contextmanager
+def nifti_memmap_writer(fname, shape, affine, dtype=np.float64):
+    """Context manager giving a writable memmap of the data of the NIfTI file fname.
+
+    The file is complete when the context exits without error. A .gz file is
+    memory-mapped as a temporary .nii next to it, compressed at exit and the
+    temporary file removed in any case.
+    """
+    fraw = fname + ".tmp.nii" if fname.endswith(".gz") else fname
+    try:
+        data = open_nifti_memmap(fraw, shape, affine, dtype)
+        yield data
+        data.flush()
+        del data
+        if fraw != fname:
+            with open(fraw, "rb") as fin, gzip.open(fname, "wb") as fout:
+                shutil.copyfileobj(fin, fout, 16 * 2**20)
+    finally:
+        if fraw != fname and os.path.exists(fraw):
+            os.remove(fraw)
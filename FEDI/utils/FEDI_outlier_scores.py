@@ -0,0 +1,124 @@
+"""Single pass scoring of the slices and voxels of fedi_dmri_outliers
+
+The slice weights of fedi_dmri_outliers (modified z-score, angle and
+correlation with the neighbouring directions, GMM of the slice RMSE) only
+depend on a few sums over the voxels of each slice and volume, and its
+SHORE-based voxel weights on the residuals of the voxels of each slice.
+OutlierScores accumulates everything the requested methods need while the
+data and its prediction are read once, slab by slab, and derives the weight
+matrices from these sums at the end.
+"""
+import numpy as np
+
+from FEDI.utils.FEDI_residuals import masked_shell_zscores
+from FEDI.utils.FEDI_weighting import (angular_neighbors, gmm_slice_weights, mzscore_from_sums,
+                                       mzscore_slice_sums, neighbor_slice_sums, neighbors_from_sums,
+                                       residual_slice_sums, residual_voxel_weights, rmse_from_sums)
+
+
+class OutlierScores(object):
+    """Sums over the slices of a dMRI needed by the requested weighting methods.
+
+    Parameters
+    ----------
+    shape : tuple (nx, ny, nz, nv)
+        Shape of the dMRI.
+    bvals : ndarray (nv,)
+        B-values.
+    mzscore : str, optional
+        Metric of the modified z-score ("var", "mean" or "iod"), None to skip it.
+    bvecs : ndarray (nv, 3), optional
+        Unit b-vectors for the angle and correlation neighbours, None to skip them.
+    gmm : bool
+        Accumulate the slice residuals of the GMM weights.
+    shore : bool
+        Compute the SHORE-based voxel weights of each slab.
+    b0_threshold : float
+        B-value up to which volumes have no neighbours.
+    """
+
+    def __init__(self, shape, bvals, mzscore=None, bvecs=None, gmm=False, shore=False, b0_threshold=0):
+        nx, ny, nz, nv = shape
+        self.shape = tuple(shape)
+        self.bvals = np.asarray(bvals)
+        self.mzscore = mzscore
+        self.gmm = gmm
+        self.shore = shore
+        if mzscore is not None:
+            self._mz_sums = np.zeros((nz, nv))
+            self._mz_squares = np.zeros((nz, nv)) if mzscore in ("var", "iod") else None
+        self.graph = None
+        if bvecs is not None:
+            self.graph = angular_neighbors(self.bvals, bvecs, b0_threshold)
+            self._nb_sums = np.zeros((nz, nv))
+            self._nb_squares = np.zeros((nz, nv))
+            self._nb_cross = np.zeros((nz,) + self.graph[1].shape)
+        if gmm:
+            self._sse = np.zeros((nz, nv))
+            self._count = np.zeros((nz, nv), dtype=int)
+        if shore:
+            self._shells = np.unique(self.bvals, return_inverse=True)[1]
+
+    @property
+    def neighbors(self):
+        """Whether the angle and correlation neighbours are scored."""
+        return self.graph is not None
+
+    @property
+    def needs_data(self):
+        """Whether add_slab needs the slabs of the dMRI when the prediction is given."""
+        return self.gmm or self.shore
+
+    def add_slab(self, start, data=None, pred=None, mask=None, gmm_mask=None, shore_mask=None):
+        """Accumulate the sums of the slices of a slab starting at slice start.
+
+        Parameters
+        ----------
+        data, pred : ndarray (nx, ny, nslab, nv)
+            Slab of the dMRI and of its prediction. The modified z-score and
+            the neighbours score pred when it is given, data otherwise, as
+            fedi_dmri_outliers does. The GMM and SHORE-based weights need both.
+        mask : ndarray (nx, ny, nslab), optional
+            Slab of the mask of the modified z-score.
+        gmm_mask : ndarray (nx, ny, nslab), optional
+            Slab of the mask of the GMM slice residuals.
+        shore_mask : ndarray (nx, ny, nslab), optional
+            Slab of the voxels given SHORE-based weights, the others get a
+            weight of 1 (default: all voxels).
+
+        Returns
+        -------
+        weights : ndarray (nx, ny, nslab, nv) or None
+            SHORE-based voxel weights of the slab, if requested.
+        """
+        scored = data if pred is None else pred
+        slab = slice(start, start + scored.shape[2])
+        if self.mzscore is not None:
+            S1, S2 = mzscore_slice_sums(scored, mask, squares=self._mz_squares is not None)
+            self._mz_sums[slab] = S1
+            if S2 is not None:
+                self._mz_squares[slab] = S2
+        if self.neighbors:
+            self._nb_sums[slab], self._nb_squares[slab], self._nb_cross[slab] = \
+                neighbor_slice_sums(scored, self.graph[0], self.graph[1])
+        if self.gmm:
+            self._sse[slab], self._count[slab] = residual_slice_sums(data, pred, gmm_mask)
+        if self.shore:
+            residuals = data - pred
+            zscores = masked_shell_zscores(residuals, self._shells, shore_mask).astype(residuals.dtype)
+            return residual_voxel_weights(zscores)
+        return None
+
+    def mzscore_weights(self, lowerThreshold=3.5, upperThreshold=6.0, weightscalingmethod="linear"):
+        """Modified z-scores and slice weights, see mzscore_slice_weights."""
+        return mzscore_from_sums(self._mz_sums, self._mz_squares, self.shape[0] * self.shape[1], self.bvals,
+                                 self.mzscore, lowerThreshold, upperThreshold, weightscalingmethod)
+
+    def neighbors_weights(self, std_scale=3):
+        """Angle and correlation slice weights, see neighbors_slice_weights."""
+        return neighbors_from_sums(self._nb_sums, self._nb_squares, self._nb_cross,
+                                   self.shape[0] * self.shape[1], self.graph, std_scale)
+
+    def gmm_weights(self, mb=1):
+        """GMM slice weights of the slice RMSE, see fedi_dmri_outliersgmm."""
+        return gmm_slice_weights(rmse_from_sums(self._sse, self._count, mb), self.bvals, mb)
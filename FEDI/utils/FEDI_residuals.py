@@ -0,0 +1,183 @@
+"""Residual summaries of a SHORE reconstruction
+
+fedi_dmri_recon can write, next to the predicted dMRI, the statistics of the
+residuals (data - prediction) from which fedi_dmri_outliers derives its GMM
+slice weights and SHORE-based voxel weights. They are computed slice by slice
+while the data and the prediction of the slice are in memory, and stored in a
+small .npz sidecar, so that fedi_dmri_outliers does not decompress and load
+the two 4D volumes again.
+"""
+import numpy as np
+
+# Scale factor of the MAD for normally distributed residuals
+MAD_SCALE = 1.4826
+
+
+def shell_zscores(residuals, shells):
+    """Standardized residuals of each voxel, shell by shell.
+
+    Parameters
+    ----------
+    residuals : ndarray (..., nv)
+        Residuals of any number of voxels.
+    shells : ndarray (nv,)
+        Shell index of each volume.
+
+    Returns
+    -------
+    mad : ndarray (..., nshells)
+        Scaled median absolute deviation of the residuals of each shell.
+    zscores : ndarray (..., nv)
+        Residuals divided by the MAD of their shell.
+    """
+    nshells = shells.max() + 1
+    mad = np.zeros(residuals.shape[:-1] + (nshells,))
+    zscores = np.zeros(residuals.shape)
+    for s in range(nshells):
+        inds = np.flatnonzero(shells == s)
+        res = residuals[..., inds]
+        dev = np.abs(res - np.median(res, axis=-1, keepdims=True))
+        mad[..., s] = MAD_SCALE * np.median(dev, axis=-1)
+        # Single volume shells have a zero MAD, as in the voxelwise loop of fedi_dmri_outliers
+        with np.errstate(divide="ignore", invalid="ignore"):
+            zscores[..., inds] = res / mad[..., s, None]
+    return mad, zscores
+
+
+def masked_shell_zscores(residuals, shells, mask=None):
+    """(nx, ny, nz, nv) standardized residuals of shell_zscores, 0 outside mask if given."""
+    if mask is None:
+        return shell_zscores(residuals, shells)[1]
+    zscores = np.zeros(residuals.shape)
+    mask = mask > 0
+    zscores[mask] = shell_zscores(residuals[mask], shells)[1]
+    return zscores
+
+
+def slice_residual_stats(dmri_slice, spred_slice, mask_slice, rmse_mask_slice, shells):
+    """Residual statistics of one (x, y, volumes) slice.
+
+    Parameters
+    ----------
+    dmri_slice, spred_slice : ndarray (nx, ny, nv)
+        Data and prediction of the slice.
+    mask_slice : ndarray (nx, ny)
+        Voxels whose standardized residuals are kept.
+    rmse_mask_slice : ndarray (nx, ny)
+        Voxels over which the squared residuals are summed.
+    shells : ndarray (nv,)
+        Shell index of each volume.
+
+    Returns
+    -------
+    sse, count : ndarray (nv,)
+        Sum of squared residuals and number of voxels of rmse_mask_slice.
+    mad : ndarray (n, nshells)
+        Scaled median absolute deviation of the residuals of each shell, for
+        the n voxels of mask_slice.
+    zscores : ndarray (n, nv)
+        Residuals of the voxels of mask_slice divided by the MAD of their shell.
+    """
+    residuals = dmri_slice - spred_slice
+    valid = rmse_mask_slice > 0
+    diff = residuals[valid].astype(np.float64)
+    sse = np.sum(diff**2, axis=0)
+    count = np.full(residuals.shape[-1], diff.shape[0], dtype=int)
+
+    mad, zscores = shell_zscores(residuals[mask_slice > 0].astype(np.float64), shells)
+    return sse, count, mad.astype(np.float32), zscores.astype(np.float32)
+
+
+class ResidualSummary(object):
+    """Residual statistics of a reconstruction, gathered slice by slice.
+
+    Parameters
+    ----------
+    mask : ndarray (nx, ny, nz)
+        Voxels whose standardized residuals and MAD are kept, usually the
+        fitted voxels of the brain mask.
+    bvals : ndarray (nv,)
+        B-values, volumes of equal b-value form a shell.
+    rmse_mask : ndarray (nx, ny, nz), optional
+        Voxels over which the slice RMSE is computed (default: mask).
+    """
+
+    def __init__(self, mask, bvals, rmse_mask=None):
+        self.mask = np.asarray(mask) > 0
+        self.rmse_mask = self.mask if rmse_mask is None else np.asarray(rmse_mask) > 0
+        self.bvals = np.asarray(bvals)
+        self.shell_bvals, self.shells = np.unique(self.bvals, return_inverse=True)
+        nz, nv = self.mask.shape[2], len(self.bvals)
+        self.sse = np.zeros((nz, nv))
+        self.count = np.zeros((nz, nv), dtype=int)
+        self._mad = [None] * nz
+        self._zscores = [None] * nz
+
+    def slice_stats(self, dmri_slice, spred_slice, indxslice):
+        """Statistics of slice indxslice, see slice_residual_stats."""
+        return slice_residual_stats(dmri_slice, spred_slice, self.mask[:, :, indxslice],
+                                    self.rmse_mask[:, :, indxslice], self.shells)
+
+    def add_slice(self, indxslice, stats):
+        """Store the statistics returned by slice_stats for slice indxslice."""
+        self.sse[indxslice], self.count[indxslice], self._mad[indxslice], self._zscores[indxslice] = stats
+
+    def merge(self, other, start):
+        """Copy the statistics of other, a summary of the slab of slices starting at start."""
+        stop = start + other.mask.shape[2]
+        self.sse[start:stop] = other.sse
+        self.count[start:stop] = other.count
+        self._mad[start:stop] = other._mad
+        self._zscores[start:stop] = other._zscores
+
+    @property
+    def mad(self):
+        """(n, nshells) MAD of the residuals of the masked voxels, slice by slice."""
+        return self._stack(self._mad, len(self.shell_bvals))
+
+    @property
+    def zscores(self):
+        """(n, nv) standardized residuals of the masked voxels, slice by slice."""
+        return self._stack(self._zscores, len(self.bvals))
+
+    @staticmethod
+    def _stack(blocks, ncols):
+        empty = np.zeros((0, ncols), dtype=np.float32)
+        return np.concatenate([empty if b is None else b for b in blocks], axis=0)
+
+    def rmse(self, mb=1):
+        """(nz/mb, nv) RMSE per slice and volume, as compute_rmse_slicewise."""
+        nz, nv = self.sse.shape
+        ne = nz // mb
+        sse = self.sse[:mb * ne].reshape(mb, ne, nv).sum(axis=0)
+        count = self.count[:mb * ne].reshape(mb, ne, nv).sum(axis=0)
+        E = np.zeros((ne, nv))
+        valid = count > 0
+        E[valid] = np.sqrt(sse[valid] / count[valid])
+        return E
+
+    def zscores_volume(self):
+        """(nx, ny, nz, nv) standardized residuals, zero outside the mask."""
+        zscores = np.zeros(self.mask.shape + (len(self.bvals),), dtype=np.float32)
+        # Voxels are stored slice by slice, i.e. in C order of the (z, x, y) mask
+        zscores.transpose(2, 0, 1, 3)[self.mask.transpose(2, 0, 1)] = self.zscores
+        return zscores
+
+    def save(self, fname):
+        """Save the summary to a compressed .npz sidecar."""
+        with open(fname, "wb") as f:
+            np.savez_compressed(f, mask=self.mask, rmse_mask=self.rmse_mask, bvals=self.bvals,
+                     sse=self.sse, count=self.count, mad=self.mad, zscores=self.zscores)
+
+    @classmethod
+    def load(cls, fname):
+        """Load a summary saved by save."""
+        with np.load(fname) as npz:
+            summary = cls(npz["mask"], npz["bvals"], npz["rmse_mask"])
+            summary.sse = npz["sse"]
+            summary.count = npz["count"]
+            mad, zscores = npz["mad"], npz["zscores"]
+        # The voxels of all slices are kept as a single block
+        summary._mad = [mad]
+        summary._zscores = [zscores]
+        return summary
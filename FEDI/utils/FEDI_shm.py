@@ -39,6 +39,7 @@ from dipy.reconst.odf import OdfModel, OdfFit
 from dipy.core.geometry import cart2sphere
 from dipy.core.onetime import auto_attr
 from dipy.reconst.cache import Cache
+from FEDI.utils.FEDI_cache import cached_matrix
 
 from distutils.version import LooseVersion
 import scipy
@@ -246,7 +247,7 @@ def real_sph_harm(m, n, theta, phi):
     return real_sh
 
 
-def real_sym_sh_brainsuite(sh_order, theta, phi):
+def real_sym_sh_brainsuite(sh_order, theta, phi, cache=True):
     """
     Compute the real spherical harmonics used in BrainSuite [1]
 
@@ -258,6 +259,9 @@ def real_sym_sh_brainsuite(sh_order, theta, phi):
         The azimuthal (longitudinal) coordinate.
     phi : float [0, pi]
         The polar (colatitudinal) coordinate.
+    cache : bool
+        Keep the harmonics in the in-memory design matrix cache, for points
+        evaluated again (e.g. an ODF sphere).
 
     Returns
     -------
@@ -276,6 +280,14 @@ def real_sym_sh_brainsuite(sh_order, theta, phi):
           MRI of the brain", NeuroImage, 2013.
 
     """
+    if not cache:
+        return _real_sym_sh_brainsuite(sh_order, theta, phi)
+    # Evaluated on arbitrary points (ODF spheres, pdf grids), kept in memory only
+    return cached_matrix("real_sym_sh_brainsuite", (sh_order, theta, phi),
+                         lambda: _real_sym_sh_brainsuite(sh_order, theta, phi), persist=False)
+
+
+def _real_sym_sh_brainsuite(sh_order, theta, phi):
     def _legendre(n, X):
         res = []
         for m in range(n+1):
@@ -397,6 +409,12 @@ def real_sym_sh_basis(sh_order, theta, phi):
     .. [1] https://github.com/scilus/fibernavigator
 
     """
+    # Evaluated on arbitrary points (ODF spheres, pdf grids), kept in memory only
+    return cached_matrix("real_sym_sh_basis", (sh_order, theta, phi),
+                         lambda: _real_sym_sh_basis(sh_order, theta, phi), persist=False)
+
+
+def _real_sym_sh_basis(sh_order, theta, phi):
     m, n = sph_harm_ind_list(sh_order)
     phi = np.reshape(phi, [-1, 1])
     theta = np.reshape(theta, [-1, 1])
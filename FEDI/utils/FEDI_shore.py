@@ -6,13 +6,16 @@ import warnings
 from sklearn.linear_model import Lasso, LassoCV
 from sklearn.exceptions import ConvergenceWarning
 from sklearn.metrics import r2_score
-from math import factorial
 import numpy as np
-from scipy.special import genlaguerre, gamma, hyp2f1
+from scipy.linalg import cho_factor, cho_solve, eigh, solve_triangular, LinAlgError
+from scipy.optimize import nnls
+from scipy.special import gamma, hyp2f1
 from dipy.reconst.cache import Cache
 # from dipy.reconst.multi_voxel import multi_voxel_fit
-from FEDI.utils.FEDI_multi_voxel import multi_voxel_fit
+from FEDI.utils.FEDI_multi_voxel import parallel_multi_voxel_fit, DenseMultiVoxelFit
 from FEDI.utils.FEDI_shm import real_sym_sh_brainsuite
+from FEDI.utils.FEDI_cache import cached_matrix, gtab_key_parts
+from FEDI.utils.FEDI_weighting import gmm_reweighting, mzscore_slice_weights
 from dipy.core.geometry import cart2sphere
 from warnings import warn
 # import cvxpy
@@ -70,7 +73,14 @@ class BrainSuiteShoreModel(Cache):
             pos_grid=11,
             pos_radius=20e-03,
             cvxpy_solver=None,
-            weights=None):
+            weights=None,
+            fedi_solver="closed_form",
+            l1_solver="batched",
+            l1_n_alphas=100,
+            lambda_selection="fixed",
+            gcv_lambdas=None,
+            positive_constraint=False,
+            n_jobs=1):
         r""" Analytical and continuous modeling of the diffusion signal with
         respect to the SHORE basis [1,2]_.
         This implementation is a modification of SHORE presented in [1]_.
@@ -114,6 +124,37 @@ class BrainSuiteShoreModel(Cache):
         pos_radius : float,
             Radius of the grid of the EAP in which enforce positivity in
             millimeters. By default 20e-03 mm.
+        weights : 2d ndarray or 1d ndarray, optional
+            Weighting matrix W of the "FEDI" loss ||W (M c - data)||^2. A 1d
+            array is taken as the diagonal of W.
+        fedi_solver : str,
+            Solver used for ``regularization="FEDI"``. "closed_form" (default)
+            solves the weighted ridge normal equations once for all voxels
+            sharing the same weights, "cvxpy" builds one CVXPY problem per
+            voxel.
+        l1_solver : str,
+            Solver used for ``regularization="L1"``. "batched" (default)
+            solves all voxels together by coordinate descent on the shared
+            Gram matrix, "sklearn" runs one LassoCV/Lasso per voxel.
+        l1_n_alphas : int,
+            Number of alphas of the regularization path searched by
+            cross-validation with the "batched" L1 solver.
+        lambda_selection : str,
+            "fixed" (default) uses lambdaN and lambdaL. "gcv_voxel" and
+            "gcv_slice" select lambdaN by generalized cross-validation for
+            each voxel, or once for all voxels passed to ``fit`` (a slice
+            in fedi_dmri_recon), keeping the ratio lambdaL / lambdaN. Only
+            for the "L2" and closed-form "FEDI" fits with shared weights.
+        gcv_lambdas : 1d ndarray, optional
+            Grid of lambdaN values searched by GCV. By default 41 values
+            from 1e-12 to 1e-2.
+        positive_constraint : bool,
+            Constrain the EAP to be positive on the points of the pos_grid
+            grid within pos_radius. Only for the "L2" and closed-form "FEDI"
+            fits with fixed lambdas.
+        n_jobs : int,
+            Number of processes of the fits made voxel by voxel ("L2", "cvxpy"
+            "FEDI" and "sklearn" L1 solvers), 0 or less for all cores.
 
 
         References
@@ -196,6 +237,41 @@ class BrainSuiteShoreModel(Cache):
 
         self.cvxpy_solver = cvxpy_solver
 
+        if fedi_solver not in ("closed_form", "cvxpy"):
+            msg = "Input `fedi_solver` was set to %s." % fedi_solver
+            msg += " One of closed_form, cvxpy was expected."
+            raise ValueError(msg)
+        self.fedi_solver = fedi_solver
+
+        if l1_solver not in ("batched", "sklearn"):
+            msg = "Input `l1_solver` was set to %s." % l1_solver
+            msg += " One of batched, sklearn was expected."
+            raise ValueError(msg)
+        self.l1_solver = l1_solver
+        self.l1_n_alphas = l1_n_alphas
+
+        if lambda_selection not in ("fixed", "gcv_voxel", "gcv_slice"):
+            msg = "Input `lambda_selection` was set to %s." % lambda_selection
+            msg += " One of fixed, gcv_voxel, gcv_slice was expected."
+            raise ValueError(msg)
+        if lambda_selection != "fixed" and (
+                regularization not in ("L2", "FEDI") or
+                (regularization == "FEDI" and fedi_solver != "closed_form")):
+            raise ValueError("GCV lambda selection requires regularization='L2' "
+                             "or the closed-form 'FEDI' fit.")
+        self.lambda_selection = lambda_selection
+        if gcv_lambdas is None:
+            gcv_lambdas = np.logspace(-12, -2, 41)
+        self.gcv_lambdas = np.asarray(gcv_lambdas, dtype=float)
+
+        if positive_constraint and (
+                lambda_selection != "fixed" or regularization not in ("L2", "FEDI") or
+                (regularization == "FEDI" and fedi_solver != "closed_form")):
+            raise ValueError("positive_constraint requires regularization='L2' or the "
+                             "closed-form 'FEDI' fit, with lambda_selection='fixed'.")
+        self.positive_constraint = positive_constraint
+        self.n_jobs = n_jobs
+
     def _n_shore(self):
         n = self.ind_mat[:, 0]
         return np.diag((n * (n + 1))**2)
@@ -204,22 +280,310 @@ class BrainSuiteShoreModel(Cache):
         ell = self.ind_mat[:, 1]
         return np.diag((ell * (ell + 1))**2)
 
-    @multi_voxel_fit
-    def fit(self, data):
-
-        # Weights
-        weights = self.weights
-
-        # Generate the SHORE basis
+    def _shore_matrix(self):
         M = self.cache_get('shore_matrix', key=self.gtab)
         if M is None:
             M = brainsuite_shore_basis(self.radial_order, self.zeta, self.gtab, self.tau)
             self.cache_set('shore_matrix', self.gtab, M)
+        return M
+
+    def _matrix_key_parts(self):
+        return (self.radial_order, self.zeta, self.tau, self.lambdaN,
+                self.lambdaL) + gtab_key_parts(self.gtab)
+
+    def _reg_pinv(self):
         MpseudoInv = self.cache_get('shore_matrix_reg_pinv', key=self.gtab)
         if MpseudoInv is None:
-            MpseudoInv = np.linalg.solve(
-                np.dot(M.T, M) + self.lambdaN * self.Nshore + self.lambdaL * self.Lshore, M.T)
+            M = self._shore_matrix()
+            MpseudoInv = cached_matrix(
+                'shore_matrix_reg_pinv', self._matrix_key_parts(),
+                lambda: np.linalg.solve(
+                    np.dot(M.T, M) + self.lambdaN * self.Nshore + self.lambdaL * self.Lshore, M.T))
             self.cache_set('shore_matrix_reg_pinv', self.gtab, MpseudoInv)
+        return MpseudoInv
+
+    def gcv_decomposition(self, weights=None):
+        """ Simultaneous diagonalization of the weighted SHORE fit.
+
+        Returns (U, V, theta) with ``U = W M V`` orthonormal and ``V`` the
+        generalized eigenvectors of the penalty, see ``shore_gcv_decomposition``.
+        Computed once per gradient table and weighting, for any lambda.
+        """
+        if weights is None:
+            weights = self.weights
+        return cached_matrix(
+            'shore_gcv_decomposition', self._matrix_key_parts() + (weights,),
+            lambda: shore_gcv_decomposition(
+                self._shore_matrix(), weights,
+                self.Nshore + self.lambdaL / self.lambdaN * self.Lshore),
+            persist=False)
+
+    def positivity_matrix(self):
+        """ Constraint matrix D of the EAP positivity, D c >= 0.
+
+        Built once per (radial_order, zeta, pos_grid, pos_radius).
+        """
+        return cached_matrix(
+            'shore_matrix_positive_constraint',
+            (self.radial_order, self.zeta, self.pos_grid, self.pos_radius),
+            lambda: shore_positivity_matrix(
+                self.radial_order, self.zeta, self.pos_grid, self.pos_radius),
+            persist=False)
+
+    def _weighted_normal(self, weights=None):
+        if weights is None:
+            weights = self.weights
+        return cached_matrix(
+            'shore_matrix_weighted_normal', self._matrix_key_parts() + (weights,),
+            lambda: weighted_shore_normal(
+                self._shore_matrix(), weights,
+                self.lambdaN * self.Nshore + self.lambdaL * self.Lshore),
+            persist=False)
+
+    def weighted_pinv(self, weights=None):
+        """ Regularized weighted pseudo-inverse of the SHORE basis.
+
+        Returns the (n_coefs, n_volumes) matrix P such that ``P @ data``
+        minimizes ||W (M c - data)||^2 + lambdaN c'Nc + lambdaL c'Lc. The
+        normal matrix is factorized once per distinct weighting and kept in
+        the shared in-memory cache.
+        """
+        if weights is None:
+            weights = self.weights
+        return cached_matrix(
+            'shore_matrix_weighted_pinv', self._matrix_key_parts() + (weights,),
+            lambda: weighted_shore_pinv(
+                self._shore_matrix(), weights,
+                self.lambdaN * self.Nshore + self.lambdaL * self.Lshore),
+            persist=False)
+
+    def fit(self, data, mask=None, weights=None):
+        """ Fit the SHORE model to every voxel of data.
+
+        With ``regularization="FEDI"`` and ``fedi_solver="closed_form"`` all
+        voxels share the same weighted normal equations and are solved with
+        a single matrix product. With ``regularization="L1"`` and
+        ``l1_solver="batched"`` all voxels are solved together by
+        coordinate descent. With GCV ``lambda_selection`` all voxels share
+        one decomposition of the design. Other settings are fitted by chunks
+        of voxels on ``n_jobs`` processes, the "L2" fit of a chunk with a
+        single matrix product and the others voxel by voxel.
+
+        Parameters
+        ----------
+        data : array, shape (..., N)
+            Diffusion signal.
+        mask : array, shape (...), optional
+            Voxels to fit.
+        weights : array, shape (..., N), optional
+            Diagonal of the weighting matrix W for each voxel, replacing the
+            model ``weights``. Only available for the closed-form "FEDI" fit.
+        """
+        if self.lambda_selection != "fixed":
+            if weights is not None:
+                raise ValueError("GCV lambda selection requires weights shared by all voxels.")
+            return self._fit_gcv(data, mask)
+        if (self.regularization == "FEDI" and self.fedi_solver == "closed_form") or \
+                self.positive_constraint:
+            return self._fit_closed_form(data, mask, weights)
+        if weights is None and self.regularization == "L1" and self.l1_solver == "batched":
+            return self._fit_l1(data, mask)
+        if weights is not None:
+            raise ValueError("Voxel-wise weights require regularization='FEDI' "
+                             "and fedi_solver='closed_form'.")
+        return self._fit_voxel(data, mask, n_jobs=self.n_jobs)
+
+    def fit_irls(self, data, mask=None, slice_weights=None, rmse_mask=None,
+                 reweight=None, max_iter=10, tol=1e-3):
+        """ Robust fit of a volume by iteratively reweighted least squares.
+
+        The slices are along the third axis of data, as in fedi_dmri_recon.
+        Each slice is fitted in closed form with its row of slice weights (W
+        is the diagonal of their square root), the RMSE of each slice and
+        volume within rmse_mask is turned into new slice weights by reweight,
+        and the fit is repeated until no weight moves by more than tol. The
+        outer loop of fedi_dmri_moco (fedi_dmri_outliers then
+        fedi_dmri_recon) thus runs in memory.
+
+        Parameters
+        ----------
+        data : array, shape (X, Y, Z, N)
+            Diffusion signal.
+        mask : array, shape (X, Y, Z), optional
+            Voxels to fit.
+        slice_weights : array, shape (Z, N), optional
+            Initial slice weights. By default the modified z-score weights
+            of the slices of data.
+        rmse_mask : array, shape (X, Y, Z), optional
+            Voxels over which the slice RMSE is computed (default: mask).
+        reweight : callable, optional
+            Maps the (Z, N) RMSE to new slice weights. By default the square
+            root of the posterior of the GMM of the log RMSE of each shell.
+        max_iter : int
+            Maximum number of fits.
+        tol : float
+            Largest change of a slice weight at convergence.
+
+        Returns
+        -------
+        fit : BrainSuiteShoreMultiVoxelFit
+            Fit of the last iteration.
+        slice_weights : array, shape (Z, N)
+            Slice weights of the last fit.
+        n_iter : int
+            Number of fits.
+        converged : bool
+            Whether no weight moved by more than tol after the last fit.
+        """
+        if self.regularization != "FEDI" or self.fedi_solver != "closed_form" or \
+                self.lambda_selection != "fixed":
+            raise ValueError("fit_irls requires the closed-form 'FEDI' fit with "
+                             "lambda_selection='fixed'.")
+        if data.ndim != 4:
+            raise ValueError("fit_irls requires a 4D volume of slices.")
+        if mask is None:
+            mask = np.ones(data.shape[:-1], dtype=bool)
+        elif mask.shape != data.shape[:-1]:
+            raise ValueError("mask and data shape do not match")
+        mask = mask > 0
+        rmse_mask = mask if rmse_mask is None else rmse_mask > 0
+        if slice_weights is None:
+            slice_weights = mzscore_slice_weights(data, mask, self.bvals)[1]
+        if reweight is None:
+            def reweight(E):
+                return gmm_reweighting(E, self.bvals)
+
+        M = self._shore_matrix()
+        nz = data.shape[2]
+        coef = [None] * nz
+        converged = False
+        for n_iter in range(1, max_iter + 1):
+            sse = np.zeros(slice_weights.shape)
+            count = np.zeros(slice_weights.shape, dtype=int)
+            for z in range(nz):
+                weights = np.sqrt(slice_weights[z])
+                signal = data[:, :, z][mask[:, :, z]]
+                coef[z] = np.dot(signal, self.weighted_pinv(weights).T)
+                if self.positive_constraint:
+                    coef[z], _ = positive_shore_coef(
+                        self._weighted_normal(weights), coef[z], self.positivity_matrix())
+                # Voxels of rmse_mask that are not fitted are predicted as 0
+                pred = np.zeros(data.shape[:2] + (M.shape[0],))
+                pred[mask[:, :, z]] = np.dot(coef[z], M.T)
+                valid = rmse_mask[:, :, z]
+                sse[z] = np.sum((data[:, :, z][valid] - pred[valid])**2, axis=0)
+                count[z] = np.count_nonzero(valid)
+            E = np.zeros(sse.shape)
+            E[count > 0] = np.sqrt(sse[count > 0] / count[count > 0])
+            new_weights = reweight(E)
+            converged = np.max(np.abs(new_weights - slice_weights)) <= tol
+            if converged or n_iter == max_iter:
+                break
+            slice_weights = new_weights
+
+        # The slices were fitted one by one, the fit holds the voxels in C order of the mask
+        coef_volume = np.zeros(data.shape[:-1] + (M.shape[1],))
+        for z in range(nz):
+            coef_volume[:, :, z][mask[:, :, z]] = coef[z]
+        return BrainSuiteShoreMultiVoxelFit(self, coef_volume[mask], mask, regularization=2), \
+            slice_weights, n_iter, converged
+
+    def _fit_closed_form(self, data, mask=None, weights=None):
+        if weights is not None and weights.shape != data.shape:
+            raise ValueError("weights and data shape do not match")
+
+        if data.ndim == 1:
+            if weights is None:
+                coef = np.dot(self.weighted_pinv(), data)
+            else:
+                coef = np.dot(self.weighted_pinv(weights), data)
+            if self.positive_constraint:
+                coef = positive_shore_coef(
+                    self._weighted_normal(weights), coef[None], self.positivity_matrix())[0][0]
+            return BrainSuiteShoreFit(self, coef, regularization=2)
+
+        if mask is None:
+            mask = np.ones(data.shape[:-1], dtype=bool)
+        elif mask.shape != data.shape[:-1]:
+            raise ValueError("mask and data shape do not match")
+        mask = mask.astype(bool)
+
+        R = self.lambdaN * self.Nshore + self.lambdaL * self.Lshore
+        if weights is None:
+            coef = np.dot(data[mask], self.weighted_pinv().T)
+            if self.positive_constraint:
+                coef, _ = positive_shore_coef(self._weighted_normal(), coef, self.positivity_matrix())
+        else:
+            coef = weighted_shore_coef_voxelwise(self._shore_matrix(), data[mask], weights[mask], R)
+            if self.positive_constraint:
+                coef, _ = positive_shore_coef(
+                    (self._shore_matrix(), weights[mask], R), coef, self.positivity_matrix())
+        return BrainSuiteShoreMultiVoxelFit(self, coef, mask, regularization=2)
+
+    def _fit_gcv(self, data, mask=None):
+        if data.ndim == 1:
+            return self._fit_gcv(data[None], np.ones(1, dtype=bool))[0]
+
+        if mask is None:
+            mask = np.ones(data.shape[:-1], dtype=bool)
+        elif mask.shape != data.shape[:-1]:
+            raise ValueError("mask and data shape do not match")
+        mask = mask.astype(bool)
+
+        weights = self.weights if self.regularization == "FEDI" else None
+        signal = data[mask]
+        if weights is not None:
+            weights = np.asarray(weights, dtype=float)
+            signal = signal * weights if weights.ndim == 1 else np.dot(signal, weights.T)
+        coef, lambdas = gcv_ridge_coef(
+            *self.gcv_decomposition(weights), signal, self.gcv_lambdas,
+            shared=self.lambda_selection == "gcv_slice")
+
+        return BrainSuiteShoreMultiVoxelFit(self, coef, mask, regularization=2, lambdaN=lambdas)
+
+    def _fit_l1(self, data, mask=None):
+        if data.ndim == 1:
+            return self._fit_l1(data[None], np.ones(1, dtype=bool))[0]
+
+        if mask is None:
+            mask = np.ones(data.shape[:-1], dtype=bool)
+        elif mask.shape != data.shape[:-1]:
+            raise ValueError("mask and data shape do not match")
+        mask = mask.astype(bool)
+
+        signal = data[mask]
+        alpha = None if self.regularization_weighting == "CV" else self.l1_alpha
+        coef, alpha, converged = lasso_shore_coef(
+            self._shore_matrix(), signal, alpha=alpha, cv=self.l1_cv,
+            n_alphas=self.l1_n_alphas, positive=self.l1_positive_constraint,
+            max_iter=self.l1_maxiter)
+
+        # Same fallback as the voxel-wise fit: L2 where the L1 fit did not converge
+        coef[~converged] = np.dot(signal[~converged], self._reg_pinv().T)
+        alpha[~converged] = 0
+        if self.l1_verbose and not converged.all():
+            warn("%d voxels did not converge, fitted with L2" % np.sum(~converged))
+
+        return BrainSuiteShoreMultiVoxelFit(self, coef, mask, regularization=np.where(converged, 1, 2),
+                                            alpha=alpha)
+
+    def _fit_chunk(self, data):
+        # The L2 fit of a chunk of voxels is a single product, other fits are voxel by voxel
+        if self.regularization != "L2":
+            return None
+        coef = np.dot(data, self._reg_pinv().T)
+        return BrainSuiteShoreMultiVoxelFit(self, coef, np.ones(len(coef), dtype=bool),
+                                            regularization=2)
+
+    @parallel_multi_voxel_fit(chunk_fit=_fit_chunk)
+    def _fit_voxel(self, data):
+
+        # Weights
+        weights = self.weights
+
+        # Generate the SHORE basis
+        M = self._shore_matrix()
+        MpseudoInv = self._reg_pinv()
 
         # Compute the signal coefficients in SHORE basis
         l2_fallback = False
@@ -318,7 +682,7 @@ class BrainSuiteShoreModel(Cache):
 
 
 class BrainSuiteShoreFit():
-    def __init__(self, model, shore_coef, regularization=0, alpha=0., r2=0., cnr=0.):
+    def __init__(self, model, shore_coef, regularization=0, alpha=0., r2=0., cnr=0., lambdaN=None):
         """ Calculates diffusion properties for a single voxel
 
         Parameters
@@ -335,6 +699,7 @@ class BrainSuiteShoreFit():
         self._r2 = r2
         self._cnr = cnr
         self._regularization = regularization
+        self._lambdaN = model.lambdaN if lambdaN is None else lambdaN
         self.gtab = model.gtab
         self.radial_order = model.radial_order
         self.zeta = model.zeta
@@ -366,7 +731,7 @@ class BrainSuiteShoreFit():
 
         psi = self.model.cache_get('shore_matrix_pdf', key=(gridsize, radius_max))
         if psi is None:
-            psi = shore_matrix_pdf(self.radial_order, self.zeta, rtab)
+            psi = brainsuite_shore_matrix_pdf(self.radial_order, self.zeta, rtab)
             self.model.cache_set('shore_matrix_pdf', (gridsize, radius_max), psi)
 
         propagator = np.dot(psi, self._shore_coef)
@@ -398,33 +763,8 @@ class BrainSuiteShoreFit():
         r""" Calculates the real analytical ODF in terms of Spherical
         Harmonics.
         """
-        # Number of Spherical Harmonics involved in the estimation
-        J = (self.radial_order + 1) * (self.radial_order + 2) // 2
-
-        # Compute the Spherical Harmonics Coefficients
-        c_sh = np.zeros(J)
-        counter = 0
-
-        for n in range(self.radial_order + 1):
-            for l in range(0, n + 1, 2):
-                for m in range(-l, l + 1):
-
-                    j = int(l + m + (2 * np.array(range(0, l, 2)) + 1).sum())
-
-                    Cnl = (((-1) **
-                            (n - l / 2)) / (2.0 * (4.0 * np.pi**2 * self.zeta)**(3.0 / 2.0)) * (
-                                (2.0 * (4.0 * np.pi**2 * self.zeta) **
-                                 (3.0 / 2.0) * factorial(n - l)) / (gamma(n + 3.0 / 2.0))) **
-                           (1.0 / 2.0))
-                    Gnl = (gamma(l / 2 + 3.0 / 2.0) * gamma(3.0 / 2.0 + n)) / \
-                        (gamma(l + 3.0 / 2.0) * factorial(n - l)) * \
-                        (1.0 / 2.0) ** (-l / 2 - 3.0 / 2.0)
-                    Fnl = hyp2f1(-n + l, l / 2 + 3.0 / 2.0, l + 3.0 / 2.0, 2.0)
-
-                    c_sh[j] += self._shore_coef[counter] * Cnl * Gnl * Fnl
-                    counter += 1
-
-        return c_sh
+        return np.dot(shore_metric_matrix(self.radial_order, self.zeta, "odf_sh"),
+                      self._shore_coef)
 
     def odf(self, sphere):
         r""" Calculates the ODF for a given discrete sphere.
@@ -447,13 +787,8 @@ class BrainSuiteShoreFit():
         diffusion imaging method for mapping tissue microstructure",
         NeuroImage, 2013.
         """
-        rtop = 0
-        c = self._shore_coef
-
-        for n in range(int(self.radial_order / 2) + 1):
-            rtop += c[n] * (-1) ** n * \
-                ((16 * np.pi * self.zeta ** 1.5 * gamma(n + 1.5))
-                 / (factorial(n))) ** 0.5
+        rtop = np.dot(shore_metric_matrix(self.radial_order, self.zeta, "rtop_signal"),
+                      self._shore_coef)
 
         return np.clip(rtop, 0, rtop.max())
 
@@ -467,12 +802,8 @@ class BrainSuiteShoreFit():
         diffusion imaging method for mapping tissue microstructure",
         NeuroImage, 2013.
         """
-        rtop = 0
-        c = self._shore_coef
-        for n in range(int(self.radial_order / 2) + 1):
-            rtop += c[n] * (-1) ** n * \
-                ((4 * np.pi ** 2 * self.zeta ** 1.5 * factorial(n))
-                 / (gamma(n + 1.5))) ** 0.5 * genlaguerre(n, 0.5)(0)
+        rtop = np.dot(shore_metric_matrix(self.radial_order, self.zeta, "rtop_pdf"),
+                      self._shore_coef)
 
         return np.clip(rtop, 0, rtop.max())
 
@@ -495,13 +826,8 @@ class BrainSuiteShoreFit():
         .. [1] Wu Y. et al., "Hybrid diffusion imaging", NeuroImage, vol 36,
         p. 617-629, 2007.
         """
-        msd = 0
-        c = self._shore_coef
-
-        for n in range(int(self.radial_order / 2) + 1):
-            msd += c[n] * (-1) ** n *\
-                (9 * (gamma(n + 1.5)) / (8 * np.pi ** 6 * self.zeta ** 3.5
-                                         * factorial(n))) ** 0.5 * hyp2f1(-n, 2.5, 1.5, 2)
+        msd = np.dot(shore_metric_matrix(self.radial_order, self.zeta, "msd"),
+                     self._shore_coef)
 
         return np.clip(msd, 0, msd.max())
 
@@ -529,6 +855,12 @@ class BrainSuiteShoreFit():
         """The alpha used for the L1 fit."""
         return self._alpha
 
+    @property
+    def lambdaN(self):
+        """The radial regularization constant of the fit, selected by GCV or
+        the model lambdaN."""
+        return self._lambdaN
+
     @property
     def cnr(self):
         """Contrast to Noise ratio."""
@@ -545,12 +877,848 @@ class BrainSuiteShoreFit():
         return self._r2
 
 
+class BrainSuiteShoreMultiVoxelFit(DenseMultiVoxelFit):
+    """SHORE fits of the voxels of a mask, held as one array of coefficients
+
+    The signal and every SHORE metric are linear in the coefficients, so they
+    are computed for all voxels with one matrix product and returned as
+    volumes, zero outside the mask, as ``MultiVoxelFit`` does. Indexing a
+    voxel gives its ``BrainSuiteShoreFit``.
+
+    Parameters
+    ----------
+    model : BrainSuiteShoreModel
+        Model of the fits.
+    coef : ndarray (n, n_coefs)
+        SHORE coefficients of the n voxels of mask, in C order of the mask.
+    mask : ndarray
+        Fitted voxels.
+    **voxel_params : ndarray (n,) or scalar
+        regularization, alpha, r2, cnr and lambdaN of the voxels, see
+        ``BrainSuiteShoreFit``.
+    """
+    fit_class = BrainSuiteShoreFit
+
+    def _metric(self, metric):
+        values = shore_metric_map(self.coef, self.model.radial_order, self.model.zeta, metric)
+        if metric != "odf_sh":
+            # Clipped at 0 as the single voxel fits intend
+            values = np.maximum(values, 0)
+        return self.volume(values)
+
+    def odf_sh(self):
+        """Real analytical ODF in terms of Spherical Harmonics."""
+        return self._metric("odf_sh")
+
+    def odf(self, sphere):
+        """ODF on the vertices of a discrete sphere."""
+        upsilon = self.model.cache_get('shore_matrix_odf', key=sphere)
+        if upsilon is None:
+            upsilon = shore_matrix_odf(self.model.radial_order, self.model.zeta, sphere.vertices)
+            self.model.cache_set('shore_matrix_odf', sphere, upsilon)
+        return self.volume(np.dot(self.coef, upsilon.T))
+
+    def rtop_signal(self):
+        """Return to origin probability computed from the signal."""
+        return self._metric("rtop_signal")
+
+    def rtop_pdf(self):
+        """Return to origin probability computed from the propagator."""
+        return self._metric("rtop_pdf")
+
+    def msd(self):
+        """Mean squared displacement."""
+        return self._metric("msd")
+
+    def fitted_signal(self):
+        """The fitted signal."""
+        return self.volume(np.dot(self.coef, self.model._shore_matrix().T))
+
+    def predict(self, gtab, S0=1.):
+        """Signal predicted on gtab, S0 is a scalar or an array of shape mask.shape."""
+        M = brainsuite_shore_basis(self.model.radial_order, self.model.zeta, gtab, self.model.tau)
+        E = np.dot(self.coef, M.T)
+        if np.ndim(S0) > 0:
+            E *= np.asarray(S0)[self.mask][:, None]
+        else:
+            E *= S0
+        return self.volume(E)
+
+    @property
+    def shore_coeff(self):
+        """The SHORE coefficients."""
+        return self.volume(self.coef)
+
+    @property
+    def alpha(self):
+        """The alpha used for the L1 fit."""
+        return self.volume(self.voxel_param("alpha", 0.))
+
+    @property
+    def lambdaN(self):
+        """The radial regularization constant of the fits."""
+        return self.volume(self.voxel_param("lambdaN", self.model.lambdaN))
+
+    @property
+    def cnr(self):
+        """Contrast to Noise ratio."""
+        return self.volume(self.voxel_param("cnr", 0.))
+
+    @property
+    def regularization(self):
+        """Regularization used for fitting coefficients."""
+        return self.volume(self.voxel_param("regularization", 0))
+
+    @property
+    def r2(self):
+        """Model r^2."""
+        return self.volume(self.voxel_param("r2", 0.))
+
+
+def weighted_shore_pinv(M, weights, R):
+    """ Solve the weighted ridge normal equations of a SHORE fit.
+
+    Parameters
+    ----------
+    M : array, shape (N, K)
+        SHORE design matrix.
+    weights : array, shape (N, N) or (N,), or None
+        Weighting matrix W, or its diagonal. None means no weighting.
+    R : array, shape (K, K)
+        Regularization matrix, e.g. lambdaN * N + lambdaL * L.
+
+    Returns
+    -------
+    P : array, shape (K, N)
+        Matrix such that ``P @ data`` minimizes
+        ||W (M c - data)||^2 + c'Rc.
+    """
+    if weights is None:
+        WM = M
+        rhs = M.T
+    else:
+        weights = np.asarray(weights, dtype=float)
+        if weights.ndim == 1:
+            WM = weights[:, None] * M
+            rhs = WM.T * weights
+        else:
+            WM = np.dot(weights, M)
+            rhs = np.dot(WM.T, weights)
+
+    A = np.dot(WM.T, WM) + R
+    try:
+        return cho_solve(cho_factor(A), rhs)
+    except LinAlgError:
+        # Singular normal matrix, e.g. all weights of a slice set to zero
+        return np.linalg.lstsq(A, rhs, rcond=None)[0]
+
+
+def weighted_shore_normal(M, weights, R):
+    """ Normal matrix M'W'WM + R of the weighted ridge SHORE fit.
+
+    weights is the matrix W, its diagonal, or None.
+    """
+    if weights is None:
+        WM = M
+    else:
+        weights = np.asarray(weights, dtype=float)
+        WM = weights[:, None] * M if weights.ndim == 1 else np.dot(weights, M)
+    return np.dot(WM.T, WM) + R
+
+
+def shore_positivity_matrix(radial_order, zeta, pos_grid, pos_radius):
+    """ EAP positivity constraints D c >= 0 of SHORE coefficients c.
+
+    Rows are the propagator at the points of half of the pos_grid grid of
+    radius pos_radius (the EAP is symmetric), normalized to unit norm.
+    """
+    lg = int(np.floor(pos_grid ** 3 / 2))
+    _, t = create_rspace(pos_grid, pos_radius)
+    psi = brainsuite_shore_matrix_pdf(radial_order, zeta, t[:lg])
+    return psi / np.linalg.norm(psi, axis=1, keepdims=True)
+
+
+def positive_shore_coef(A, coef, D, tol=1e-10, max_rounds=50):
+    """ Constrain ridge SHORE fits to a positive EAP.
+
+    The weighted ridge objective of a voxel equals (c - c0)'A(c - c0) up to a
+    constant, with A its normal matrix and c0 its unconstrained solution, so
+    each voxel whose c0 violates D c >= 0 solves
+
+        min (c - c0)'A(c - c0)  s.t.  D c >= 0.
+
+    With A = LL' and u = L'(c - c0), this is the least distance problem
+    min ||u|| s.t. D L^-T u >= -D c0, solved by NNLS [Lawson1974]_. The
+    constraints are added in rounds starting from the most violated ones,
+    so each NNLS only sees a few tens of the constraints. The Cholesky
+    factor and D L^-T are shared by all voxels when A is.
+
+    Parameters
+    ----------
+    A : array, shape (K, K), or tuple (M, weights, R)
+        Normal matrix shared by all voxels, or the design matrix, the
+        (V, N) diagonal weights and the regularization matrix of voxels
+        with their own weights.
+    coef : array, shape (V, K)
+        Unconstrained coefficients.
+    D : array, shape (m, K)
+        Constraint matrix, see ``shore_positivity_matrix``.
+
+    Returns
+    -------
+    coef : array, shape (V, K)
+    converged : array of bool, shape (V,)
+
+    References
+    ----------
+    .. [Lawson1974] Lawson C. L. and Hanson R. J., "Solving Least Squares
+       Problems", Prentice-Hall, 1974, chapter 23.
+    """
+    coef = np.array(coef, dtype=float)
+    converged = np.ones(len(coef), dtype=bool)
+    h = -np.dot(coef, D.T)
+    scale = np.abs(h).max(axis=1)
+    violating = np.nonzero(h.max(axis=1) > tol * scale)[0]
+    if len(violating) == 0:
+        return coef, converged
+
+    n_coefs = D.shape[1]
+    f = np.zeros(n_coefs + 1)
+    f[-1] = 1
+    if not isinstance(A, tuple):
+        L = np.linalg.cholesky(A)
+        G = solve_triangular(L, D.T, lower=True).T
+    for i in violating:
+        if isinstance(A, tuple):
+            M, weights, R = A
+            L = np.linalg.cholesky(weighted_shore_normal(M, weights[i], R))
+            G = solve_triangular(L, D.T, lower=True).T
+        work = np.argsort(-h[i])[:n_coefs]
+        work = work[h[i, work] > 0]
+        for _ in range(max_rounds):
+            E = np.vstack([G[work].T, h[i, work]])
+            x = nnls(E, f)[0]
+            r = np.dot(E, x) - f
+            u = -r[:-1] / r[-1]
+            slack = np.dot(G, u) - h[i]
+            bad = np.nonzero(slack < -tol * scale[i])[0]
+            if len(bad) == 0:
+                break
+            # Keep the active constraints, add the most violated ones
+            bad = bad[np.argsort(slack[bad])[:n_coefs]]
+            work = np.union1d(work[x > 0], bad)
+        else:
+            converged[i] = False
+        coef[i] += solve_triangular(L.T, u, lower=False)
+    return coef, converged
+
+
+def weighted_shore_coef_voxelwise(M, data, weights, R, chunk_size=1024):
+    """ Solve the weighted ridge SHORE fit with one weighting per voxel.
+
+    The normal equations of all voxels in a chunk are assembled with one
+    matrix product and solved as a batch.
+
+    Parameters
+    ----------
+    M : array, shape (N, K)
+        SHORE design matrix.
+    data : array, shape (V, N)
+        Signal of V voxels.
+    weights : array, shape (V, N)
+        Diagonal of the weighting matrix W of each voxel.
+    R : array, shape (K, K)
+        Regularization matrix, e.g. lambdaN * N + lambdaL * L.
+    chunk_size : int
+        Number of voxels solved together, bounds memory to
+        chunk_size * K * K floats.
+
+    Returns
+    -------
+    coef : array, shape (V, K)
+        SHORE coefficients of each voxel.
+    """
+    n_coefs = M.shape[1]
+    MM = (M[:, :, None] * M[:, None, :]).reshape(M.shape[0], -1)
+    coef = np.empty((data.shape[0], n_coefs))
+    for start in range(0, data.shape[0], chunk_size):
+        chunk = slice(start, start + chunk_size)
+        w2 = np.square(weights[chunk], dtype=float)
+        A = np.dot(w2, MM).reshape(-1, n_coefs, n_coefs) + R
+        b = np.dot(w2 * data[chunk], M)
+        try:
+            coef[chunk] = np.linalg.solve(A, b[..., None])[..., 0]
+        except LinAlgError:
+            # At least one singular voxel, e.g. all its weights set to zero
+            coef[chunk] = [np.linalg.lstsq(a, rhs, rcond=None)[0]
+                           for a, rhs in zip(A, b)]
+    return coef
+
+
+def shore_gcv_decomposition(M, weights, R):
+    """ Simultaneous diagonalization of the weighted design and the penalty.
+
+    Solves the generalized eigenproblem R v = theta (M'W'WM) v, so that for
+    any lambda (M'W'WM + lambda R)^-1 = V diag(1 / (1 + lambda theta)) V'
+    and U = W M V has orthonormal columns.
+
+    Parameters
+    ----------
+    M : array, shape (N, K)
+        SHORE design matrix.
+    weights : array, shape (N, N) or (N,), or None
+        Weighting matrix W, or its diagonal.
+    R : array, shape (K, K)
+        Penalty matrix scaled by lambda, e.g. N + (lambdaL / lambdaN) L.
+
+    Returns
+    -------
+    U : array, shape (N, K)
+    V : array, shape (K, K)
+    theta : array, shape (K,)
+    """
+    if weights is None:
+        WM = M
+    else:
+        weights = np.asarray(weights, dtype=float)
+        WM = weights[:, None] * M if weights.ndim == 1 else np.dot(weights, M)
+    A = np.dot(WM.T, WM)
+    try:
+        theta, V = eigh(R, A)
+    except LinAlgError:
+        # Rank deficient weighted design, e.g. fewer volumes than coefficients
+        A[np.diag_indices_from(A)] += 1e-12 * np.trace(A) / A.shape[0]
+        theta, V = eigh(R, A)
+    return np.dot(WM, V), V, np.maximum(theta, 0)
+
+
+def gcv_ridge_coef(U, V, theta, data, lambdas, shared=False):
+    """ Ridge SHORE fit with lambda selected by generalized cross-validation.
+
+    With the decomposition of ``shore_gcv_decomposition``, the residual and
+    the trace of the hat matrix of every voxel and every lambda of the grid
+    only take products with the (V, K) projections of the data.
+
+    Parameters
+    ----------
+    U, V, theta : arrays
+        Output of ``shore_gcv_decomposition``.
+    data : array, shape (n_voxels, N)
+        Weighted signal W y of each voxel.
+    lambdas : array, shape (n_lambdas,)
+        Grid of lambdas.
+    shared : bool
+        Select one lambda for all voxels instead of one per voxel.
+
+    Returns
+    -------
+    coef : array, shape (n_voxels, K)
+    lambda : array, shape (n_voxels,)
+        Selected lambda of each voxel.
+    """
+    n_samples = U.shape[0]
+    Z = np.dot(data, U)
+    Z2 = Z ** 2
+    filters = 1 / (1 + lambdas[:, None] * theta)
+    outside = np.sum(data ** 2, axis=1) - np.sum(Z2, axis=1)
+    rss = np.maximum(outside[:, None] + np.dot(Z2, ((1 - filters) ** 2).T), 0)
+    dof = np.maximum(n_samples - filters.sum(axis=1), np.finfo(float).eps) ** 2
+    if shared:
+        best = np.full(len(data), np.argmin(rss.sum(axis=0) / dof))
+    else:
+        best = np.argmin(rss / dof, axis=1)
+    coef = np.dot(Z * filters[best], V.T)
+    return coef, lambdas[best]
+
+
+def lasso_coordinate_descent(M, data, alpha, coef=None, G=None, positive=False,
+                             max_iter=1000, tol=1e-4, min_batch=4):
+    """ Lasso of many voxels sharing one design matrix, by coordinate descent.
+
+    Minimizes (1 / 2N) ||y - M c||^2 + alpha ||c||_1 for every voxel with
+    sweeps over all voxels at once, using the Gram matrix G = M'M shared by
+    all voxels. The stopping rule is the duality gap of sklearn's coordinate
+    descent, and converged voxels are dropped from the following sweeps. The
+    last ``min_batch`` voxels are finished one by one with sklearn's Lasso,
+    which is cheaper than a sweep over so few voxels.
+
+    Parameters
+    ----------
+    M : array, shape (N, K)
+        SHORE design matrix.
+    data : array, shape (V, N)
+        Signal of V voxels.
+    alpha : float or array, shape (V,)
+        L1 penalty of each voxel.
+    coef : array, shape (V, K), optional
+        Warm start.
+    G : array, shape (K, K), optional
+        Precomputed M'M.
+    positive : bool
+        Constrain the coefficients to be positive.
+    max_iter : int
+        Maximum number of sweeps over the coefficients.
+    tol : float
+        Tolerance on the duality gap, relative to ||y||^2.
+    min_batch : int
+        Number of remaining voxels below which they are solved one by one.
+
+    Returns
+    -------
+    coef : array, shape (V, K)
+    converged : array of bool, shape (V,)
+    """
+    n_samples, n_coefs = M.shape
+    n_voxels = data.shape[0]
+    if G is None:
+        G = np.dot(M.T, M)
+    q = np.dot(data, M)
+    y_norm2 = np.sum(data ** 2, axis=1)
+    alpha = np.broadcast_to(np.asarray(alpha, dtype=float), (n_voxels,))
+    coef = np.zeros((n_voxels, n_coefs)) if coef is None else np.array(coef, dtype=float)
+    converged = np.zeros(n_voxels, dtype=bool)
+    diag = np.diag(G)
+
+    # Coefficients along the rows, so that each coordinate update works on
+    # contiguous arrays of the remaining voxels
+    idx = np.arange(n_voxels)
+    w, qa, a = coef.T.copy(), q.T.copy(), alpha * n_samples
+    inv_diag = np.divide(1, diag, out=np.zeros_like(diag), where=diag != 0)
+    for sweep in range(max_iter):
+        if len(idx) < min_batch:
+            break
+        w_old = w.copy()
+        thresholds = np.outer(inv_diag, a)
+        for j in np.nonzero(diag)[0]:
+            z = qa[j] - np.dot(G[j], w)
+            z *= inv_diag[j]
+            z += w[j]
+            # Soft thresholding, z minus its clipping to [-t, t]
+            if positive:
+                np.maximum(z - thresholds[j], 0, out=w[j])
+            else:
+                np.subtract(z, np.minimum(np.maximum(z, -thresholds[j]), thresholds[j]), out=w[j])
+        H = np.dot(G, w)
+
+        # Duality gap of the voxels whose coefficients barely moved
+        done = np.zeros(len(idx), dtype=bool)
+        w_max = np.abs(w).max(axis=0)
+        d_w_max = np.abs(w - w_old).max(axis=0)
+        check = d_w_max <= tol * w_max
+        if check.any():
+            wc, qc, Hc, ac, yc = w[:, check], qa[:, check], H[:, check], a[check], y_norm2[idx[check]]
+            XtA = qc - Hc
+            dual_norm = XtA.max(axis=0) if positive else np.abs(XtA).max(axis=0)
+            wq = np.einsum('ij,ij->j', wc, qc)
+            R_norm2 = yc + np.einsum('ij,ij->j', wc, Hc) - 2 * wq
+            scale = np.where(dual_norm > ac, ac / np.where(dual_norm == 0, 1, dual_norm), 1)
+            gap = np.where(dual_norm > ac, 0.5 * R_norm2 * (1 + scale ** 2), R_norm2)
+            gap += ac * np.abs(wc).sum(axis=0) - scale * (yc - wq)
+            done[check] = gap <= tol * yc
+        if done.any():
+            coef[idx[done]] = w[:, done].T
+            converged[idx[done]] = True
+            keep = ~done
+            idx, w, qa, a, H = idx[keep], w[:, keep], qa[:, keep], a[keep], H[:, keep]
+    else:
+        sweep = max_iter
+    coef[idx] = w.T
+
+    for i in idx:
+        lasso = Lasso(alpha=alpha[i], fit_intercept=False, precompute=G, positive=positive,
+                      max_iter=max(max_iter - sweep, 1), tol=tol, warm_start=True)
+        lasso.coef_ = coef[i].copy()
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always', ConvergenceWarning)
+            coef[i] = lasso.fit(M, data[i]).coef_
+        converged[i] = not any(issubclass(warning.category, ConvergenceWarning) for warning in caught)
+    return coef, converged
+
+
+def lasso_shore_coef(M, data, alpha=None, cv=3, n_alphas=100, eps=1e-3,
+                     positive=False, max_iter=1000, tol=1e-4):
+    """ Lasso SHORE fit of all voxels sharing the design matrix M.
+
+    Uses the objective of sklearn's Lasso, (1 / 2N) ||y - M c||^2 +
+    alpha ||c||_1. Without ``alpha``, each voxel picks its alpha by K-fold
+    cross-validation over the volumes, as LassoCV does: every voxel follows
+    its own grid of ``n_alphas`` alphas from its alpha_max down to
+    eps * alpha_max, all solved together with warm starts and one Gram
+    matrix per fold.
+
+    Parameters
+    ----------
+    M : array, shape (N, K)
+        SHORE design matrix.
+    data : array, shape (V, N)
+        Signal of V voxels.
+    alpha : float, optional
+        Fixed L1 penalty. None selects it by cross-validation.
+    cv : int
+        Number of folds.
+
+    Returns
+    -------
+    coef : array, shape (V, K)
+        SHORE coefficients of each voxel.
+    alpha : array, shape (V,)
+        Alpha of each voxel.
+    converged : array of bool, shape (V,)
+        Whether the final fit of each voxel converged.
+    """
+    data = np.asarray(data, dtype=float)
+    n_samples = M.shape[0]
+    if alpha is None:
+        Xy = np.abs(np.dot(data, M)).max(axis=1) / n_samples
+        alpha_max = np.maximum(Xy, np.finfo(float).resolution)
+        alphas = alpha_max[:, None] * np.logspace(0, np.log10(eps), n_alphas)
+
+        mse = np.zeros_like(alphas)
+        for test in np.array_split(np.arange(n_samples), cv):
+            train = np.setdiff1d(np.arange(n_samples), test)
+            M_train, M_test = M[train], M[test]
+            G = np.dot(M_train.T, M_train)
+            coef = None
+            for k in range(n_alphas):
+                coef, _ = lasso_coordinate_descent(
+                    M_train, data[:, train], alphas[:, k], coef, G, positive, max_iter, tol)
+                residual = data[:, test] - np.dot(coef, M_test.T)
+                mse[:, k] += np.mean(residual ** 2, axis=1) / cv
+        alpha = alphas[np.arange(len(data)), np.argmin(mse, axis=1)]
+    else:
+        alpha = np.full(len(data), alpha, dtype=float)
+
+    coef, converged = lasso_coordinate_descent(
+        M, data, alpha, positive=positive, max_iter=max_iter, tol=tol)
+    return coef, alpha, converged
+
+
+SHORE_METRICS = ("odf_sh", "rtop_signal", "rtop_pdf", "msd")
+
+
+def shore_metric_matrix(radial_order, zeta, metric):
+    """ Linear map from SHORE coefficients to a scalar or SH metric.
+
+    Every metric of ``SHORE_METRICS`` is linear in the coefficients, so it is
+    computed once per (radial_order, zeta) and applied to any number of
+    voxels with one matrix product.
+
+    Parameters
+    ----------
+    radial_order : unsigned int,
+        an even integer that represent the order of the basis
+    zeta : unsigned int,
+        scale factor
+    metric : str,
+        One of "odf_sh" (real analytical ODF in spherical harmonics),
+        "rtop_signal", "rtop_pdf" (return to origin probability) and "msd"
+        (mean squared displacement).
+
+    Returns
+    -------
+    A : array, shape (J, n_coefs) for "odf_sh", (n_coefs,) otherwise
+    """
+    if metric not in SHORE_METRICS:
+        raise ValueError("Unknown SHORE metric %s, one of %s was expected."
+                         % (metric, ', '.join(SHORE_METRICS)))
+    return cached_matrix('shore_metric_' + metric, (radial_order, zeta),
+                         lambda: _shore_metric_matrix(radial_order, zeta, metric),
+                         persist=False)
+
+
+def _shore_metric_matrix(radial_order, zeta, metric):
+    ind_mat = shore_index_matrix(radial_order)
+    n, l, m = ind_mat[:, 0], ind_mat[:, 1], ind_mat[:, 2]
+
+    if metric == "odf_sh":
+        # Number of Spherical Harmonics involved in the estimation
+        J = (radial_order + 1) * (radial_order + 2) // 2
+        Cnl = ((-1.0) ** (n - l // 2) / (2.0 * (4.0 * np.pi**2 * zeta)**(3.0 / 2.0)) * (
+            (2.0 * (4.0 * np.pi**2 * zeta)**(3.0 / 2.0) * gamma(n - l + 1)) /
+            gamma(n + 3.0 / 2.0))**(1.0 / 2.0))
+        Gnl = (gamma(l / 2 + 3.0 / 2.0) * gamma(3.0 / 2.0 + n)) / \
+            (gamma(l + 3.0 / 2.0) * gamma(n - l + 1)) * \
+            (1.0 / 2.0) ** (-l / 2 - 3.0 / 2.0)
+        Fnl = hyp2f1(-n + l, l / 2 + 3.0 / 2.0, l + 3.0 / 2.0, 2.0)
+        A = np.zeros((J, ind_mat.shape[0]))
+        A[l * (l - 1) // 2 + l + m, np.arange(ind_mat.shape[0])] = Cnl * Gnl * Fnl
+        return A
+
+    # The scalar metrics only involve the first radial_order / 2 + 1 coefficients
+    A = np.zeros(ind_mat.shape[0])
+    k = np.arange(int(radial_order / 2) + 1)
+    if metric == "rtop_signal":
+        A[k] = (-1.0) ** k * ((16 * np.pi * zeta ** 1.5 * gamma(k + 1.5)) / gamma(k + 1)) ** 0.5
+    elif metric == "rtop_pdf":
+        # L_k^{1/2}(0) = binom(k + 1/2, k)
+        A[k] = (-1.0) ** k * ((4 * np.pi ** 2 * zeta ** 1.5 * gamma(k + 1)) / gamma(k + 1.5)) ** 0.5 \
+            * gamma(k + 1.5) / (gamma(k + 1) * gamma(1.5))
+    elif metric == "msd":
+        A[k] = (-1.0) ** k * (9 * gamma(k + 1.5) / (8 * np.pi ** 6 * zeta ** 3.5 * gamma(k + 1))) ** 0.5 \
+            * hyp2f1(-k, 2.5, 1.5, 2)
+    return A
+
+
+def shore_metric_map(shore_coeff, radial_order, zeta, metric):
+    """ Compute a SHORE metric for every voxel of a coefficient array.
+
+    Parameters
+    ----------
+    shore_coeff : array, shape (..., n_coefs)
+        SHORE coefficients, e.g. ``MultiVoxelFit.shore_coeff`` of a volume.
+    radial_order : unsigned int,
+        radial order used for the fit
+    zeta : unsigned int,
+        scale factor used for the fit
+    metric : str,
+        One of ``SHORE_METRICS``.
+
+    Returns
+    -------
+    map : array, shape (...) or (..., J) for "odf_sh"
+        Same values as the per-voxel ``BrainSuiteShoreFit`` methods.
+    """
+    A = shore_metric_matrix(radial_order, zeta, metric)
+    return np.dot(shore_coeff, A.T)
+
+
+class ShorePropagatorEngine(object):
+    """ Ensemble average propagators of many voxels on a common grid.
+
+    The propagator matrix of the grid is built once if it fits in half of
+    ``max_memory``, by blocks of grid points otherwise, and applied to chunks
+    of SHORE coefficients. Full grids are streamed in voxel chunks so that
+    the propagators and the propagator matrix together stay within
+    ``max_memory``, and the usual propagator integrals are computed without
+    materializing any grid.
+
+    Parameters
+    ----------
+    radial_order : unsigned int,
+        radial order used for the fit
+    zeta : unsigned int,
+        scale factor used for the fit
+    gridsize : unsigned int
+        dimension of the propagator grid
+    radius_max : float
+        maximal radius in which to compute the propagator
+    max_memory : int
+        Maximum number of bytes of propagators and propagator matrix held at once.
+    dtype : data-type
+        Data type of the propagator matrix and of the streamed grids.
+    """
+
+    REDUCTIONS = ("rtop", "mass", "line_integral", "plane_integral", "radial_profile")
+
+    def __init__(self, radial_order, zeta, gridsize, radius_max,
+                 max_memory=256 * 2**20, dtype=np.float32):
+        self.radial_order = radial_order
+        self.zeta = zeta
+        self.radius_max = radius_max
+        self.max_memory = max_memory
+        self.dtype = np.dtype(dtype)
+
+        rgrid, self.rtab = create_rspace(gridsize, radius_max)
+        radius = gridsize // 2
+        # Integer grid coordinates relative to the origin
+        self.grid = rgrid.astype(int) - radius
+        self.side = 2 * radius + 1
+        self.spacing = radius_max / radius
+        self.n_coefs = shore_index_matrix(radial_order).shape[0]
+        # Rows of the propagator matrix built at once within half of max_memory, a
+        # block is built from its float64 radial and angular factors
+        self._row_bytes = 4 * self.n_coefs * np.dtype(np.float64).itemsize
+        self.block_size = int(min(self.n_points, max(1, (max_memory // 2) // self._row_bytes)))
+        self._psi = None
+        if self.block_size == self.n_points:
+            self._psi = self._psi_rows(slice(0, self.n_points))
+
+    @property
+    def n_points(self):
+        return self.rtab.shape[0]
+
+    @property
+    def chunk_size(self):
+        """Number of voxels whose propagators fit in max_memory with a block of the propagator matrix."""
+        itemsize = self.dtype.itemsize
+        # A chunk of propagators, and the product of the chunk with a block if the matrix is built by blocks
+        voxel_bytes = self.n_points * itemsize
+        if self._psi is None:
+            free = self.max_memory - self.block_size * self._row_bytes
+            voxel_bytes += self.block_size * itemsize
+        else:
+            free = self.max_memory - self._psi.nbytes
+        return max(1, int(free // voxel_bytes))
+
+    def _psi_rows(self, points):
+        return brainsuite_shore_matrix_pdf(self.radial_order, self.zeta, self.rtab[points], self.dtype)
+
+    def iter_psi(self):
+        """ Yield (points, psi) blocks of rows of the propagator matrix.
+
+        The whole matrix, built once, if it fits in half of max_memory, else
+        blocks of ``block_size`` grid points built on the fly.
+        """
+        if self._psi is not None:
+            yield slice(0, self.n_points), self._psi
+            return
+        for start in range(0, self.n_points, self.block_size):
+            points = slice(start, min(start + self.block_size, self.n_points))
+            yield points, self._psi_rows(points)
+
+    def iter_propagators(self, shore_coeff):
+        """ Yield the propagator grids chunk by chunk.
+
+        Parameters
+        ----------
+        shore_coeff : array, shape (n_voxels, n_coefs)
+
+        Yields
+        ------
+        voxels : slice
+            Rows of shore_coeff in the chunk.
+        eap : array, shape (n, side, side, side)
+            Propagator density of each voxel of the chunk.
+        """
+        shore_coeff = np.asarray(shore_coeff).reshape(-1, self.n_coefs)
+        for start in range(0, shore_coeff.shape[0], self.chunk_size):
+            voxels = slice(start, start + self.chunk_size)
+            coef = shore_coeff[voxels].astype(self.dtype, copy=False)
+            if self._psi is not None:
+                eap = np.dot(coef, self._psi.T)
+            else:
+                eap = np.empty((coef.shape[0], self.n_points), dtype=self.dtype)
+                for points, psi in self.iter_psi():
+                    eap[:, points] = np.dot(coef, psi.T)
+            yield voxels, eap.reshape((-1,) + (self.side,) * 3)
+
+    def reduction_matrix(self, reduction, bins=10, points=None):
+        """ Grid weights of a named linear reduction, shape (k, n_points).
+
+        "rtop": density at the origin. "mass": total probability.
+        "line_integral": integrals along the x, y and z grid axes through the
+        origin (RTAP-style when an axis follows the fiber). "plane_integral":
+        integrals over the planes through the origin perpendicular to x, y
+        and z (RTPP-style). "radial_profile": mean density in ``bins``
+        displacement-magnitude bins up to radius_max. If points (a slice) is
+        given, only the weights of these grid points are returned.
+        """
+        points = slice(None) if points is None else points
+        grid = self.grid[points]
+        if reduction == "rtop":
+            R = np.all(grid == 0, axis=1)[None].astype(float)
+        elif reduction == "mass":
+            R = np.full((1, grid.shape[0]), self.spacing ** 3)
+        elif reduction == "line_integral":
+            R = np.stack([np.all(np.delete(grid, axis, axis=1) == 0, axis=1)
+                          for axis in range(3)]) * self.spacing
+        elif reduction == "plane_integral":
+            R = np.stack([grid[:, axis] == 0 for axis in range(3)]) * self.spacing ** 2
+        elif reduction == "radial_profile":
+            edges = np.linspace(0, self.radius_max, bins + 1)
+            norms = np.linalg.norm(self.rtab, axis=1)
+            which = np.digitize(norms, edges[1:-1])
+            inside = norms <= self.radius_max
+            # Number of points of each bin over the whole grid
+            counts = np.maximum(np.bincount(which[inside], minlength=bins), 1)
+            which, inside = which[points], inside[points]
+            R = np.zeros((bins, grid.shape[0]))
+            R[which[inside], np.nonzero(inside)[0]] = 1
+            R /= counts[:, None]
+        else:
+            raise ValueError("Unknown reduction %s, one of %s was expected."
+                             % (reduction, ', '.join(self.REDUCTIONS)))
+        return R
+
+    def reduce(self, shore_coeff, reduction, **kwargs):
+        """ Reduce the propagator of every voxel without keeping its grid.
+
+        Parameters
+        ----------
+        shore_coeff : array, shape (..., n_coefs)
+        reduction : str or callable
+            One of ``REDUCTIONS``, which are linear and are applied directly
+            to the coefficients, or a function mapping a chunk of propagator
+            grids (n, side, side, side) to an (n, ...) array, applied to the
+            streamed grids.
+        kwargs :
+            Passed to ``reduction_matrix`` for named reductions.
+
+        Returns
+        -------
+        out : array, shape (...) or (..., k)
+        """
+        shore_coeff = np.asarray(shore_coeff)
+        shape = shore_coeff.shape[:-1]
+        if not callable(reduction):
+            A = sum(np.dot(self.reduction_matrix(reduction, points=points, **kwargs), psi)
+                    for points, psi in self.iter_psi())
+            out = np.dot(shore_coeff, A.T)
+            return out[..., 0] if out.shape[-1] == 1 else out
+
+        out = None
+        for voxels, eap in self.iter_propagators(shore_coeff):
+            value = np.asarray(reduction(eap))
+            if out is None:
+                out = np.empty((int(np.prod(shape)),) + value.shape[1:], dtype=value.dtype)
+            out[voxels] = value
+        return out.reshape(shape + out.shape[1:])
+
+
 def _kappa(zeta, n, l):
-    return np.sqrt((2 * factorial(n - l)) / (zeta**1.5 * gamma(n + 1.5)))
+    return np.sqrt((2 * gamma(n - l + 1)) / (zeta**1.5 * gamma(n + 1.5)))
+
+
+def _genlaguerre_table(max_degree, alpha, x):
+    """Generalized Laguerre polynomials L_k^alpha(x) for k = 0..max_degree,
+    evaluated with the three-term recurrence."""
+    table = np.empty((max_degree + 1,) + x.shape)
+    table[0] = 1
+    if max_degree > 0:
+        table[1] = 1 + alpha - x
+    for k in range(1, max_degree):
+        table[k + 1] = ((2 * k + 1 + alpha - x) * table[k] - (k + alpha) * table[k - 1]) / (k + 1)
+    return table
+
+
+def _shore_radial(radial_order, x):
+    r"""Radial part $L_{n-l}^{l+1/2}(x) \, x^{l/2} e^{-x/2}$ of every column
+    of the SHORE basis, for points x of shape (N,). Returns (N, n_coefs)."""
+    ind_mat = shore_index_matrix(radial_order)
+    n, l = ind_mat[:, 0], ind_mat[:, 1]
+    # Built one basis function per row, then transposed
+    radial = np.empty((ind_mat.shape[0], x.shape[0]))
+    decay = np.exp(-x / 2)
+    for ell in range(0, radial_order + 1, 2):
+        cols = np.nonzero(l == ell)[0]
+        laguerre = _genlaguerre_table(radial_order - ell, ell + 0.5, x)
+        laguerre *= decay * x ** (ell / 2)
+        radial[cols] = laguerre[n[cols] - ell]
+    return radial.T
+
+
+def _shore_angular(radial_order, theta, phi, cache=True):
+    """Spherical harmonics part of every column of the SHORE basis."""
+    S, _, _ = real_sym_sh_brainsuite(radial_order, theta, phi, cache)
+    ind_mat = shore_index_matrix(radial_order)
+    l, m = ind_mat[:, 1], ind_mat[:, 2]
+    # BrainSuite orders the harmonics of degree l by m, from l(l-1)/2 on
+    return S[:, l * (l - 1) // 2 + l + m]
+
+
+def brainsuite_shore_basis(radial_order, zeta, gtab, tau=1 / (4 * np.pi**2), dtype=np.float64):
+    """Calculate the brainsuite shore basis functions.
+
+    The basis only depends on the gradient table and on the parameters, it
+    is computed once per scheme and kept in the shared design matrix cache.
+    """
+    return cached_matrix(
+        'brainsuite_shore_basis',
+        (radial_order, zeta, tau, np.dtype(dtype).str) + gtab_key_parts(gtab),
+        lambda: _brainsuite_shore_basis(radial_order, zeta, gtab, tau, dtype))
 
 
-def brainsuite_shore_basis(radial_order, zeta, gtab, tau=1 / (4 * np.pi**2)):
-    """Calculate the brainsuite shore basis functions."""
+def _brainsuite_shore_basis(radial_order, zeta, gtab, tau, dtype):
 
     # If deltas are defined, use them
     try:
@@ -565,26 +1733,14 @@ def brainsuite_shore_basis(radial_order, zeta, gtab, tau=1 / (4 * np.pi**2)):
     r, theta, phi = cart2sphere(qgradients[:, 0], qgradients[:, 1], qgradients[:, 2])
     theta[np.isnan(theta)] = 0
 
-    # Angular part of the basis - Spherical harmonics
-    S, _, L = real_sym_sh_brainsuite(radial_order, theta, phi)
-    Snew = []
-    R = []
-    for n in range(radial_order + 1):
-        for l in range(0, n + 1, 2):
-            Snew.append(S[:, L == l])
-            for _ in range(-l, l + 1):
-                # Radial part
-                R.append(genlaguerre(n - l, l + 0.5)(r ** 2 / zeta) *
-                         np.exp(- r ** 2 / (2.0 * zeta)) *
-                         _kappa(zeta, n, l) *
-                         (r ** 2 / zeta) ** (l / 2))
-    R = np.column_stack(R)
-    Snew = np.column_stack(Snew)
-    Sh = R * Snew
-    return Sh
-
-
-def brainsuite_shore_matrix_pdf(radial_order, zeta, rtab):
+    ind_mat = shore_index_matrix(radial_order)
+    kappa = _kappa(zeta, ind_mat[:, 0], ind_mat[:, 1])
+    Sh = _shore_radial(radial_order, r ** 2 / zeta) * kappa * \
+        _shore_angular(radial_order, theta, phi)
+    return Sh.astype(dtype, copy=False)
+
+
+def brainsuite_shore_matrix_pdf(radial_order, zeta, rtab, dtype=np.float64):
     r"""Compute the SHORE propagator matrix [1]_"
 
     Parameters
@@ -595,6 +1751,8 @@ def brainsuite_shore_matrix_pdf(radial_order, zeta, rtab):
         scale factor
     rtab : array, shape (N,3)
         real space points in which calculates the pdf
+    dtype : data-type, optional
+        Data type of the returned matrix.
 
     References
     ----------
@@ -605,29 +1763,21 @@ def brainsuite_shore_matrix_pdf(radial_order, zeta, rtab):
 
     r, theta, phi = cart2sphere(rtab[:, 0], rtab[:, 1], rtab[:, 2])
     theta[np.isnan(theta)] = 0
-    psi = []
 
-    # Angular part of the basis - Spherical harmonics
-    S, _, L = real_sym_sh_brainsuite(radial_order, theta, phi)
-    Snew = []
-
-    for n in range(radial_order + 1):
-        for l in range(0, n + 1, 2):
-            Snew.append(S[:, L == l])
-            for _ in range(-l, l + 1):
-                psi.append(
-                    genlaguerre(n - l, l + 0.5)(4 * np.pi ** 2 * zeta * r ** 2)
-                    * np.exp(-2 * np.pi ** 2 * zeta * r ** 2) * _kappa_pdf(zeta, n, l)
-                    * (4 * np.pi ** 2 * zeta * r ** 2) ** (l / 2) * (-1) ** (n - l / 2))
-
-    return np.column_stack(psi) * np.column_stack(Snew)
+    ind_mat = shore_index_matrix(radial_order)
+    n, l = ind_mat[:, 0], ind_mat[:, 1]
+    scale = _kappa_pdf(zeta, n, l) * (-1.0) ** (n - l // 2)
+    # The harmonics of a grid of points are not kept in the cache, they are used once
+    psi = _shore_radial(radial_order, 4 * np.pi ** 2 * zeta * r ** 2) * scale * \
+        _shore_angular(radial_order, theta, phi, cache=False)
+    return psi.astype(dtype, copy=False)
 
 
 def _kappa_pdf(zeta, n, l):
-    return np.sqrt((16 * np.pi**3 * zeta**1.5 * factorial(n - l)) / gamma(n + 1.5))
+    return np.sqrt((16 * np.pi**3 * zeta**1.5 * gamma(n - l + 1)) / gamma(n + 1.5))
 
 
-def shore_matrix_odf(radial_order, zeta, sphere_vertices):
+def shore_matrix_odf(radial_order, zeta, sphere_vertices, dtype=np.float64):
     r"""Compute the SHORE ODF matrix [1]_"
 
     Parameters
@@ -638,6 +1788,8 @@ def shore_matrix_odf(radial_order, zeta, sphere_vertices):
         scale factor
     sphere_vertices : array, shape (N,3)
         vertices of the odf sphere
+    dtype : data-type, optional
+        Data type of the returned matrix.
 
     References
     ----------
@@ -649,26 +1801,18 @@ def shore_matrix_odf(radial_order, zeta, sphere_vertices):
     _, theta, phi = cart2sphere(sphere_vertices[:, 0], sphere_vertices[:, 1],
                                 sphere_vertices[:, 2])
     theta[np.isnan(theta)] = 0
-    upsilon = []
 
-    # Angular part of the basis - Spherical harmonics
-    S, _, L = real_sym_sh_brainsuite(radial_order, theta, phi)
-    Snew = []
-
-    for n in range(radial_order + 1):
-        for l in range(0, n + 1, 2):
-            Snew.append(S[:, L == l])
-            for _ in range(-l, l + 1):
-                upsilon.append((-1) ** (n - l / 2.0) * _kappa_odf(zeta, n, l) * hyp2f1(
-                    l - n, l / 2.0 + 1.5, l + 1.5, 2.0))
-
-    return np.column_stack(upsilon) * np.column_stack(Snew)
+    ind_mat = shore_index_matrix(radial_order)
+    n, l = ind_mat[:, 0], ind_mat[:, 1]
+    upsilon = (-1.0) ** (n - l // 2) * _kappa_odf(zeta, n, l) * \
+        hyp2f1(l - n, l / 2.0 + 1.5, l + 1.5, 2.0)
+    return (upsilon * _shore_angular(radial_order, theta, phi)).astype(dtype, copy=False)
 
 
 def _kappa_odf(zeta, n, l):
     return np.sqrt(
-        (gamma(l / 2.0 + 1.5)**2 * gamma(n + 1.5) * 2 ** (l + 3)) / (
-            16 * np.pi**3 * (zeta)**1.5 * factorial(n - l) * gamma(l + 1.5)**2))
+        (gamma(l / 2.0 + 1.5)**2 * gamma(n + 1.5) * 2 ** (l + 3.0)) / (
+            16 * np.pi**3 * (zeta)**1.5 * gamma(n - l + 1) * gamma(l + 1.5)**2))
 
 
 def create_rspace(gridsize, radius_max):
@@ -691,13 +1835,8 @@ def create_rspace(gridsize, radius_max):
     """
 
     radius = gridsize // 2
-    vecs = []
-    for i in range(-radius, radius + 1):
-        for j in range(-radius, radius + 1):
-            for k in range(-radius, radius + 1):
-                vecs.append([i, j, k])
-
-    vecs = np.array(vecs, dtype='float32')
+    grid = np.mgrid[-radius:radius + 1, -radius:radius + 1, -radius:radius + 1]
+    vecs = grid.reshape(3, -1).T.astype('float32')
     tab = vecs / radius
     tab = tab * radius_max
     vecs = vecs + radius
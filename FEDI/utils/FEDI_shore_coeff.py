@@ -0,0 +1,182 @@
+"""Stored SHORE coefficients of a reconstruction
+
+fedi_dmri_recon can save the SHORE coefficients of the fitted voxels, packed
+by the mask in float32, together with the parameters of the basis. Since the
+signal and every SHORE metric are linear in the coefficients, any later
+re-prediction on a new gradient table or derived map is a single matrix
+product over the stored voxels, without fitting again.
+
+Voxels are packed slice by slice, i.e. in C order of the (z, x, y) mask, so
+that slabs of slices are packed independently and concatenated, and the
+voxels of a slab are a contiguous block of rows. Predictions on a large
+gradient table are streamed to disk slab by slab (see predict_to_nifti).
+"""
+import re
+
+import numpy as np
+from dipy.core.gradients import gradient_table
+
+from FEDI.utils.FEDI_nifti import nifti_memmap_writer
+from FEDI.utils.FEDI_shore import brainsuite_shore_basis, shore_index_matrix, shore_metric_map
+
+# Metrics clipped at 0, as the BrainSuiteShoreFit methods do
+_POSITIVE_METRICS = ("rtop_signal", "rtop_pdf", "msd")
+
+
+def pack_slices(volume, mask):
+    """(n, ...) values of volume (nx, ny, nz, ...) at the voxels of mask, slice by slice."""
+    return np.moveaxis(volume, 2, 0)[np.moveaxis(mask, 2, 0)]
+
+
+def unpack_slices(values, mask, fill=0, dtype=None):
+    """Inverse of pack_slices, voxels outside the mask are set to fill."""
+    values = np.asarray(values)
+    volume = np.full(mask.shape + values.shape[1:], fill, dtype=dtype or values.dtype)
+    np.moveaxis(volume, 2, 0)[np.moveaxis(mask, 2, 0)] = values
+    return volume
+
+
+def read_dvs(fname, bmax):
+    """Gradient table of a Siemens .dvs scheme file.
+
+    The vectors of a .dvs file are scaled so that their squared norm is the
+    b-value relative to the largest b-value of the scheme, bmax.
+    """
+    vectors = []
+    with open(fname) as f:
+        for line in f:
+            match = re.match(r"\s*Vector\[\d+\]\s*=\s*\((.*)\)", line)
+            if match:
+                vectors.append([float(v) for v in match.group(1).split(",")])
+    vectors = np.array(vectors)
+    norms = np.linalg.norm(vectors, axis=1)
+    bvals = np.round(bmax * norms**2)
+    bvecs = np.zeros_like(vectors)
+    nonzero = norms > 0
+    bvecs[nonzero] = vectors[nonzero] / norms[nonzero, None]
+    return gradient_table(bvals, bvecs=bvecs, b0_threshold=0)
+
+
+def n_shore_coef(radial_order):
+    """Number of SHORE coefficients of a given radial order."""
+    return shore_index_matrix(radial_order).shape[0]
+
+
+class ShoreCoefficients(object):
+    """SHORE coefficients of the voxels of a mask and the parameters of their basis.
+
+    Parameters
+    ----------
+    coef : ndarray (n, n_coefs)
+        Coefficients of the n voxels of mask, packed by pack_slices.
+    mask : ndarray (nx, ny, nz)
+        Fitted voxels.
+    affine : ndarray (4, 4)
+        Affine of the reconstructed volume.
+    radial_order, zeta, tau : float
+        Parameters of the SHORE basis.
+    lambdaN, lambdaL : float
+        Radial and angular regularization constants of the fit.
+    S0 : float
+        Scale of the predicted signal.
+    fit_options : dict, optional
+        Other options of the fit (gradient tables, solver, ...) as arrays or
+        scalars, saved with the coefficients so that a later reconstruction
+        can check that it would fit them the same way.
+    """
+
+    def __init__(self, coef, mask, affine, radial_order, zeta, tau, lambdaN, lambdaL, S0=1., fit_options=None):
+        self.mask = np.asarray(mask) > 0
+        self.coef = np.asarray(coef, dtype=np.float32)
+        if self.coef.shape != (np.count_nonzero(self.mask), n_shore_coef(radial_order)):
+            raise ValueError("coef of shape %s do not match the mask and radial_order %d"
+                             % (self.coef.shape, radial_order))
+        self.affine = np.asarray(affine)
+        self.radial_order = int(radial_order)
+        self.zeta = zeta
+        self.tau = tau
+        self.lambdaN = lambdaN
+        self.lambdaL = lambdaL
+        self.S0 = S0
+        self.fit_options = dict(fit_options or {})
+
+    @classmethod
+    def from_volume(cls, coef_volume, mask, affine, **params):
+        """Pack a (nx, ny, nz, n_coefs) coefficient volume by mask."""
+        return cls(pack_slices(coef_volume, np.asarray(mask) > 0), mask, affine, **params)
+
+    @property
+    def shape(self):
+        """Shape of the reconstructed volume, without the coefficient axis."""
+        return self.mask.shape
+
+    def volume(self, values=None):
+        """Unpack values (n, ...) per voxel, the coefficients by default, into a volume."""
+        return unpack_slices(self.coef if values is None else values, self.mask)
+
+    def predict(self, gtab, S0=None):
+        """(nx, ny, nz, n_volumes) float32 signal predicted on gtab."""
+        S0 = self.S0 if S0 is None else S0
+        M = brainsuite_shore_basis(self.radial_order, self.zeta, gtab, self.tau, dtype=np.float32)
+        return self.volume(S0 * np.dot(self.coef, M.T))
+
+    def iter_predict(self, gtab, S0=None, max_memory=256 * 2**20):
+        """Predict the signal on gtab by blocks of at most about max_memory bytes.
+
+        Yields (slab, volumes, block) where block is the float32 signal of
+        the voxels [:, :, slab, volumes], zero outside the mask. The basis of
+        gtab is cached per scheme, and each block is a single product of the
+        rows of the slab with the columns of the basis of its volumes.
+        """
+        S0 = self.S0 if S0 is None else S0
+        M = brainsuite_shore_basis(self.radial_order, self.zeta, gtab, self.tau, dtype=np.float32)
+        nx, ny, nz = self.shape
+        nv = M.shape[0]
+        itemsize = np.dtype(np.float32).itemsize
+        # Whole volumes of one slice at least, fewer volumes if a slice does not fit
+        nvblock = int(min(nv, max(1, max_memory // (nx * ny * itemsize))))
+        nslab = int(min(nz, max(1, max_memory // (nx * ny * nvblock * itemsize))))
+        offsets = np.concatenate([[0], np.cumsum(np.count_nonzero(self.mask, axis=(0, 1)))])
+        for start in range(0, nz, nslab):
+            slab = slice(start, min(start + nslab, nz))
+            coef = self.coef[offsets[slab.start]:offsets[slab.stop]]
+            for vstart in range(0, nv, nvblock):
+                volumes = slice(vstart, min(vstart + nvblock, nv))
+                values = np.dot(coef, M[volumes].T)
+                values *= S0
+                yield slab, volumes, unpack_slices(values, self.mask[:, :, slab])
+
+    def predict_to_nifti(self, gtab, fname, S0=None, max_memory=256 * 2**20):
+        """Write the float32 signal predicted on gtab to the NIfTI file fname.
+
+        The prediction is streamed to a memory-mapped output by iter_predict,
+        so that it is never held in memory as a whole.
+        """
+        shape = self.shape + (len(gtab.bvals),)
+        with nifti_memmap_writer(fname, shape, self.affine, np.float32) as spred4D:
+            for slab, volumes, block in self.iter_predict(gtab, S0, max_memory):
+                spred4D[:, :, slab, volumes] = block
+
+    def metric(self, metric):
+        """Map of one of SHORE_METRICS, (nx, ny, nz) or (nx, ny, nz, J) for "odf_sh"."""
+        values = shore_metric_map(self.coef.astype(np.float64), self.radial_order, self.zeta, metric)
+        if metric in _POSITIVE_METRICS:
+            values = np.maximum(values, 0)
+        return self.volume(values)
+
+    def save(self, fname):
+        """Save the coefficients and parameters to an .npz file."""
+        with open(fname, "wb") as f:
+            np.savez(f, coef=self.coef, mask=self.mask, affine=self.affine,
+                     radial_order=self.radial_order, zeta=self.zeta, tau=self.tau,
+                     lambdaN=self.lambdaN, lambdaL=self.lambdaL, S0=self.S0,
+                     **{"fit_" + name: value for name, value in self.fit_options.items()})
+
+    @classmethod
+    def load(cls, fname):
+        """Load coefficients saved by save, files saved without fit options have none."""
+        with np.load(fname) as npz:
+            fit_options = {key[len("fit_"):]: npz[key] for key in npz.files if key.startswith("fit_")}
+            return cls(npz["coef"], npz["mask"], npz["affine"], int(npz["radial_order"]),
+                       float(npz["zeta"]), float(npz["tau"]), float(npz["lambdaN"]),
+                       float(npz["lambdaL"]), float(npz["S0"]), fit_options)
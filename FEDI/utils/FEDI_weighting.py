@@ -0,0 +1,616 @@
+"""Slice weighting rules shared by fedi_dmri_outliers and the robust SHORE fit
+
+The modified z-score weights of the slices of the data, and the weights
+given by the posterior of a Gaussian mixture model of the log RMSE of each
+slice and volume, which fedi_dmri_outliers writes to disk, are computed here
+on arrays so that BrainSuiteShoreModel.fit_irls can apply them in memory.
+The angular neighbours of the directions of a scheme, used by the neighbour
+correlation weights, only depend on the scheme and are cached.
+"""
+import numpy as np
+
+from FEDI.utils.FEDI_cache import cached_matrix
+
+
+def calculate_mzscore_weightts(Zscores, lowerThreshold, upperThreshold, weightscalingmethod):
+
+    weights = Zscores
+    weights[weights < lowerThreshold] = lowerThreshold
+    weights[weights > upperThreshold] = upperThreshold
+
+    if weightscalingmethod == "linear":
+        # Linear scaling
+        weights = (weights - lowerThreshold) / (upperThreshold - lowerThreshold)
+    elif weightscalingmethod == "sigmoid":
+        # Sigmoid scaling
+        k = 1  # You may adjust the k value as needed
+        weights = (weights - lowerThreshold) * 2.0 / (upperThreshold - lowerThreshold) - 1.0
+        weights = 1 / (1 + np.exp(-weights / k))
+
+    weights = 1 - weights
+
+    # Replace NaN with 0
+    weights = np.nan_to_num(weights)
+
+    # Ensure that at least some values are > 0
+    for i in range(weights.shape[0]):
+        if np.all(weights[i, :] <= 0):
+            weights[i, 0] = 1
+            weights[i, -1] = 1
+
+    return weights
+
+
+def mzscore_slice_weights(dmri, fmask, bvals, metric="mean", lowerThreshold=3.5, upperThreshold=6.0, weightscalingmethod="linear"):
+    """
+    Modified z-score of each slice and volume, and the slice weights derived from it
+
+    Parameters:
+    -----------
+    dmri : ndarray (nx, ny, nz, nv)
+        DWI data
+    fmask : ndarray (nx, ny, nz) or None
+        Brain mask, voxels outside are set to 0
+    bvals : ndarray (nv,)
+        B-values
+    metric : str
+        Statistic of each slice compared across volumes: "var", "mean" or "iod"
+    lowerThreshold, upperThreshold : float
+        Modified z-scores mapped to the weights 1 and 0
+    weightscalingmethod : str
+        "linear" or "sigmoid" mapping between the thresholds
+
+    Returns:
+    --------
+    ModZscore : ndarray (nz, nv)
+        Modified z-scores, clipped to the thresholds (NaN for shells of a single volume)
+    ModZscore_weights : ndarray (nz, nv)
+        Slice weights
+    """
+    nx, ny, nz, nv = dmri.shape
+    S1, S2 = mzscore_slice_sums(dmri, fmask, squares=metric in ("var", "iod"))
+    return mzscore_from_sums(S1, S2, nx * ny, bvals, metric, lowerThreshold, upperThreshold, weightscalingmethod)
+
+
+def mzscore_slice_sums(dmri, fmask=None, squares=True):
+    """
+    Sums, and sums of squares, of each slice of each volume within the mask
+
+    Computed in one pass over a masked view of dmri, which can be a slab of
+    slices. Voxels outside the mask count as 0, as in the mean of the whole
+    slice.
+
+    Returns:
+    --------
+    S1, S2 : ndarray (nz, nv)
+        Sums and sums of squares (None if squares is False)
+    """
+    if fmask is None:
+        inside = np.ones(dmri.shape[:3], dtype=dmri.dtype)
+    else:
+        inside = (fmask.astype(int) != 0).astype(dmri.dtype)
+    S1 = np.einsum("xyzv,xyz->zv", dmri, inside, dtype=np.float64)
+    S2 = None
+    if squares:
+        S2 = np.einsum("xyzv,xyzv,xyz->zv", dmri, dmri, inside, dtype=np.float64)
+    return S1, S2
+
+
+def mzscore_from_sums(S1, S2, nvox, bvals, metric="mean", lowerThreshold=3.5, upperThreshold=6.0, weightscalingmethod="linear"):
+    """
+    Modified z-scores and slice weights of mzscore_slice_weights from the sums of mzscore_slice_sums
+
+    nvox is the number of voxels of a slice.
+    """
+    mean = S1 / nvox
+    if metric in ("var", "iod"):
+        var = np.maximum(S2 / nvox - mean**2, 0)
+
+    # get y following the chosen metric, for all volumes at once
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if metric == "var":
+            y = var
+        if metric == "mean":
+            y = mean
+        if metric == "iod":
+            y = var / mean
+
+    nz, nv = y.shape
+    ModZscore = np.full((nz, nv), np.nan)
+    bvalsround = bvals.round(-2)
+    for b in np.unique(bvalsround):
+        # for each dwi bvalues
+        inds = np.flatnonzero(bvalsround == b)
+        if inds.size < 2:
+            continue
+
+        # Median of the slice over the volumes of the shell, the slices of an empty mask (NaN iod) are ignored
+        yshell = y[:, inds]
+        ymedian = np.nanmedian(yshell, axis=1)[:, None]
+        # Median Absolute Deviation (MAD) = k-factor * median(|y - ymedian|)
+        # k-factor =  For normally distributed data k is taken to be 1.4826
+        deviation = np.abs(yshell - ymedian)
+        MAD = 1.4826 * np.nanmedian(deviation, axis=1) + 0.0001
+
+        # Calculate modified Zscore = |y-ymedian|/MAD
+        ModZscore[:, inds] = deviation / MAD[:, None]
+
+    ModZscore_weights = calculate_mzscore_weightts(ModZscore, lowerThreshold, upperThreshold, weightscalingmethod)
+
+    return ModZscore, ModZscore_weights
+
+
+def angular_neighbors(bvals, bvecs, b0_threshold=0, n_neighbors=3):
+    """
+    Nearest directions of each diffusion weighted volume on its shell
+
+    The graph only depends on the gradient scheme, it is cached under a hash
+    of bvals and bvecs (see FEDI_cache).
+
+    Parameters:
+    -----------
+    bvals : ndarray (nv,)
+        B-values
+    bvecs : ndarray (nv, 3)
+        Unit b-vectors
+    b0_threshold : float
+        Volumes of b-value up to b0_threshold have no neighbours
+    n_neighbors : int
+        Number of neighbours of each direction
+
+    Returns:
+    --------
+    volumes : ndarray (n,)
+        Volume of each direction, shell by shell, -1 for a zero b-vector
+    neighbors : ndarray (n, n_neighbors)
+        Volumes of the nearest directions of the same shell
+    angles : ndarray (n,)
+        Average angle in degrees with the neighbours, -1 for a zero b-vector
+    shells : ndarray (n,)
+        B-value of the shell of each direction
+    """
+    bvals = np.asarray(bvals, dtype=float)
+    bvecs = np.asarray(bvecs, dtype=float)
+    return cached_matrix("angular_neighbors", (bvals, bvecs, b0_threshold, n_neighbors),
+                         lambda: _angular_neighbors(bvals, bvecs, b0_threshold, n_neighbors))
+
+
+def _angular_neighbors(bvals, bvecs, b0_threshold, n_neighbors):
+    volumes, neighbors, angles, shells = [], [], [], []
+    for bval in np.unique(bvals[bvals > b0_threshold]):
+        shell_idx = np.where(bvals == bval)[0]
+        shell = bvecs[shell_idx]
+        for i, vec in enumerate(shell):
+            shells.append(bval)
+            if np.linalg.norm(vec) < 0.001:
+                volumes.append(-1)
+                neighbors.append([-1] * n_neighbors)
+                angles.append(-1)
+                continue
+
+            dot_product = np.clip(np.tensordot(shell, vec, axes=1), -1, 1)
+            angle = np.arccos(dot_product) * 180 / np.pi
+            angle[np.isnan(angle)] = 0
+
+            # The direction itself is among its n_neighbors + 1 nearest
+            idx = np.argpartition(angle, n_neighbors + 1).tolist()
+            idx.remove(i)
+
+            volumes.append(shell_idx[i])
+            neighbors.append(shell_idx[idx[:n_neighbors]])
+            angles.append(np.average(angle[idx[:n_neighbors]]))
+    return (np.array(volumes, dtype=int), np.array(neighbors, dtype=int).reshape(-1, n_neighbors),
+            np.array(angles, dtype=float), np.array(shells, dtype=float))
+
+
+def neighbors_slice_weights(dmri, bvals, bvecs, b0_threshold=0, std_scale=3):
+    """
+    Slice weights from the angle and the correlation with the neighbouring directions
+
+    Each pair of consecutive slices of a volume is correlated with the same
+    slices of the nearest directions of its shell (see angular_neighbors).
+    A volume whose average angle, or average correlation, with its neighbours
+    is more than std_scale standard deviations below the average of its
+    shell gets a weight of 0 in the first slice of the pair. The last two
+    slices keep a weight of 1.
+
+    Parameters:
+    -----------
+    dmri : ndarray (nx, ny, nz, nv)
+        DWI data
+    bvals : ndarray (nv,)
+        B-values
+    bvecs : ndarray (nv, 3)
+        Unit b-vectors
+    b0_threshold : float
+        Volumes of b-value up to b0_threshold are not weighted
+    std_scale : float
+        Number of standard deviations below the average of the shell
+
+    Returns:
+    --------
+    AngleMatrix, CorreMatrix : ndarray (nz, nv)
+        Slice weights of the angle and of the correlation tests
+    """
+    graph = angular_neighbors(bvals, bvecs, b0_threshold)
+    S1, S2, C = neighbor_slice_sums(dmri, graph[0], graph[1])
+    return neighbors_from_sums(S1, S2, C, dmri.shape[0] * dmri.shape[1], graph, std_scale)
+
+
+def neighbor_slice_sums(dmri, volumes, neighbors):
+    """
+    Sums over each slice needed by the neighbour correlations
+
+    Parameters:
+    -----------
+    dmri : ndarray (nx, ny, nz, nv)
+        DWI data, or a slab of its slices
+    volumes, neighbors : ndarray (n,), (n, n_neighbors)
+        Directions and their neighbours, as returned by angular_neighbors
+
+    Returns:
+    --------
+    S1, S2 : ndarray (nz, nv)
+        Sums and sums of squares of each slice of each volume
+    C : ndarray (nz, n, n_neighbors)
+        Sums of the products of each direction with its neighbours (0 for a zero b-vector)
+    """
+    S1 = np.einsum("xyzv->zv", dmri, dtype=np.float64)
+    S2 = np.einsum("xyzv,xyzv->zv", dmri, dmri, dtype=np.float64)
+    C = np.zeros((dmri.shape[2],) + neighbors.shape)
+    # One direction at a time, on a view of its volume and a copy of its few neighbours only
+    for r in np.flatnonzero(volumes >= 0):
+        C[:, r] = np.einsum("xyz,xyzk->zk", dmri[..., volumes[r]], dmri[..., neighbors[r]], dtype=np.float64)
+    return S1, S2, C
+
+
+def neighbors_from_sums(S1, S2, C, nvox, graph, std_scale=3):
+    """
+    Angle and correlation slice weights of neighbors_slice_weights from the sums of neighbor_slice_sums
+
+    nvox is the number of voxels of a slice and graph is returned by angular_neighbors.
+    """
+    volumes, neighbors, angles, shells = graph
+    nz, nv = S1.shape
+    AngleMatrix = np.ones((nz, nv))
+    CorreMatrix = np.ones((nz, nv))
+    nblocks = max(nz - 2, 0)
+    valid = volumes >= 0
+
+    # Centred sums of each pair of slices
+    n = 2 * nvox
+    sums = S1[:nblocks] + S1[1:nblocks + 1]
+    var = np.maximum(S2[:nblocks] + S2[1:nblocks + 1] - sums**2 / n, 0)
+    cross = C[:nblocks] + C[1:nblocks + 1]
+
+    # Average correlation of each pair of slices with its neighbours, -1 for a zero b-vector
+    corr = np.full((nblocks, len(volumes)), -1.)
+    vol = volumes[valid]
+    nb = neighbors[valid]
+    cov = cross[:, valid] - sums[:, vol, None] * sums[:, nb] / n
+    with np.errstate(divide="ignore", invalid="ignore"):
+        r = cov / np.sqrt(var[:, vol, None] * var[:, nb])
+    corr[:, valid] = np.mean(np.clip(r, -1, 1), axis=2)
+
+    # Outliers of each shell, for all pairs of slices at once
+    for bval in np.unique(shells):
+        rows = np.flatnonzero(shells == bval)
+        avg_angle = np.round(np.average(angles[rows]), 4)
+        std_angle = np.round(np.std(angles[rows]), 4)
+        outliers_angle = rows[angles[rows] < avg_angle - (std_scale * std_angle)]
+        AngleMatrix[np.ix_(np.arange(nblocks), volumes[outliers_angle])] = 0
+
+        avg_corr = np.round(np.average(corr[:, rows], axis=1), 4)
+        std_corr = np.round(np.std(corr[:, rows], axis=1), 4)
+        blocks, outliers_corr = np.nonzero(corr[:, rows] < (avg_corr - (std_scale * std_corr))[:, None])
+        CorreMatrix[blocks, volumes[rows[outliers_corr]]] = 0
+
+    return AngleMatrix, CorreMatrix
+
+
+class GMModel:
+    """
+    2-component Gaussian Mixture Model for outlier detection
+    Based on the C++ implementation in dwisliceoutliergmm.cpp
+
+    A 2D input is fitted row by row, all rows at once: the parameters are
+    arrays with one value per row, and each row stops updating once its
+    log-likelihood has converged.
+    """
+    
+    def __init__(self, max_iters=50, eps=1e-3, reg_covar=1e-6):
+        self.niter = max_iters
+        self.tol = eps
+        self.reg = reg_covar
+        
+    def fit(self, x, valid=None):
+        """Fit GMM to vector x using Expectation-Maximization
+
+        x can also be a 2D array of rows fitted independently, valid then
+        marks the samples of each row when rows of different lengths are
+        padded to the same size.
+        """
+        x = np.asarray(x, dtype=float)
+        self._vector = x.ndim != 2
+        if self._vector:
+            x = x.reshape(1, -1)
+        valid = np.ones(x.shape, dtype=bool) if valid is None else np.asarray(valid, dtype=bool)
+        # Padded samples are set to 0, they are given no weight
+        x = np.where(valid, x, 0.)
+        self._valid = valid
+        self._n = np.count_nonzero(valid, axis=1)
+        
+        # Initialize
+        self._init(x)
+        
+        ll0 = np.full(x.shape[0], -np.inf)
+        active = np.ones(x.shape[0], dtype=bool)
+        
+        # EM algorithm
+        for n in range(self.niter):
+            ll = self._e_step(x, active)
+            self._m_step(x, active)
+            
+            # Check convergence, converged rows keep their responsibilities
+            active &= ~(np.abs(ll - ll0) < self.tol)
+            if not np.any(active):
+                break
+            ll0 = ll
+            
+    def posterior(self):
+        """Get posterior probability of inlier class, a row per fitted row (zero where not valid)"""
+        p = np.where(self._valid, np.exp(self.Rin), 0.)
+        return p[0] if self._vector else p
+
+    def _init(self, x):
+        """Initialize inlier and outlier classes"""
+        samples = np.where(self._valid, x, np.nan)
+        med = np.nanmedian(samples, axis=1)
+        mad = np.nanmedian(np.abs(samples - med[:, None]), axis=1) * 1.4826
+        
+        # Initialize means (shift +1 for log-Gaussians)
+        self.Min = med
+        self.Mout = med + 1.0
+        
+        # Initialize standard deviations
+        self.Sin = mad
+        self.Sout = mad + 1.0
+        
+        # Initialize mixing proportions
+        self.Pin = np.full(x.shape[0], 0.9)
+        self.Pout = np.full(x.shape[0], 0.1)
+        self.Rin = np.zeros(x.shape)
+        self.Rout = np.zeros(x.shape)
+        
+    def _e_step(self, x, active):
+        """E-step: update sample log-responsibilities of the active rows and return the log-likelihood of each row"""
+        # Compute log responsibilities
+        Rin = self._log_gaussian(x, self.Min[:, None], self.Sin[:, None]) + np.log(self.Pin)[:, None]
+        Rout = self._log_gaussian(x, self.Mout[:, None], self.Sout[:, None]) + np.log(self.Pout)[:, None]
+        
+        # Normalize
+        log_prob_norm = np.logaddexp(Rin, Rout)
+        self.Rin = np.where(active[:, None], Rin - log_prob_norm, self.Rin)
+        self.Rout = np.where(active[:, None], Rout - log_prob_norm, self.Rout)
+        
+        return np.sum(log_prob_norm, axis=1, where=self._valid) / self._n
+    
+    def _m_step(self, x, active):
+        """M-step: update component mean and variance of the active rows"""
+        eps = np.finfo(float).eps
+        
+        # Compute weights, none for the padded samples
+        w1 = (np.exp(self.Rin) + eps) * self._valid
+        w2 = (np.exp(self.Rout) + eps) * self._valid
+        
+        # Update mixing proportions
+        Pin = np.sum(w1, axis=1) / self._n
+        Pout = np.sum(w2, axis=1) / self._n
+        
+        # Update means
+        Min = self._average(x, w1)
+        Mout = self._average(x, w2)
+        
+        # Update standard deviations
+        Sin = np.sqrt(self._average((x - Min[:, None])**2, w1) + self.reg)
+        Sout = np.sqrt(self._average((x - Mout[:, None])**2, w2) + self.reg)
+
+        for name, value in (("Pin", Pin), ("Pout", Pout), ("Min", Min), ("Mout", Mout), ("Sin", Sin), ("Sout", Sout)):
+            setattr(self, name, np.where(active, value, getattr(self, name)))
+    
+    def _log_gaussian(self, x, mu, sigma):
+        """Compute log probability under Gaussian"""
+        resp = (x - mu) / sigma
+        resp = -(resp**2 + np.log(2 * np.pi)) / 2 - np.log(sigma)
+        return resp
+    
+    def _average(self, x, w):
+        """Weighted average of each row"""
+        return np.einsum("ij,ij->i", x, w) / np.sum(w, axis=1)
+
+
+def organize_shells(bvals, threshold=50):
+    """
+    Organize gradient directions into shells
+    
+    Parameters:
+    -----------
+    bvals : ndarray
+        B-values
+    threshold : float
+        Threshold for grouping b-values into shells
+        
+    Returns:
+    --------
+    shells : list of lists
+        Each shell contains volume indices
+    """
+    unique_bvals = []
+    shells = []
+    
+    for i, bval in enumerate(bvals):
+        # Find matching shell
+        matched = False
+        for j, ubval in enumerate(unique_bvals):
+            if np.abs(bval - ubval) < threshold:
+                shells[j].append(i)
+                matched = True
+                break
+        
+        if not matched:
+            unique_bvals.append(bval)
+            shells.append([i])
+    
+    return shells
+
+
+def compute_rmse_slicewise(data, pred, mask, mb=1):
+    """
+    Compute root mean squared error for each slice
+    
+    Parameters:
+    -----------
+    data : ndarray (nx, ny, nz, nv)
+        DWI data
+    pred : ndarray (nx, ny, nz, nv)
+        Signal prediction
+    mask : ndarray (nx, ny, nz)
+        Brain mask
+    mb : int
+        Multiband factor
+        
+    Returns:
+    --------
+    E : ndarray (ne, nv)
+        RMSE matrix (ne = nz/mb excitations, nv = volumes)
+    """
+    sse, count = residual_slice_sums(data, pred, mask)
+    return rmse_from_sums(sse, count, mb)
+
+
+def residual_slice_sums(data, pred, mask):
+    """
+    Sum of squared errors and number of voxels of mask of each slice and volume
+
+    data and pred can be a slab of slices. Returns sse (nz, nv) and count (nz, nv).
+    """
+    nv = data.shape[3]
+    valid = mask > 0
+    diff = np.subtract(data, pred, dtype=np.result_type(data, pred, np.float64))
+    diff **= 2
+    sse = np.einsum("xyzv,xyz->zv", diff, valid.astype(diff.dtype))
+    count = np.repeat(np.count_nonzero(valid, axis=(0, 1))[:, None], nv, axis=1)
+    return sse, count
+
+
+def rmse_from_sums(sse, count, mb=1):
+    """
+    RMSE of compute_rmse_slicewise from the sums of residual_slice_sums
+    """
+    nz, nv = sse.shape
+    ne = nz // mb  # Number of excitations
+    
+    # Combine multiband slices, the excitations are the rows of each group of ne slices
+    ngroups = nz // ne
+    E_mb = sse[:ngroups * ne].reshape(ngroups, ne, nv).sum(axis=0)
+    N_mb = count[:ngroups * ne].reshape(ngroups, ne, nv).sum(axis=0)
+    
+    # Compute RMSE
+    E = np.zeros((ne, nv))
+    valid_mask = N_mb > 0
+    E[valid_mask] = np.sqrt(E_mb[valid_mask] / N_mb[valid_mask])
+    
+    return E
+
+
+def fedi_dmri_outliersgmm(data, pred, mask, bvals, mb=1):
+    """
+    Detect and reweigh outlier slices using Bayesian GMM modeling
+    
+    Parameters:
+    -----------
+    data : ndarray (nx, ny, nz, nv)
+        DWI data
+    pred : ndarray (nx, ny, nz, nv)
+        Signal prediction
+    mask : ndarray (nx, ny, nz)
+        Brain mask
+    bvals : ndarray (nv,)
+        B-values
+    mb : int
+        Multiband factor
+        
+    Returns:
+    --------
+    W : ndarray (nz, nv)
+        Slice weights
+    """
+    # Compute RMSE
+    E = compute_rmse_slicewise(data, pred, mask, mb)
+
+    return gmm_slice_weights(E, bvals, mb)
+
+
+def gmm_slice_weights(E, bvals, mb=1):
+    """
+    Slice weights from the slice RMSE using Bayesian GMM modeling
+    
+    Parameters:
+    -----------
+    E : ndarray (ne, nv)
+        RMSE matrix, as returned by compute_rmse_slicewise
+    bvals : ndarray (nv,)
+        B-values
+    mb : int
+        Multiband factor
+        
+    Returns:
+    --------
+    W : ndarray (nz, nv)
+        Slice weights
+    """
+    ne = E.shape[0]
+    
+    # Organize into shells
+    shells = organize_shells(bvals)
+    
+    # Residuals of each shell, volume after volume, as the rows of a padded array
+    lengths = np.array([len(shell) * ne for shell in shells])
+    res = np.zeros((len(shells), lengths.max()))
+    valid = np.arange(res.shape[1]) < lengths[:, None]
+    for s, shell in enumerate(shells):
+        res[s, :lengths[s]] = E[:, shell].T.ravel()
+    
+    # Clip each shell at its non-zero minimum
+    positive = valid & (res > 0)
+    nzmin = np.min(res, axis=1, where=positive, initial=np.inf)
+    nzmin[~np.any(positive, axis=1)] = 1e-10
+    logres = np.log(np.maximum(res, nzmin[:, None]))
+    
+    # Fit the GMM of all shells at once
+    gmm = GMModel()
+    gmm.fit(logres, valid)
+    
+    # Get posterior probabilities
+    p = gmm.posterior()
+    
+    # Assign to weight matrix
+    W = np.ones_like(E)
+    for s, shell in enumerate(shells):
+        W[:, shell] = p[s, :lengths[s]].reshape(len(shell), ne).T
+    
+    # Replicate for multiband and round to 6 decimals
+    W_full = W.repeat(mb, axis=0)
+    W_full = np.round(W_full * 1e6) * 1e-6
+    
+    return W_full
+
+
+def residual_voxel_weights(zscores):
+    """Voxel weights of fedi_dmri_outliers --fvoxelweights_shorebased from the standardized residuals."""
+    return np.sqrt(1 / np.square(np.square(zscores) + 1))
+
+
+def gmm_reweighting(E, bvals, mb=1):
+    """Slice weights of fedi_dmri_outliers --fsliceweights_gmmodel: the square root of the GMM posterior."""
+    return np.sqrt(gmm_slice_weights(E, bvals, mb))
@@ -1,7 +1,7 @@
 #!/bin/bash
 
 
-TOOLS=("fedi_dmri_moco" "fedi_dmri_reg" "fedi_dmri_recon" "fedi_apply_transform" "fedi_dmri_qweights" "fedi_dmri_rotate_bvecs" "fedi_dmri_outliers" "fedi_dmri_snr")
+TOOLS=("fedi_dmri_moco" "fedi_dmri_reg" "fedi_dmri_recon" "fedi_dmri_shore" "fedi_apply_transform" "fedi_dmri_qweights" "fedi_dmri_rotate_bvecs" "fedi_dmri_outliers" "fedi_dmri_snr")
 
 for tool in "${TOOLS[@]}"; do
     echo "${tool} - Command Help" > source/help_outputs/${tool}.txt
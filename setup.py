@@ -24,6 +24,7 @@ setup(
             'fedi_apply_transform=FEDI.scripts.fedi_apply_transform:main',
             'fedi_dmri_reg=FEDI.scripts.fedi_dmri_reg:main',
             'fedi_dmri_recon=FEDI.scripts.fedi_dmri_recon:main',
+            'fedi_dmri_shore=FEDI.scripts.fedi_dmri_shore:main',
             'fedi_dmri_moco=FEDI.scripts.fedi_dmri_moco:main',
             'fedi_dmri_fod=FEDI.scripts.fedi_dmri_fod:main',
             'fedi_testing=FEDI.scripts.fedi_testing_commands:main'